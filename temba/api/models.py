@@ -79,25 +79,25 @@ class WebHookEvent(SmartModel):
         deliver_event_task.delay(self.id)
 
     @classmethod
-    def trigger_flow_event(cls, webhook_url, flow, run, node, contact, event, action='POST'):
+    def build_flow_event_data(cls, flow, run, node, contact, event, results=None):
+        """
+        Builds the data we post to flow webhooks. Callers which have already fetched the results for
+        this contact can pass them in, and our run's steps are fetched along with their text in one query.
+        """
         org = flow.org
-        api_user = get_api_user()
-
-        # no-op if no webhook configured
-        if not webhook_url:
-            return
-
-        json_time = datetime_to_str(timezone.now())
 
         # get the results for this contact
-        results = flow.get_results(contact)
-        values = []
+        if results is None:
+            results = flow.get_results(contact)
 
+        values = []
         if results and results[0]:
-            values = results[0]['values']
-            for value in values:
+            for result_value in results[0]['values']:
+                # copy our values, the results may still be in use by our caller
+                value = dict(result_value)
                 value['time'] = datetime_to_str(value['time'])
                 value['value'] = unicode(value['value'])
+                values.append(value)
 
         # if the action is on the first node
         # we might not have an sms (or channel) yet
@@ -113,16 +113,35 @@ class WebHookEvent(SmartModel):
         else:
             channel_id = -1
 
+        # voice steps have no messages, their text is the value of the digits entered
+        ivr_steps = set()
+        if run.call_id:
+            from temba.ivr.models import IVRAction
+            ivr_steps = set(IVRAction.objects.filter(step__run=run).values_list('step', flat=True))
+
+        # steps come back once for each of their messages, most recent first, we only want that first text
+        step_values = run.steps.values('pk', 'step_type', 'step_uuid', 'arrived_on', 'left_on', 'rule_value', 'messages__text')
+        step_values = step_values.order_by('arrived_on', 'pk', '-messages__created_on', '-messages__pk')
+
         steps = []
-        for step in run.steps.all().order_by('arrived_on'):
-            steps.append(dict(type=step.step_type,
-                              node=step.step_uuid,
-                              arrived_on=datetime_to_str(step.arrived_on),
-                              left_on=datetime_to_str(step.left_on),
-                              text=step.get_text(),
-                              value=step.rule_value))
-
-        data = dict(channel=channel_id,
+        last_step = None
+        for step in step_values:
+            if step['pk'] == last_step:
+                continue
+            last_step = step['pk']
+
+            step_text = step['messages__text']
+            if step_text is None and step['pk'] in ivr_steps:
+                step_text = unicode(step['rule_value'])
+
+            steps.append(dict(type=step['step_type'],
+                              node=step['step_uuid'],
+                              arrived_on=datetime_to_str(step['arrived_on']),
+                              left_on=datetime_to_str(step['left_on']),
+                              text=step_text,
+                              value=step['rule_value']))
+
+        return dict(channel=channel_id,
                     relayer=channel_id,
                     flow=flow.id,
                     run=run.id,
@@ -131,7 +150,19 @@ class WebHookEvent(SmartModel):
                     phone=contact.get_urn_display(org=org, scheme=TEL_SCHEME, full=True),
                     values=json.dumps(values),
                     steps=json.dumps(steps),
-                    time=json_time)
+                    time=datetime_to_str(timezone.now()))
+
+    @classmethod
+    def trigger_flow_event(cls, webhook_url, flow, run, node, contact, event, action='POST', results=None):
+        org = flow.org
+        api_user = get_api_user()
+
+        # no-op if no webhook configured
+        if not webhook_url:
+            return
+
+        data = cls.build_flow_event_data(flow, run, node, contact, event, results=results)
+        channel = event.channel if event else None
 
         if not action:
             action = 'POST'
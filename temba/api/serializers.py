@@ -155,7 +155,7 @@ class ContactReadSerializer(serializers.ModelSerializer):
 
     def get_contact_fields(self, obj):
         fields = dict()
-        for contact_field in ContactField.objects.filter(org=obj.org, is_active=True):
+        for contact_field in obj.org.get_schema().active_fields:
             fields[contact_field.key] = obj.get_field_display(contact_field.key)
         return fields
 
@@ -287,7 +287,7 @@ class ContactWriteSerializer(WriteSerializer):
     def validate_fields(self, attrs, source):
         fields = attrs.get(source, {}).items()
         if fields:
-            org_fields = list(ContactField.objects.filter(org=self.user.get_org(), is_active=True))
+            org_fields = self.user.get_org().get_schema().active_fields
 
             for key, value in attrs.get(source, {}).items():
                 for field in org_fields:
@@ -362,16 +362,20 @@ class ContactWriteSerializer(WriteSerializer):
         # update our fields
         fields = attrs.get('fields', None)
         if not fields is None:
+            field_values = dict()
             for key, value in fields.items():
                 existing_by_key = ContactField.objects.filter(org=self.user.get_org(), key__iexact=key, is_active=True).first()
                 if existing_by_key:
-                    contact.set_field(existing_by_key.key, value)
+                    field_values[existing_by_key.key] = value
                     continue
 
                 # TODO as above, need to get users to stop updating via label
                 existing_by_label = ContactField.objects.filter(org=self.user.get_org(), label__iexact=key, is_active=True).first()
                 if existing_by_label:
-                    contact.set_field(existing_by_label.key, value)
+                    field_values[existing_by_label.key] = value
+
+            # and set them all at once
+            contact.set_fields(field_values)
 
         # update our groups by UUID or name (deprecated)
         group_uuids = attrs.get('group_uuids', None)
@@ -736,7 +736,7 @@ class APITest(TembaTest):
         self.assertEquals("Andre", contact.get_field_display("real_name"))
 
         # try when contact field is not active
-        ContactField.objects.filter(org=self.org, key='state').update(is_active=False)
+        ContactField.hide_field(self.org, 'state')
         response = self.postJSON(url, dict(phone='+250788123456', fields={"state": "VA"}))
         self.assertContains(response, "Invalid", status_code=400)
         self.assertEquals("IL", Value.objects.get(contact=contact, contact_field=state).string_value)   # unchanged
@@ -2807,6 +2807,13 @@ class WebHookTest(TembaTest):
             self.assertTrue(values[0]['time'])
             self.assertTrue(data['time'])
 
+            # our steps should include the text of their messages, the api action's step isn't added until it's done
+            steps = json.loads(data['steps'])
+            self.assertEquals(2, len(steps))
+            self.assertEquals('What is your favorite color?', steps[0]['text'])
+            self.assertEquals('Mauve', steps[1]['text'])
+            self.assertEquals('Mauve', steps[1]['value'])
+
     def test_event_deliveries(self):
         sms = self.create_msg(contact=self.joe, direction='I', status='H', text="I'm gonna pop some tags")
 
@@ -1336,8 +1336,7 @@ class Contacts(generics.ListAPIView):
         if not queryset:
             return Response(status=status.HTTP_404_NOT_FOUND)
         else:
-            for contact in queryset:
-                contact.release()
+            Contact.bulk_release(queryset)
             return Response(status=status.HTTP_204_NO_CONTENT)
 
     def get_base_queryset(self, request):
@@ -1,6 +1,7 @@
+from collections import defaultdict
 from operator import attrgetter
 from uuid import uuid4
-from django.db import models
+from django.db import models, connection
 from django.db.models import Model
 from django.utils import timezone
 from smartmin.models import SmartModel
@@ -8,7 +9,8 @@ from datetime import timedelta
 
 from temba.contacts.models import ContactGroup, ContactField, Contact
 from temba.orgs.models import Org
-from temba.flows.models import Flow
+from temba.flows.models import Flow, FlowRun
+from temba.values.models import Value
 from dateutil.parser import parse
 from django.utils.translation import ugettext_lazy as _
 
@@ -197,6 +199,12 @@ UNIT_CHOICES = ((MINUTES, "Minutes"),
                 (DAYS, "Days"),
                 (WEEKS, "Weeks"))
 
+# how many event fires we insert at once when scheduling a whole group
+EVENT_FIRE_BATCH_SIZE = 1000
+
+# how many due event fires we claim at once when firing
+EVENT_FIRE_CLAIM_SIZE = 10000
+
 
 class CampaignEvent(SmartModel):
 
@@ -269,14 +277,41 @@ class CampaignEvent(SmartModel):
 
         return offset
 
+    def fire_batch(self, fire_ids):
+        """
+        Starts our flow for the contacts of all the passed in claimed fires at once, the flow takes care of batching
+        larger starts. If that fails, the fires whose contacts weren't started are released so they can be claimed
+        again.
+        """
+        contact_ids = EventFire.objects.filter(pk__in=fire_ids).values('contact_id')
+        started_on = timezone.now()
+        try:
+            self.flow.start([], Contact.objects.filter(pk__in=contact_ids), restart_participants=True)
+        except Exception:
+            # contacts who got a run before the failure have been sent our flow, so their fires stay fired
+            started = FlowRun.objects.filter(flow=self.flow, contact__in=contact_ids, created_on__gte=started_on)
+            started_ids = started.values('contact_id')
+            EventFire.objects.filter(pk__in=fire_ids).exclude(contact__in=started_ids).update(fired=None)
+            raise
+
     def calculate_scheduled_fire(self, contact):
         if not self.relative_to.is_active: # pragma: no cover
             return None
 
         # try to parse it to a datetime
         try:
-            now = timezone.now()
             date_value = EventFire.parse_relative_to_date(contact, self.relative_to.key)
+            return self.calculate_scheduled_fire_for_date(date_value, timezone.now())
+        except Exception:
+            pass
+
+        return None
+
+    def calculate_scheduled_fire_for_date(self, date_value, now):
+        """
+        Calculates when we should fire for the passed in relative to date, returning None if that is in the past
+        """
+        try:
             if date_value:
                 if self.unit == MINUTES:
                     delta = timedelta(minutes=self.offset)
@@ -295,7 +330,7 @@ class CampaignEvent(SmartModel):
                 if scheduled > now:
                     return scheduled
 
-        except Exception as e:
+        except Exception:
             pass
 
         return None
@@ -330,14 +365,98 @@ class EventFire(Model):
         self.fired = timezone.now()
         self.save()
 
+    @classmethod
+    def claim_due_fires(cls, limit=EVENT_FIRE_CLAIM_SIZE, exclude_events=()):
+        """
+        Claims up to limit fires which are due by marking them as fired in a single statement, skipping those of any
+        excluded events. Returns a dict of event id to the ids of the claimed fires for that event. Fires can only be
+        claimed again if they are released by a failed fire_batch.
+        """
+        claimed_on = timezone.now()
+
+        exclude_sql = ''
+        params = [claimed_on, claimed_on]
+        if exclude_events:
+            exclude_sql = 'AND event_id NOT IN %s '
+            params.append(tuple(exclude_events))
+
+        cursor = connection.cursor()
+        cursor.execute('UPDATE campaigns_eventfire SET fired = %s '
+                       'WHERE id IN (SELECT id FROM campaigns_eventfire WHERE fired IS NULL AND scheduled <= %s '
+                       '             ' + exclude_sql + 'ORDER BY scheduled LIMIT %s) '
+                       'AND fired IS NULL RETURNING id, event_id', params + [limit])
+
+        event_fires = defaultdict(list)
+        for fire_id, event_id in cursor.fetchall():
+            event_fires[event_id].append(fire_id)
+
+        return event_fires
+
+    @classmethod
+    def get_relative_to_dates(cls, contact_field, group):
+        """
+        Returns a list of (contact id, date) tuples for every contact in the passed in group with a parseable
+        date for the passed in field. All values are read in a single query.
+        """
+        contacts = group.contacts.filter(is_active=True, is_test=False)
+        values = Value.objects.filter(contact_field=contact_field, contact__in=contacts)
+
+        # most groups share a lot of dates, so only parse each distinct value once
+        parsed = dict()
+        dates = dict()
+        for contact_id, string_value in values.values_list('contact_id', 'string_value'):
+            if string_value not in parsed:
+                try:
+                    parsed[string_value] = contact_field.org.parse_date(string_value)
+                except Exception:
+                    parsed[string_value] = None
+
+            if parsed[string_value]:
+                dates[contact_id] = parsed[string_value]
+
+        return dates.items()
+
+    @classmethod
+    def create_event_fires(cls, events):
+        """
+        Schedules fires for the passed in events for every contact in their campaign groups. Callers are
+        responsible for removing any existing unfired fires first.
+        """
+        now = timezone.now()
+        group_dates = dict()
+        fires = []
+
+        for event in events:
+            if not event.relative_to.is_active:
+                continue
+
+            # events on the same field and group share their dates
+            key = (event.relative_to_id, event.campaign.group_id)
+            if key not in group_dates:
+                group_dates[key] = cls.get_relative_to_dates(event.relative_to, event.campaign.group)
+
+            for contact_id, date_value in group_dates[key]:
+                scheduled = event.calculate_scheduled_fire_for_date(date_value, now)
+                if scheduled:
+                    fires.append(EventFire(event=event, contact_id=contact_id, scheduled=scheduled))
+
+                if len(fires) >= EVENT_FIRE_BATCH_SIZE:
+                    EventFire.objects.bulk_create(fires)
+                    fires = []
+
+        if fires:
+            EventFire.objects.bulk_create(fires)
+
     @classmethod
     def update_campaign_events(cls, campaign):
         """
         Updates all the scheduled events for each user for the passed in campaign.
         Should be called anytime a campaign changes.
         """
-        for contact in campaign.group.contacts.exclude(is_test=True):
-            cls.update_campaign_events_for_contact(campaign, contact)
+        # remove any unfired events, they will get recreated below
+        EventFire.objects.filter(event__campaign=campaign, fired=None).delete()
+
+        cls.create_event_fires(campaign.get_events().select_related('campaign', 'relative_to'))
 
     @classmethod
     def update_events_for_event(cls, event):
@@ -346,13 +465,7 @@ class EventFire(Model):
 
         # add new ones
         if event.is_active:
-            for contact in event.campaign.group.contacts.exclude(is_test=True):
-                # calculate our scheduled date
-                scheduled = event.calculate_scheduled_fire(contact)
-
-                # and if we have a date, then schedule it
-                if scheduled:
-                    EventFire.objects.create(event=event, contact=contact, scheduled=scheduled)
+            cls.create_event_fires([event])
 
     @classmethod
     def update_field_events(cls, contact_field):
@@ -366,17 +479,10 @@ class EventFire(Model):
             # cancel existing events, we are going to recreate them all
             EventFire.objects.filter(event__relative_to=contact_field, fired=None).delete()
 
-            for event in CampaignEvent.objects.filter(relative_to=contact_field,
-                                                      campaign__is_active=True, campaign__is_archived=False, is_active=True):
-
-                # for each contact
-                for contact in event.campaign.group.contacts.filter(is_active=True):
-                    # calculate our scheduled date
-                    scheduled = event.calculate_scheduled_fire(contact)
+            events = CampaignEvent.objects.filter(relative_to=contact_field, campaign__is_active=True,
+                                                  campaign__is_archived=False, is_active=True)
 
-                    # and if we have a date, then schedule it
-                    if scheduled:
-                        EventFire.objects.create(event=event, contact=contact, scheduled=scheduled)
+            cls.create_event_fires(events.select_related('campaign', 'relative_to'))
 
     @classmethod
     def update_events_for_contact(cls, contact):
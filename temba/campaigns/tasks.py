@@ -1,10 +1,9 @@
 from __future__ import unicode_literals
 
 from datetime import datetime
-from django.utils import timezone
 from djcelery_transactions import task
 from redis_cache import get_redis_connection
-from .models import Campaign, EventFire
+from .models import Campaign, CampaignEvent, EventFire
 from django.conf import settings
 import redis
 
@@ -23,17 +22,19 @@ def check_campaigns_task(sched_id=None):
     # only do this if we aren't already checking campaigns
     if not r.get(key):
         with r.lock(key, timeout=3600):
-            # for each that needs to be fired
-            for fire in EventFire.objects.filter(fired=None, scheduled__lte=timezone.now()):
-                try:
-                    key = 'fire_campaign_%d' % fire.pk
-                    if not r.get(key):
-                        # try to acquire a lock
-                        with r.lock('fire_campaign_%d' % fire.pk, timeout=120):
-                            # reload it
-                            fire = EventFire.objects.get(id=fire.pk)
-                            if not fire.fired:
-                                fire.fire()
+            # events which fail have their fires released, so skip those until our next check
+            failed_events = set()
 
-                except:  # pragma: no cover
-                    logger.error("Error running campaign event: %s" % fire.pk, exc_info=True)
+            # claim the fires which are due in batches, until there are none left
+            while True:
+                event_fires = EventFire.claim_due_fires(exclude_events=failed_events)
+                if not event_fires:
+                    break
+
+                # start each event's flow once for all its contacts
+                for event in CampaignEvent.objects.filter(pk__in=event_fires.keys()).select_related('flow'):
+                    try:
+                        event.fire_batch(event_fires[event.pk])
+                    except:  # pragma: no cover
+                        failed_events.add(event.pk)
+                        logger.error("Error running campaign event: %s" % event.pk, exc_info=True)
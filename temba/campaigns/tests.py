@@ -1,7 +1,10 @@
 from __future__ import unicode_literals
 
+from datetime import timedelta
 from django.contrib.auth.models import Group
 from django.core.urlresolvers import reverse
+from django.utils import timezone
+from mock import patch
 from temba.contacts.models import ContactField
 from temba.flows.models import FlowRun, Flow, RuleSet, ActionSet
 from temba.tests import TembaTest
@@ -370,3 +373,99 @@ class ScheduleTest(TembaTest):
         # should have one flow run now
         run = FlowRun.objects.get()
         self.assertEquals(event.contact, run.contact)
+
+    def test_group_scheduling(self):
+        campaign = Campaign.objects.create(name="Planting Reminders", group=self.farmers, org=self.org,
+                                           created_by=self.admin, modified_by=self.admin)
+
+        planting_reminder = CampaignEvent.objects.create(campaign=campaign, relative_to=self.planting_date, offset=0,
+                                                         flow=self.reminder_flow, delivery_hour=17,
+                                                         created_by=self.admin, modified_by=self.admin)
+        planting_reminder2 = CampaignEvent.objects.create(campaign=campaign, relative_to=self.planting_date, offset=1,
+                                                          flow=self.reminder2_flow,
+                                                          created_by=self.admin, modified_by=self.admin)
+
+        # add a test contact to our group, and give everybody the same planting date, except one in the past
+        test_contact = self.create_contact("Test Contact", "+250788444444")
+        test_contact.is_test = True
+        test_contact.save()
+        self.farmers.update_contacts([test_contact], True)
+
+        for contact in (self.farmer1, test_contact, self.nonfarmer):
+            contact.set_field('planting_date', "05-10-2020 12:30:10")
+        self.farmer2.set_field('planting_date', "05-10-2000 12:30:10")
+
+        EventFire.update_campaign_events(campaign)
+
+        # only our farmer with a future date gets scheduled, once for each event
+        fires = EventFire.objects.all()
+        self.assertEquals(2, fires.count())
+        self.assertEquals([planting_reminder, planting_reminder2], [fire.event for fire in fires])
+        self.assertEquals({self.farmer1}, set(fire.contact for fire in fires))
+        self.assertEquals(17 - 2, fires[0].scheduled.hour)
+        self.assertEquals(6, fires[1].scheduled.day)
+
+        # rescheduling an event doesn't touch the other event's fires
+        self.farmer2.set_field('planting_date', "05-10-2021 12:30:10")
+        EventFire.objects.filter(contact=self.farmer2).delete()
+        EventFire.update_events_for_event(planting_reminder)
+
+        self.assertEquals(2, EventFire.objects.filter(event=planting_reminder).count())
+        self.assertEquals(1, EventFire.objects.filter(event=planting_reminder2).count())
+
+    def test_batch_firing(self):
+        campaign = Campaign.objects.create(name="Planting Reminders", group=self.farmers, org=self.org,
+                                           created_by=self.admin, modified_by=self.admin)
+
+        planting_reminder = CampaignEvent.objects.create(campaign=campaign, relative_to=self.planting_date, offset=0,
+                                                         flow=self.reminder_flow,
+                                                         created_by=self.admin, modified_by=self.admin)
+        planting_reminder2 = CampaignEvent.objects.create(campaign=campaign, relative_to=self.planting_date, offset=1,
+                                                          flow=self.reminder2_flow,
+                                                          created_by=self.admin, modified_by=self.admin)
+
+        now = timezone.now()
+        fire1 = EventFire.objects.create(event=planting_reminder, contact=self.farmer1, scheduled=now - timedelta(hours=1))
+        fire2 = EventFire.objects.create(event=planting_reminder, contact=self.farmer2, scheduled=now - timedelta(hours=1))
+        fire3 = EventFire.objects.create(event=planting_reminder2, contact=self.farmer1, scheduled=now - timedelta(hours=1))
+        future = EventFire.objects.create(event=planting_reminder2, contact=self.farmer2, scheduled=now + timedelta(days=1))
+
+        # claim our due fires, they should come back grouped by event
+        event_fires = EventFire.claim_due_fires()
+        self.assertEquals({fire1.pk, fire2.pk}, set(event_fires[planting_reminder.pk]))
+        self.assertEquals([fire3.pk], event_fires[planting_reminder2.pk])
+
+        # they are now marked as fired, so can't be claimed again
+        self.assertEquals(3, EventFire.objects.exclude(fired=None).count())
+        self.assertIsNone(EventFire.objects.get(pk=future.pk).fired)
+        self.assertFalse(EventFire.claim_due_fires())
+
+        # if starting the flow fails, the fires are released to be claimed again
+        with patch('temba.flows.models.Flow.start', side_effect=ValueError("boom")):
+            self.assertRaises(ValueError, planting_reminder.fire_batch, event_fires[planting_reminder.pk])
+
+        self.assertEquals(2, EventFire.objects.filter(event=planting_reminder, fired=None).count())
+        self.assertFalse(EventFire.claim_due_fires(exclude_events=[planting_reminder.pk]))
+
+        event_fires[planting_reminder.pk] = EventFire.claim_due_fires()[planting_reminder.pk]
+
+        # if it fails part way through, only the fires of contacts who weren't started are released
+        def partial_start(groups, contacts, **kwargs):
+            FlowRun.create(self.reminder_flow, self.farmer1)
+            raise ValueError("boom")
+
+        with patch('temba.flows.models.Flow.start', side_effect=partial_start):
+            self.assertRaises(ValueError, planting_reminder.fire_batch, event_fires[planting_reminder.pk])
+
+        self.assertIsNotNone(EventFire.objects.get(pk=fire1.pk).fired)
+        self.assertIsNone(EventFire.objects.get(pk=fire2.pk).fired)
+
+        event_fires[planting_reminder.pk] = EventFire.claim_due_fires()[planting_reminder.pk]
+        self.assertEquals([fire2.pk], event_fires[planting_reminder.pk])
+
+        # fire each event for all its contacts at once
+        planting_reminder.fire_batch(event_fires[planting_reminder.pk])
+        planting_reminder2.fire_batch(event_fires[planting_reminder2.pk])
+
+        self.assertEquals(2, FlowRun.objects.filter(flow=self.reminder_flow).count())
+        self.assertEquals(1, FlowRun.objects.filter(flow=self.reminder2_flow).count())
@@ -24,7 +24,7 @@ from phonenumbers import NumberParseException
 from redis_cache import get_redis_connection
 from smartmin.models import SmartModel
 from temba.nexmo import NexmoClient
-from temba.orgs.models import Org, OrgLock, APPLICATION_SID, NEXMO_UUID
+from temba.orgs.models import Org, OrgLock, OrgSchema, APPLICATION_SID, NEXMO_UUID
 from temba.temba_email import send_temba_email
 from temba.utils import analytics, random_string, dict_to_struct, dict_to_json
 from twilio.rest import TwilioRestClient
@@ -611,6 +611,13 @@ class Channel(SmartModel):
         self.address = phone
         self.save()
 
+    def save(self, *args, **kwargs):
+        super(Channel, self).save(*args, **kwargs)
+
+        # channels are part of our org's cached schema
+        if self.org_id:
+            OrgSchema.invalidate(self.org_id)
+
     def release(self, trigger_sync=True, notify_mage=True):
 
         org = self.org
@@ -652,6 +659,10 @@ class Channel(SmartModel):
         self.is_active = False
         self.save()
 
+        # we're no longer part of our old org's schema
+        if org:
+            OrgSchema.invalidate(org.pk)
+
         # mark any messages in sending mode as failed for this channel
         from temba.msgs.models import Msg
         Msg.objects.filter(channel=self, status__in=['Q', 'P', 'E']).update(status='F')
@@ -1481,6 +1492,10 @@ class SyncEvent(SmartModel):
         if channel.country != country or channel.device != device or channel.os != os:
             Channel.objects.filter(pk=channel.pk).update(country=country, device=device, os=os)
 
+            # updates don't go through save, so invalidate our org's cached schema ourselves
+            if channel.org_id:
+                OrgSchema.invalidate(channel.org_id)
+
         args = dict()
 
         args['power_source'] = cmd.get('p_src', cmd.get('power_source'))
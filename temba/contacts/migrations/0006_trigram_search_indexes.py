@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# trigram indexes allow substring searches, i.e. icontains lookups and LIKE '%term%', to use an index. They are on
+# the same UPPER(col::text) expression that Django generates for icontains lookups.
+INDEX_SQL = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX contacts_contact_name_trgm ON contacts_contact USING gin (UPPER(name::text) gin_trgm_ops);
+CREATE INDEX contacts_contacturn_path_trgm ON contacts_contacturn USING gin (UPPER(path::text) gin_trgm_ops);
+CREATE INDEX contacts_contactgroup_name_trgm ON contacts_contactgroup USING gin (UPPER(name::text) gin_trgm_ops);
+"""
+
+DROP_INDEX_SQL = """
+DROP INDEX IF EXISTS contacts_contact_name_trgm;
+DROP INDEX IF EXISTS contacts_contacturn_path_trgm;
+DROP INDEX IF EXISTS contacts_contactgroup_name_trgm;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0005_auto_20141210_0208'),
+    ]
+
+    operations = [
+        migrations.RunSQL(INDEX_SQL, DROP_INDEX_SQL)
+    ]
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0006_trigram_search_indexes'),
+    ]
+
+    operations = [
+        # complex searches use the @> and ? operators on the fields hstore which are supported by a GIN index
+        migrations.RunSQL("CREATE INDEX contacts_contact_fields_gin ON contacts_contact USING gin (fields);",
+                          "DROP INDEX IF EXISTS contacts_contact_fields_gin;"),
+    ]
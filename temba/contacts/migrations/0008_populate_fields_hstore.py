@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# how many contact ids we populate with each update
+POPULATE_BATCH_SIZE = 10000
+
+# copies the values of contact fields into the fields hstore of their contacts, in the same form as
+# Contact.get_field_hstore, i.e. the lowercase text under the field key and the decimal, datetime (as a millisecond
+# timestamp) and lowercase location name under typed keys
+POPULATE_SQL = """
+WITH field_values AS (
+  SELECT v.contact_id, f.key, v.string_value, v.decimal_value, v.datetime_value, l.name AS location_name
+  FROM values_value v
+  INNER JOIN contacts_contactfield f ON f.id = v.contact_field_id
+  LEFT OUTER JOIN locations_adminboundary l ON l.id = v.location_value_id
+  WHERE v.contact_id >= %s AND v.contact_id < %s
+), entries AS (
+  SELECT contact_id, key AS entry_key, LOWER(string_value) AS entry_value FROM field_values
+  UNION ALL
+  SELECT contact_id, key || ':n', decimal_value::text FROM field_values WHERE decimal_value IS NOT NULL
+  UNION ALL
+  SELECT contact_id, key || ':d', (EXTRACT(EPOCH FROM DATE_TRUNC('second', datetime_value))::bigint * 1000 +
+                                   EXTRACT(MICROSECONDS FROM datetime_value)::bigint %% 1000000 / 1000)::text
+  FROM field_values WHERE datetime_value IS NOT NULL
+  UNION ALL
+  SELECT contact_id, key || ':l', LOWER(location_name) FROM field_values WHERE location_name IS NOT NULL
+)
+UPDATE contacts_contact c SET fields = COALESCE(c.fields, ''::hstore) || e.fields
+FROM (SELECT contact_id, hstore(array_agg(entry_key), array_agg(entry_value)) AS fields
+      FROM entries GROUP BY contact_id) e
+WHERE c.id = e.contact_id
+"""
+
+
+def populate_fields_hstore(apps, schema_editor):
+    cursor = schema_editor.connection.cursor()
+    cursor.execute("SELECT MIN(contact_id), MAX(contact_id) FROM values_value WHERE contact_field_id IS NOT NULL")
+    min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        return
+
+    # each update is set-based over a range of contact ids, so no values or contacts are loaded into memory
+    for start in range(min_id, max_id + 1, POPULATE_BATCH_SIZE):
+        cursor.execute(POPULATE_SQL, [start, start + POPULATE_BATCH_SIZE])
+        print "Populated fields for contacts up to id %d of %d.." % (min(start + POPULATE_BATCH_SIZE - 1, max_id), max_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0007_contact_fields_gin_index'),
+        ('locations', '0002_auto_20141126_2054'),
+        ('values', '0002_auto_20141202_0138'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_fields_hstore)
+    ]
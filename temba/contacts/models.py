@@ -1,27 +1,34 @@
 from __future__ import unicode_literals
 
+import csv
 import datetime
 import json
 import os
 import phonenumbers
+import pytz
 import re
+import threading
 
+from collections import defaultdict
 from django.conf import settings
 from django.core.files import File
 from django.core.files.storage import default_storage
 from django.core.files.temp import NamedTemporaryFile
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Count, Min, Max
+from django.utils import timezone
 from django.utils.translation import ugettext
 from django.utils.translation import ugettext_lazy as _
 from django_hstore import hstore
 from django_hstore.fields import DictionaryField
+from redis_cache import get_redis_connection
 from smartmin.models import SmartModel
 from smartmin.csv_imports.models import ImportTask
-from temba.orgs.models import Org, OrgAssetMixin, OrgEvent, OrgLock, ORG_DISPLAY_CACHE_TTL
+from temba.orgs.models import Org, OrgAssetMixin, OrgEvent, OrgFolder, OrgLock, OrgSchema, ORG_DISPLAY_CACHE_TTL
 from temba.channels.models import Channel
 from temba.temba_email import send_temba_email
-from temba.utils import analytics, format_decimal, truncate
-from temba.utils.cache import get_cacheable_result, incrby_existing
+from temba.utils import analytics, datetime_to_ms, format_decimal, truncate
+from temba.utils.cache import get_cacheable_result, incrby_existing, LRUCache
 from temba.utils.models import TembaModel
 from temba.values.models import Value, VALUE_TYPE_CHOICES, TEXT, DECIMAL, DATETIME, DISTRICT
 from urlparse import urlparse, urlunparse, ParseResult
@@ -32,6 +39,31 @@ RESERVED_CONTACT_FIELDS = ['name', 'phone', 'created_by', 'modified_by', 'org']
 
 # cache keys and TTLs
 GROUP_MEMBER_COUNT_CACHE_KEY = 'org:%d:cache:group_member_count:%d'
+URN_CONTACT_CACHE_KEY = 'org:%d:cache:urn_contact:%s'
+URN_CONTACT_CACHE_TTL = 24 * 60 * 60  # 1 day
+
+# how many rows we import at once
+CONTACT_IMPORT_CHUNK_SIZE = 1000
+
+# how many contacts we deactivate at once, and hold the org contacts lock for, when releasing contacts in bulk
+CONTACT_RELEASE_CHUNK_SIZE = 500
+
+# the range of contact ids covered by each statement when rebuilding dynamic group membership
+GROUP_REBUILD_CHUNK_SIZE = 10000
+
+# keys in the contact fields hstore which hold the typed values of a contact field, the field key itself holds the text
+FIELD_HSTORE_DECIMAL_KEY = '%s:n'
+FIELD_HSTORE_DATETIME_KEY = '%s:d'
+FIELD_HSTORE_LOCATION_KEY = '%s:l'
+
+# how many contacts we load at once when exporting
+EXPORT_PAGE_SIZE = 1000
+
+# xlwt holds the whole workbook in memory until it's saved, so larger exports are written to CSV row by row instead
+EXPORT_XLS_MAX_CONTACTS = 65535 * 4
+
+# how many distinct numbers we keep the normalization and validation results of in each process
+NUMBER_CACHE_SIZE = 100000
 
 
 class ContactField(models.Model, OrgAssetMixin):
@@ -129,6 +161,12 @@ class ContactField(models.Model, OrgAssetMixin):
 
             return field
 
+    def save(self, *args, **kwargs):
+        super(ContactField, self).save(*args, **kwargs)
+
+        # fields are part of our org's cached schema
+        OrgSchema.invalidate(self.org_id)
+
     def __unicode__(self):
         return "%s" % self.label
 
@@ -214,10 +252,32 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
         if hasattr(self, cache_attr):
             return getattr(self, cache_attr)
 
-        value = Value.objects.filter(contact=self, contact_field__key__exact=key).first()
+        # look up the field in our org's schema so we don't need to join or fetch it
+        field = OrgSchema.get(self.org_id).get_field(key)
+        value = Value.objects.filter(contact=self, contact_field=field).first() if field else None
+        if value:
+            value.contact_field = field
+
         setattr(self, cache_attr, value)
         return value
 
+    def cache_fields(self, keys):
+        """
+        Fetches and caches the values of the given contact fields which aren't already cached, in a single query
+        """
+        keys = [key.lower() for key in keys if not hasattr(self, '__field__%s' % key.lower())]
+        if not keys:
+            return
+
+        values = Value.objects.filter(contact=self, contact_field__key__in=keys)
+        for value in values.select_related('contact_field', 'location_value'):
+            setattr(self, '__field__%s' % value.contact_field.key, value)
+
+        # set missing fields as None attributes to avoid cache fetches later
+        for key in keys:
+            if not hasattr(self, '__field__%s' % key):
+                setattr(self, '__field__%s' % key, None)
+
     def get_field_raw(self, key):
         """
         Gets the string value (i.e. raw user input) of a contact field
@@ -245,57 +305,172 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
             return None
 
     def set_field(self, key, value, label=None):
-        from temba.values.models import Value
+        self.set_fields({key: value}, labels={key: label} if label else None)
 
-        # make sure this field exists
-        field = ContactField.get_or_create(self.org, key, label)
+    def set_fields(self, fields, labels=None):
+        """
+        Sets multiple contact fields at once from a dict of field key to value, a value of None or '' removes that
+        field. Labels can optionally be given by key for fields which may need creating.
+        """
+        Contact.bulk_set_fields(self.org, [(self, fields)], labels=labels)
 
-        existing = None
-        if value is None or value == '':
-            Value.objects.filter(contact=self, contact_field__pk=field.id).delete()
-        else:
-            # parse as all value data types
-            str_value = unicode(value)
-            dt_value = self.org.parse_date(value)
-            dec_value = self.org.parse_decimal(value)
-            loc_value = self.org.parse_location(value, 2 if field.value_type == DISTRICT else 1)
+    @classmethod
+    def bulk_set_fields(cls, org, contact_fields, labels=None):
+        """
+        Sets fields on many contacts at once from a list of (contact, dict of field key to value) tuples. All values
+        are parsed up front, existing values are updated in place and only missing ones inserted, all in a single
+        transaction, and the side effects for each contact are only handled once.
+        """
+        keys = set()
+        for contact, values in contact_fields:
+            keys.update(values.keys())
 
-            # find the existing value
-            existing = Value.objects.filter(contact=self, contact_field__pk=field.id).first()
+        if not keys:
+            return
 
-            # update it if it exists
-            if existing:
-                existing.string_value = str_value
-                existing.decimal_value = dec_value
-                existing.datetime_value = dt_value
-                existing.location_value = loc_value
+        # make sure all our fields exist, only going through get_or_create for new fields or those given labels
+        schema = org.get_schema()
+        fields = dict((field.key, field) for field in schema.active_fields if field.key in keys)
+        for key in keys:
+            label = labels.get(key, None) if labels else None
+            if key not in fields or label:
+                fields[key] = ContactField.get_or_create(org, key, label)
+
+        # we only need to parse each distinct value once
+        parsed = dict()
 
-                if loc_value:
-                    existing.category = loc_value.name
+        def parse_value(field, value):
+            # date values need converted to localized strings
+            if isinstance(value, datetime.date):
+                value = org.format_date(value, True)
+
+            parse_key = (field.value_type, value)
+            if parse_key not in parsed:
+                loc_value = org.parse_location(value, 2 if field.value_type == DISTRICT else 1)
+                parsed[parse_key] = dict(string_value=unicode(value), datetime_value=org.parse_date(value),
+                                         decimal_value=org.parse_decimal(value), location_value=loc_value,
+                                         category=loc_value.name if loc_value else None)
+            return parse_key
+
+        # build all our new values, later values for the same contact and field win
+        new_values = dict()
+        parse_keys = dict()
+        for contact, values in contact_fields:
+            for key, value in values.items():
+                if value is None or value == '':
+                    new_values[(contact.pk, key)] = None
+                else:
+                    parse_key = parse_value(fields[key], value)
+                    parse_keys[(contact.pk, key)] = parse_key
+                    new_values[(contact.pk, key)] = Value(contact=contact, contact_field=fields[key], org=org,
+                                                          **parsed[parse_key])
+
+        with transaction.atomic():
+            # find the values which already exist for these contacts and fields
+            existing_values = Value.objects.filter(contact__in=set(contact.pk for contact, values in contact_fields),
+                                                   contact_field__in=[field.pk for field in fields.values()])
+            existing = defaultdict(list)
+            for value_id, contact_id, field_id in existing_values.values_list('pk', 'contact', 'contact_field'):
+                existing[(contact_id, field_id)].append(value_id)
+
+            # existing values are updated in place, grouped by their new value, the rest are created or removed
+            to_update = defaultdict(list)
+            to_create = []
+            to_delete = []
+            for (contact_id, key), value in new_values.items():
+                value_ids = existing.get((contact_id, fields[key].pk), [])
+                if value and value_ids:
+                    value.pk = value_ids[0]
+                    to_update[parse_keys[(contact_id, key)]].append(value.pk)
+                    to_delete += value_ids[1:]
+                elif value:
+                    to_create.append(value)
                 else:
-                    existing.category = None
+                    to_delete += value_ids
 
-                existing.save(update_fields=['string_value', 'decimal_value', 'datetime_value',
-                                             'location_value', 'category'])
+            now = timezone.now()
+            for parse_key, value_ids in to_update.items():
+                Value.objects.filter(pk__in=value_ids).update(modified_on=now, **parsed[parse_key])
 
-            # otherwise, create a new value for it
-            else:
-                category = loc_value.name if loc_value else None
-                existing = Value.objects.create(contact=self, contact_field=field, org=self.org,
-                                                string_value=str_value, decimal_value=dec_value, datetime_value=dt_value,
-                                                location_value=loc_value, category=category)
+            if to_delete:
+                Value.objects.filter(pk__in=to_delete).delete()
+
+            Value.objects.bulk_create(to_create)
 
-        # cache
-        setattr(self, '__field__%s' % key, existing)
+            # mirror the new values in each contact's fields hstore, which is what complex searches query
+            hstore_updates = defaultdict(lambda: (set(), dict()))
+            for (contact_id, key), value in new_values.items():
+                removed, added = hstore_updates[contact_id]
+                removed.update(Contact.get_field_hstore_keys(key))
+                added.update(Contact.get_field_hstore(key, value))
 
-        # persist to db
-        self.save(update_fields=['fields'])
+            Contact.update_fields_hstore(hstore_updates)
 
-        # update any groups or campaigns for this contact
-        self.handle_update(field=field)
+        for contact, values in contact_fields:
+            removed, added = hstore_updates[contact.pk]
+            contact.fields = {k: v for k, v in (contact.fields or {}).items() if k not in removed}
+            contact.fields.update(added)
 
-        # invalidate our value cache for this contact field
-        Value.invalidate_cache(contact_field=field)
+        # groups and campaign events are updated once per contact
+        with Contact.batch_updates():
+            for contact, values in contact_fields:
+                for key in values.keys():
+                    # cache
+                    setattr(contact, '__field__%s' % key, new_values[(contact.pk, key)])
+
+                    # update any groups or campaigns for this contact
+                    contact.handle_update(field=fields[key])
+
+            # invalidate our value cache for these contact fields
+            for field in fields.values():
+                ContactUpdateBatch.invalidate_cache(contact_field=field)
+
+    @classmethod
+    def get_field_hstore_keys(cls, key):
+        """
+        Gets all the keys in the fields hstore which can hold the value of the given contact field
+        """
+        return [key, FIELD_HSTORE_DECIMAL_KEY % key, FIELD_HSTORE_DATETIME_KEY % key, FIELD_HSTORE_LOCATION_KEY % key]
+
+    @classmethod
+    def get_field_hstore(cls, key, value):
+        """
+        Gets the fields hstore entries for the given value of a contact field. The field key holds the lowercase text
+        and the typed keys hold the decimal, datetime (as a millisecond timestamp) and location name, so that searches
+        can always cast them safely.
+        """
+        if not value:
+            return {}
+
+        entries = {key: value.string_value.lower()}
+        if value.decimal_value is not None:
+            entries[FIELD_HSTORE_DECIMAL_KEY % key] = unicode(value.decimal_value)
+        if value.datetime_value is not None:
+            entries[FIELD_HSTORE_DATETIME_KEY % key] = unicode(datetime_to_ms(value.datetime_value))
+        if value.location_value:
+            entries[FIELD_HSTORE_LOCATION_KEY % key] = value.location_value.name.lower()
+
+        return entries
+
+    @classmethod
+    def update_fields_hstore(cls, updates):
+        """
+        Updates the fields hstore of many contacts in a single statement, from a dict of contact id to a tuple of the
+        keys to remove and a dict of entries to add
+        """
+        if not updates:
+            return
+
+        rows = []
+        params = []
+        for contact_id, (removed, added) in updates.items():
+            rows.append('(%s, %s::text[], %s::text[], %s::text[])')
+            params += [contact_id, list(removed), added.keys(), added.values()]
+
+        cursor = connection.cursor()
+        cursor.execute("UPDATE contacts_contact c SET fields = (COALESCE(c.fields, ''::hstore) - u.removed) || "
+                       "hstore(u.keys, u.vals) FROM (VALUES %s) AS u(id, removed, keys, vals) WHERE c.id = u.id"
+                       % ', '.join(rows), params)
 
     def handle_update(self, attrs=(), urns=(), field=None, group=None):
         """
@@ -303,7 +478,14 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
           1. A change to one or more attributes
           2. A change to the specified contact field
           3. A manual change to a group membership
+
+        If we are inside a batch of updates, these are deferred until the end of the batch.
         """
+        batch = ContactUpdateBatch.current()
+        if batch:
+            batch.add_update(self, attrs=attrs, urns=urns, field=field, group=group)
+            return
+
         groups_changed = False
 
         if 'name' in attrs or urns or field:
@@ -354,6 +536,22 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
 
         contact = None
 
+        # for an incoming message from an existing contact, we can usually use our cache of URNs instead of locking
+        # and looking up the URN and contact
+        if incoming_channel and not name and not uuid:
+            scheme, path = urns[0]
+            if scheme and path:
+                norm_scheme, norm_path = ContactURN.normalize_urn(scheme, path, country)
+                cached_urn = ContactURN.get_cached(org, ContactURN.format_urn(norm_scheme, norm_path))
+
+                # only if the URN doesn't need its channel updated
+                if cached_urn and cached_urn.channel_id == incoming_channel.pk:
+                    contact = Contact.objects.filter(pk=cached_urn.contact_id, is_active=True).first()
+                    if contact:
+                        cached_urn.contact = contact
+                        contact.urn_objects = {urns[0]: cached_urn}
+                        return contact
+
         # if we were passed in a UUID, look it up by that
         if uuid:
             contact = Contact.objects.get(org=org, is_active=True, uuid=uuid)
@@ -429,6 +627,10 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
             urn_objects.update(existing_owned_urns)
             contact.urn_objects = urn_objects
 
+            # cache the URN of an incoming message so the next message from it can skip all this
+            if incoming_channel:
+                ContactURN.set_cached(urn_objects[urns[0]], contact)
+
             # record contact creation in analytics
             if getattr(contact, 'is_new', False):
                 params = dict(name=name)
@@ -445,6 +647,14 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
 
         return contact
 
+    @classmethod
+    def batch_updates(cls):
+        """
+        Returns a context manager within which the side effects of contact updates are deferred, to be applied once
+        for all updated contacts when it exits
+        """
+        return ContactUpdateBatch()
+
     @classmethod
     def get_test_contact(cls, user):
         org = user.get_org()
@@ -509,15 +719,9 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
         del field_dict['created_by']
         del field_dict['name']
         del field_dict['modified_by']
-        
-        for key in field_dict.keys():
-            value = field_dict[key]
 
-            # date values need converted to localized strings
-            if isinstance(value, datetime.date):
-                value = org.format_date(value, True)
-
-            contact.set_field(key, value)
+        # remaining values are our fields, dates are converted to localized strings as they are set
+        contact.set_fields(field_dict)
 
         return contact
                 
@@ -601,9 +805,165 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
         return None
     
     @classmethod
-    def import_csv(cls, task, log=None):
-        from xlrd import XLRDError
+    def read_import_rows(cls, filename, tz):
+        """
+        Generator of a dict of header to value for each row in the passed in xls or csv file. csv files are read a
+        line at a time so are never loaded as a whole. Dates in xls files are localized to the passed in timezone.
+        """
+        from xlrd import open_workbook, xldate_as_tuple, XLRDError, XL_CELL_DATE
+
+        try:
+            workbook = open_workbook(filename, on_demand=True)
+        except XLRDError:
+            workbook = None
 
+        def read_cell(cell):
+            if cell.ctype == XL_CELL_DATE:
+                return tz.localize(datetime.datetime(*xldate_as_tuple(cell.value, workbook.datemode)))
+            elif isinstance(cell.value, basestring):
+                return cell.value.strip()
+            return cell.value
+
+        def decode_value(value):
+            try:
+                return value.decode('utf-8').strip()
+            except UnicodeDecodeError:
+                return value.decode('cp1252').strip()
+
+        if workbook:
+            sheet = workbook.sheet_by_index(0)
+            rows = ([read_cell(cell) for cell in sheet.row(index)] for index in range(sheet.nrows))
+        else:
+            rows = ([decode_value(value) for value in line] for line in csv.reader(open(filename, 'rU')))
+
+        header = None
+        for row in rows:
+            if header is None:
+                header = [unicode(value).strip().lower() for value in row]
+                Contact.validate_import_header(header)
+
+            # ignore any blank lines
+            elif any(value != '' for value in row):
+                yield dict(zip(header, row))
+
+    @classmethod
+    def import_chunk(cls, org, user, rows, extra_fields, import_results):
+        """
+        Imports a chunk of rows at once. All the URNs in the chunk are looked up in a single query, and new contacts,
+        URNs and values are created in bulk. Returns the contact for each valid row.
+        """
+        channel = org.get_receive_channel(TEL_SCHEME)
+        country = channel.country.code if channel else None
+
+        # validate and normalize the number for each row
+        def get_phone(row):
+            phone = row.get('phone', None)
+            if isinstance(phone, float):
+                phone = '%d' % phone if phone.is_integer() else unicode(phone)
+            return phone
+
+        phones = [get_phone(row) for row in rows]
+        normalized_phones = ContactURN.normalize_numbers([p for p in phones if p], country)
+
+        row_urns = []
+        for row, phone in zip(rows, phones):
+            (normalized, is_valid) = normalized_phones[phone] if phone else (None, False)
+            if not is_valid:
+                import_results['errors'] += 1
+                continue
+
+            # title case our name
+            name = row.get('name', None)
+            if name:
+                name = " ".join([_.capitalize() for _ in unicode(name).split()])
+
+            row_urns.append((ContactURN.format_urn(TEL_SCHEME, normalized), normalized, name, row))
+
+        # perform everything in a org-level lock to prevent duplication by different instances
+        with org.lock_on(OrgLock.contacts):
+            existing_urns = ContactURN.objects.filter(org=org, urn__in=[_[0] for _ in row_urns])
+            existing_urns = dict((urn.urn, urn) for urn in existing_urns.select_related('contact'))
+
+            contacts = []
+            contacts_by_urn = dict()
+            renamed = dict()
+
+            for urn, path, name, row in row_urns:
+                contact = contacts_by_urn.get(urn, None)
+
+                if not contact:
+                    existing_urn = existing_urns.get(urn, None)
+
+                    if existing_urn and existing_urn.contact:
+                        # anonymous orgs can't update existing contacts
+                        if org.is_anon:
+                            import_results['errors'] += 1
+                            continue
+
+                        contact = existing_urn.contact
+                        import_results['updates'] += 1
+                    else:
+                        contact = Contact(org=org, name=name, created_by=user, modified_by=user)
+                        contact.is_new = True
+                        import_results['creates'] += 1
+
+                    contacts_by_urn[urn] = contact
+                else:
+                    import_results['updates'] += 1
+
+                if name and name != contact.name:
+                    contact.name = name
+                    if contact.pk:
+                        renamed[contact.pk] = contact
+
+                contacts.append((contact, row))
+
+            # create all our new contacts at once, then fetch back their ids
+            new_contacts = [contact for contact in contacts_by_urn.values() if not contact.pk]
+            if new_contacts:
+                Contact.objects.bulk_create(new_contacts)
+                contact_ids = Contact.objects.filter(org=org, uuid__in=[_.uuid for _ in new_contacts])
+                contact_ids = dict(contact_ids.values_list('uuid', 'pk'))
+                for contact in new_contacts:
+                    contact.pk = contact_ids[contact.uuid]
+                    org.update_caches(OrgEvent.contact_new, contact)
+
+            # create or attach any URNs which don't belong to a contact yet
+            new_urns = []
+            for urn, path, name, row in row_urns:
+                contact = contacts_by_urn.get(urn, None)
+                existing_urn = existing_urns.get(urn, None)
+
+                if contact and not existing_urn:
+                    new_urns.append(ContactURN(org=org, contact=contact, scheme=TEL_SCHEME, path=path, urn=urn,
+                                               priority=URN_SCHEME_PRIORITIES[TEL_SCHEME]))
+                    existing_urns[urn] = new_urns[-1]
+
+                elif contact and not existing_urn.contact:
+                    ContactURN.objects.filter(pk=existing_urn.pk).update(contact=contact)
+                    existing_urn.contact = contact
+
+                else:
+                    continue
+
+                # handle group and campaign events for our new contact
+                contact.handle_update(attrs=('name',), urns=[(TEL_SCHEME, path)])
+
+            ContactURN.objects.bulk_create(new_urns)
+
+        for contact in renamed.values():
+            contact.save(update_fields=['name'])
+            contact.handle_update(attrs=('name',))
+
+        # write all our field values
+        contact_fields = [(contact, dict((key, row.get(header, None)) for header, key in extra_fields.items()))
+                          for contact, row in contacts]
+        cls.bulk_set_fields(org, contact_fields)
+
+        return [contact for contact, row in contacts]
+
+    @classmethod
+    def import_csv(cls, task, log=None):
         filename = task.csv_file.file
         user = task.created_by
 
@@ -615,6 +975,17 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
             except:
                 pass
 
+        org = Org.objects.get(pk=import_params['org_id'])
+
+        # create any extra fields up front, mapping their headers to their keys
+        extra_fields = dict()
+        for field in import_params.get('extra_fields', []):
+            if field['key'] in RESERVED_CONTACT_FIELDS:
+                raise Exception('Extra field %s is a reserved field name' % field['key'])
+
+            ContactField.get_or_create(org, field['key'], field['label'], False, field['type'])
+            extra_fields[field['header']] = field['key']
+
         # this file isn't good enough, lets write it to local disk
         from django.conf import settings
         from uuid import uuid4
@@ -633,40 +1004,50 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
         out_file.write(filename.read())
         out_file.close()
 
-        import_results = dict()
-
-        try:
-            contacts = cls.import_xls(open(tmp_file), user, import_params, log, import_results)
-        except XLRDError:
-            contacts = cls.import_raw_csv(open(tmp_file), user, import_params, log, import_results)
-        finally:
-            os.remove(tmp_file)
-
-        # don't create a group if there are no contacts
-        if not contacts:
-            return contacts
+        import_results = dict(records=0, errors=0, creates=0, updates=0)
+        contact_ids = []
+        groups = []
 
         # we always create a group after a successful import (strip off 8 character uniquifier by django)
         group_name = os.path.splitext(os.path.split(import_params.get('original_filename'))[-1])[0]
         group_name = group_name.replace('_', ' ').replace('-', ' ').title()
 
-        # group org is same as org of any contact in that group
-        group_org = contacts[0].org
-        group = ContactGroup.create(group_org, user, group_name, task)
+        def import_rows(rows):
+            # groups and campaign events are updated once per chunk, so we only ever hold one chunk of contacts
+            with Contact.batch_updates():
+                chunk_contacts = cls.import_chunk(org, user, rows, extra_fields, import_results)
 
-        num_creates = 0
-        for contact in contacts:
-            # if contact has is_new attribute, then we have created a new contact rather than updated an existing one
-            if getattr(contact, 'is_new', False):
-                num_creates += 1
+                # don't create a group if there are no contacts
+                if chunk_contacts:
+                    if not groups:
+                        groups.append(ContactGroup.create(org, user, group_name, task))
+                    groups[0].contacts.add(*set(chunk_contacts))
+
+            contact_ids.extend([contact.pk for contact in chunk_contacts])
+
+            # record our progress as we go
+            import_results['records'] = len(contact_ids)
+            task.import_results = json.dumps(import_results)
+            task.save(update_fields=['import_results'])
 
-            group.contacts.add(contact)
+        try:
+            rows = []
+            for row in cls.read_import_rows(tmp_file, pytz.timezone(org.timezone)):
+                rows.append(row)
+
+                if len(rows) >= CONTACT_IMPORT_CHUNK_SIZE:
+                    import_rows(rows)
+                    rows = []
+
+            if rows:
+                import_rows(rows)
+        finally:
+            os.remove(tmp_file)
 
-        import_results['creates'] = num_creates
-        import_results['updates'] = len(contacts) - num_creates
         task.import_results = json.dumps(import_results)
 
-        return contacts
+        # hand back the imported contacts lazily rather than holding every one of them while we import
+        return Contact.objects.filter(pk__in=contact_ids)
 
     @classmethod
     def apply_action_label(cls, contacts, group, add):
@@ -695,12 +1076,7 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
 
     @classmethod
     def apply_action_delete(cls, contacts):
-        changed = []
-
-        for contact in contacts:
-            contact.release()
-            changed.append(contact.pk)
-        return changed
+        return cls.bulk_release(contacts)
 
     def block(self):
         """
@@ -732,23 +1108,101 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
         """
         Releases (i.e. deletes) this contact, provided it is currently not deleted
         """
-        # perform everything in an org level lock to prevent conflicts with get_or_create or update_urns
+        from temba.msgs.models import Msg
+
+        # deactivate in an org level lock to prevent conflicts with get_or_create or update_urns
         with self.org.lock_on(OrgLock.contacts):
-            if self._update_state(dict(is_active=True), dict(is_active=False), OrgEvent.contact_deleted):
-                # detach all contact's URNs
+            released = self._update_state(dict(is_active=True), dict(is_active=False), OrgEvent.contact_deleted)
+
+            # detach all contact's URNs
+            if released:
+                ContactURN.invalidate_cached(self.org_id, self.urns.values_list('urn', flat=True))
                 self.urns.update(contact=None)
 
-                # remove contact from all groups
-                for group in self.groups.all():
-                    group.update_contacts((self,), False)
+        if released:
+            # remove contact from all groups
+            for group in self.groups.all():
+                group.update_contacts((self,), False)
 
-                # delete all messages with this contact
-                for msg in self.msgs.all():
-                    msg.release()
+            # delete all messages with this contact
+            Msg.bulk_release(self.msgs.all())
 
-                # remove all flow runs and steps
-                for run in self.runs.all():
-                    run.release()
+            # remove all flow runs and steps
+            for run in self.runs.all():
+                run.release()
+
+    @classmethod
+    def bulk_release(cls, contacts):
+        """
+        Releases (i.e. deletes) the given contacts. Contacts are deactivated, and their URNs and group memberships
+        removed, in chunks which each only hold the org contacts lock briefly. Their messages, runs, values and event
+        fires are then purged in the background. Returns the ids of the contacts which were released.
+        """
+        from .tasks import purge_contacts_task
+
+        org_contact_ids = defaultdict(list)
+        for contact in contacts:
+            org_contact_ids[contact.org_id].append(contact.pk)
+
+        released = []
+
+        for org in Org.objects.filter(pk__in=org_contact_ids.keys()):
+            contact_ids = org_contact_ids[org.pk]
+            folder_deltas = defaultdict(int)
+
+            for i in range(0, len(contact_ids), CONTACT_RELEASE_CHUNK_SIZE):
+                chunk = contact_ids[i:i + CONTACT_RELEASE_CHUNK_SIZE]
+
+                # deactivate in an org level lock to prevent conflicts with get_or_create or update_urns
+                with org.lock_on(OrgLock.contacts):
+                    active = Contact.objects.filter(pk__in=chunk, is_active=True)
+                    states = list(active.values_list('pk', 'is_archived', 'status'))
+                    chunk = [contact_id for contact_id, is_archived, status in states]
+
+                    Contact.objects.filter(pk__in=chunk).update(is_active=False)
+
+                    urns = ContactURN.objects.filter(contact__in=chunk)
+                    ContactURN.invalidate_cached(org.pk, urns.values_list('urn', flat=True))
+                    urns.update(contact=None)
+
+                for contact_id, is_archived, status in states:
+                    folder_deltas[OrgFolder.contacts_blocked if is_archived else OrgFolder.contacts_all] -= 1
+                    if status == FAILED:
+                        folder_deltas[OrgFolder.contacts_failed] -= 1
+
+                ContactGroup.remove_contacts_from_all(chunk)
+                released += chunk
+
+            org.update_folder_counts(folder_deltas)
+
+        if released:
+            purge_contacts_task.delay(released)
+
+        return released
+
+    @classmethod
+    def purge_released(cls, contact_ids):
+        """
+        Purges the messages, runs, values and event fires of the given released contacts, in chunks of set-based
+        deletes and updates
+        """
+        from temba.campaigns.models import EventFire
+        from temba.flows.models import FlowRun
+        from temba.msgs.models import Msg
+
+        # ignore any contacts which have been re-activated since
+        contact_ids = list(Contact.objects.filter(pk__in=contact_ids, is_active=False).values_list('pk', flat=True))
+        if not contact_ids:
+            return
+
+        Msg.bulk_release(Msg.objects.filter(contact__in=contact_ids))
+        FlowRun.bulk_release(FlowRun.objects.filter(contact__in=contact_ids))
+
+        for i in range(0, len(contact_ids), CONTACT_RELEASE_CHUNK_SIZE):
+            chunk = contact_ids[i:i + CONTACT_RELEASE_CHUNK_SIZE]
+
+            Value.objects.filter(contact__in=chunk).delete()
+            EventFire.objects.filter(contact__in=chunk).delete()
 
     @classmethod
     def bulk_cache_initialize(cls, org, contacts, for_show_only=False):
@@ -762,12 +1216,12 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
             return
 
         # get our contact fields
-        fields = ContactField.objects.filter(org=org)
+        fields = org.get_schema().fields
         if for_show_only:
-            fields = fields.filter(show_in_table=True)
+            fields = [f for f in fields if f.show_in_table]
 
         # build id maps to avoid re-fetching contact objects
-        key_map = {f.id: f.key for f in fields}
+        field_map = {f.id: f for f in fields}
 
         contact_map = dict()
         for contact in contacts:
@@ -775,12 +1229,11 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
             setattr(contact, '__urns', list())  # initialize URN list cache (setattr avoids name mangling or __urns)
 
         # cache all field values
-        values = Value.objects.filter(contact__in=contact_map.keys(),
-                                      contact_field__in=fields).order_by('contact').select_related('contact_field')
+        values = Value.objects.filter(contact__in=contact_map.keys(), contact_field__in=field_map.keys()).order_by('contact')
         for value in values:
             contact = contact_map[value.contact_id]
-            field_key = key_map[value.contact_field_id]
-            cache_attr = '__field__%s' % field_key
+            value.contact_field = field_map[value.contact_field_id]
+            cache_attr = '__field__%s' % value.contact_field.key
             setattr(contact, cache_attr, value)
 
         # set missing fields as None attributes to avoid cache fetches later
@@ -815,7 +1268,7 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
             contact_dict[scheme] = urn_value if not urn_value is None else ''
 
         # add all fields
-        for field in ContactField.objects.filter(org_id=self.org_id):
+        for field in OrgSchema.get(self.org_id).fields:
             field_value = self.get_field_display(field.key)
             contact_dict[field.key] = field_value if not field_value is None else ''
 
@@ -903,6 +1356,7 @@ class Contact(TembaModel, SmartModel, OrgAssetMixin):
         # detach any existing URNs that weren't included
         urn_ids = [urn.pk for urn in (urns_created + urns_attached + urns_retained)]
         urns_detached_qs = ContactURN.objects.filter(contact=self).exclude(pk__in=urn_ids)
+        ContactURN.invalidate_cached(self.org_id, urns_detached_qs.values_list('urn', flat=True))
         urns_detached_qs.update(contact=None)
         urns_detached = list(urns_detached_qs)
 
@@ -1027,6 +1481,10 @@ class ContactURN(models.Model):
     channel = models.ForeignKey(Channel, null=True, blank=True,
                                 help_text="The preferred channel for this URN")
 
+    # in-process caches of normalization and validation results by number and country
+    _normalized_numbers = LRUCache(NUMBER_CACHE_SIZE)
+    _validated_numbers = LRUCache(NUMBER_CACHE_SIZE)
+
     @classmethod
     def create(cls, org, contact, scheme, path, channel=None):
         urn = cls.format_urn(scheme, path)
@@ -1035,6 +1493,46 @@ class ContactURN(models.Model):
         return cls.objects.create(org=org, contact=contact, priority=priority, channel=channel,
                                   scheme=scheme, path=path, urn=urn)
 
+    @classmethod
+    def get_cached(cls, org, urn):
+        """
+        Gets the given URN from our cache of URNs which belong to contacts, without hitting the database. Returns None if
+        it isn't cached.
+        """
+        r = get_redis_connection()
+        cached = r.get(URN_CONTACT_CACHE_KEY % (org.pk, urn))
+        if cached is None:
+            return None
+
+        cached = json.loads(cached)
+        return ContactURN(pk=cached['id'], org=org, contact_id=cached['contact'], channel_id=cached['channel'],
+                          priority=cached['priority'], scheme=cached['scheme'], path=cached['path'], urn=urn)
+
+    @classmethod
+    def set_cached(cls, urn, contact):
+        """
+        Caches the given URN as belonging to the given contact
+        """
+        r = get_redis_connection()
+        cached = dict(id=urn.pk, contact=contact.pk, channel=urn.channel_id, priority=urn.priority,
+                      scheme=urn.scheme, path=urn.path)
+        r.set(URN_CONTACT_CACHE_KEY % (urn.org_id, urn.urn), json.dumps(cached), URN_CONTACT_CACHE_TTL)
+
+    @classmethod
+    def invalidate_cached(cls, org_id, urns):
+        """
+        Removes the given URNs from our cache, e.g. because they've been detached from their contact
+        """
+        if urns:
+            r = get_redis_connection()
+            r.delete(*[URN_CONTACT_CACHE_KEY % (org_id, urn) for urn in urns])
+
+    def save(self, *args, **kwargs):
+        super(ContactURN, self).save(*args, **kwargs)
+
+        # our contact or channel may have changed
+        ContactURN.invalidate_cached(self.org_id, [self.urn])
+
     @classmethod
     def get_or_create(cls, org, scheme, path, channel=None):
         urn = cls.format_urn(scheme, path)
@@ -1081,11 +1579,9 @@ class ContactURN(models.Model):
 
         if scheme == TEL_SCHEME:
             if country_code:
-                try:
-                    normalized = phonenumbers.parse(path, country_code)
-                    return phonenumbers.is_possible_number(normalized)
-                except Exception:
-                    return False
+                country_code = str(country_code)
+                return cls._validated_numbers.get_or_set((path, country_code),
+                                                         lambda: cls._is_possible_number(path, country_code))
 
             return True  # if we don't have a channel with country, we can't for now validate tel numbers
         elif scheme == TWITTER_SCHEME:
@@ -1109,6 +1605,13 @@ class ContactURN(models.Model):
 
         return norm_scheme, norm_path
 
+    @classmethod
+    def _is_possible_number(cls, number, country_code):
+        try:
+            return phonenumbers.is_possible_number(phonenumbers.parse(number, country_code))
+        except Exception:
+            return False
+
     @classmethod
     def normalize_number(cls, number, country_code):
         """
@@ -1116,8 +1619,22 @@ class ContactURN(models.Model):
         maybe crazy users put in dashes or parentheses in the console.
 
         Returns a tuple of the normalizes number and whether it looks like a possible full international
-        number.
+        number. Results are cached as the same numbers are normalized over and over.
+        """
+        country_code = str(country_code) if country_code else None
+        return cls._normalized_numbers.get_or_set((number, country_code),
+                                                  lambda: cls._normalize_number(number, country_code))
+
+    @classmethod
+    def normalize_numbers(cls, numbers, country_code):
+        """
+        Normalizes many numbers at once, e.g. for an import. Returns a dict of each distinct number to a tuple of the
+        normalized number and whether it looks like a possible full international number.
         """
+        return {number: cls.normalize_number(number, country_code) for number in set(numbers)}
+
+    @classmethod
+    def _normalize_number(cls, number, country_code):
         # if the number ends with e11, then that is Excel corrupting it, remove it
         if number.lower().endswith("e+11") or number.lower().endswith("e+12"):
             number = number[0:-4].replace('.', '')
@@ -1131,7 +1648,7 @@ class ContactURN(models.Model):
 
         normalized = None
         try:
-            normalized = phonenumbers.parse(number, str(country_code) if country_code else None)
+            normalized = phonenumbers.parse(number, country_code)
         except Exception:
             pass
 
@@ -1158,6 +1675,8 @@ class ContactURN(models.Model):
             # don't trounce existing contacts with that country code already
             norm_urn = ContactURN.format_urn(TEL_SCHEME, norm_number)
             if not ContactURN.objects.filter(urn=norm_urn, org_id=self.org_id).exclude(id=self.id):
+                ContactURN.invalidate_cached(self.org_id, [self.urn])
+
                 self.urn = norm_urn
                 self.path = norm_number
                 self.save()
@@ -1240,28 +1759,28 @@ class ContactGroup(TembaModel, SmartModel):
         """
         Adds or removes contacts from this group. Returns array of contact ids of contacts whose membership changed
         """
-        changed = set()
-        group_contacts = self.contacts.all()
+        contacts = {contact.pk: contact for contact in contacts}
+        if not contacts:
+            return set()
 
-        for contact in contacts:
-            contact_changed = False
+        # find which of these contacts are already in this group with a single query
+        through = ContactGroup.contacts.through
+        existing = set(through.objects.filter(contactgroup=self, contact__in=contacts.keys())
+                                      .values_list('contact_id', flat=True))
 
-            # if we are adding the contact to the group, and this contact is not in this group
-            if add:
-                if not group_contacts.filter(id=contact.id):
-                    self.contacts.add(contact)
-                    contact_changed = True
-            else:
-                if group_contacts.filter(id=contact.id):
-                    self.contacts.remove(contact)
-                    contact_changed = True
+        if add:
+            changed = set(contacts.keys()) - existing
+            through.objects.bulk_create([through(contactgroup=self, contact_id=contact_id) for contact_id in changed])
+        else:
+            changed = existing
+            through.objects.filter(contactgroup=self, contact__in=changed).delete()
 
-            if contact_changed:
-                changed.add(contact.pk)
-                contact.handle_update(group=self)
+        with Contact.batch_updates():
+            for contact_id in changed:
+                contacts[contact_id].handle_update(group=self)
 
         # invalidate our result cache for anybody depending on this group
-        Value.invalidate_cache(group=self)
+        ContactUpdateBatch.invalidate_cache(group=self)
 
         # if there is a cached members count, update it
         count_delta = len(changed) if add else -len(changed)
@@ -1269,6 +1788,25 @@ class ContactGroup(TembaModel, SmartModel):
                     
         return changed
 
+    @classmethod
+    def remove_contacts_from_all(cls, contact_ids):
+        """
+        Removes the given contacts from all of their groups with a single delete, adjusting member counts by the real
+        delta of each group
+        """
+        through = ContactGroup.contacts.through
+        memberships = through.objects.filter(contact__in=contact_ids)
+
+        counted = memberships.filter(contact__is_test=False).order_by().values('contactgroup')
+        count_deltas = {c['contactgroup']: c['count'] for c in counted.annotate(count=Count('pk'))}
+        groups = list(ContactGroup.objects.filter(pk__in=memberships.values('contactgroup')))
+
+        memberships.delete()
+
+        for group in groups:
+            ContactUpdateBatch.invalidate_cache(group=group)
+            incrby_existing(group.get_member_count_cache_key(), -count_deltas.get(group.pk, 0))
+
     def update_query(self, query):
         """
         Updates the query for a dynamic contact group. For now this is only called when group is created and we don't
@@ -1284,28 +1822,81 @@ class ContactGroup(TembaModel, SmartModel):
             if field:
                 self.query_fields.add(field)
 
+        return self.rebuild_members()
+
+    def rebuild_members(self):
+        """
+        Rebuilds the membership of a dynamic group from its query. Rather than fetching all matching contacts, the
+        differences between the current members and the query results are applied with INSERT ... SELECT and DELETE
+        statements, each covering a range of contact ids. Returns a tuple of the added and removed counts.
+        """
         qs, complex_query = Contact.search(self.org, self.query)
-        members = list(qs)
-        self.contacts.clear()
-        self.contacts.add(*members)
+
+        table = ContactGroup.contacts.through._meta.db_table
+        id_range = Contact.objects.filter(org=self.org).aggregate(min_id=Min('id'), max_id=Max('id'))
+        chunk_start = id_range['min_id']
+
+        added = 0
+        removed = 0
+
+        cursor = connection.cursor()
+        while chunk_start is not None and chunk_start <= id_range['max_id']:
+            chunk_end = chunk_start + GROUP_REBUILD_CHUNK_SIZE
+            chunk_qs = qs.filter(pk__gte=chunk_start, pk__lt=chunk_end).order_by().values_list('pk', flat=True)
+            chunk_sql, chunk_params = chunk_qs.query.sql_with_params()
+
+            # add matching contacts which aren't yet members
+            cursor.execute('INSERT INTO %s (contactgroup_id, contact_id) '
+                           'SELECT %%s, m.id FROM (%s) m '
+                           'WHERE NOT EXISTS (SELECT 1 FROM %s WHERE contactgroup_id = %%s AND contact_id = m.id)'
+                           % (table, chunk_sql, table), [self.pk] + list(chunk_params) + [self.pk])
+            added += cursor.rowcount
+
+            # remove members which no longer match
+            cursor.execute('DELETE FROM %s WHERE contactgroup_id = %%s AND contact_id >= %%s AND contact_id < %%s '
+                           'AND contact_id NOT IN (%s)' % (table, chunk_sql),
+                           [self.pk, chunk_start, chunk_end] + list(chunk_params))
+            removed += cursor.rowcount
+
+            chunk_start = chunk_end
+
+        if added or removed:
+            ContactUpdateBatch.invalidate_cache(group=self)
+
+            # removed members may have been inactive or test contacts which weren't counted, so recount exactly
+            r = get_redis_connection()
+            r.set(self.get_member_count_cache_key(), self._calculate_member_count(), ORG_DISPLAY_CACHE_TTL)
+
+        return added, removed
 
     @classmethod
     def update_groups_for_contact(cls, contact, field=None):
         """
         Updates all dynamic groups effected by a change to a contact. Returns whether any group membership changes.
         """
+        from temba.contacts import search
+
         qs_args = dict(org=contact.org, is_active=True)
         if field:
             qs_args['query_fields__pk'] = field.id
 
+        groups = list(ContactGroup.objects.filter(**qs_args).exclude(query=None))
+        if not groups:
+            return False
+
+        # evaluate each group query in memory against the contact, rather than re-running it against the database
+        fields = contact.org.get_schema().fields_by_key
+        member_of = set(contact.groups.filter(pk__in=[g.pk for g in groups]).values_list('pk', flat=True))
+
         group_change = False
 
-        for group in ContactGroup.objects.filter(**qs_args).exclude(query=None).select_related("contacts"):
-            qs, is_complex = Contact.search(group.org, group.query)  # re-run group query
-            qualifies = qs.filter(pk=contact.id).count() == 1        # should contact now be in group?
-            changed = group.update_contacts([contact], qualifies)
+        for group in groups:
+            predicate, is_complex = search.contact_predicate(contact.org, group.query, fields)
+            qualifies = predicate.matches(contact)  # should contact now be in group?
 
-            if changed:
+            # only write to the group if membership has actually changed
+            if qualifies != (group.pk in member_of):
+                group.update_contacts([contact], qualifies)
                 group_change = True
 
         return group_change
@@ -1345,6 +1936,152 @@ class ContactGroup(TembaModel, SmartModel):
         return self.name
 
 
+class ContactUpdateBatch(object):
+    """
+    Collects the side effects of contact updates, i.e. dynamic group membership, campaign event scheduling and
+    value cache invalidation, so they can be applied once for all contacts at the end of a block:
+
+        with Contact.batch_updates():
+            for contact in contacts:
+                contact.set_field('district', "Gasabo")
+
+    Batches can be nested, in which case only the outermost batch applies the collected updates.
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self.contacts = dict()                  # contacts with pending updates by id
+        self.attr_updates = set()               # ids of contacts whose name or URNs changed
+        self.field_updates = defaultdict(dict)  # contact id to the fields changed for that contact
+        self.group_updates = set()              # ids of contacts whose group membership changed
+        self.invalid_fields = dict()
+        self.invalid_groups = dict()
+        self.is_outermost = False
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'batch', None)
+
+    @classmethod
+    def invalidate_cache(cls, contact_field=None, group=None):
+        """
+        Invalidates the value cache for the passed in field or group, deferring that if we are inside a batch
+        """
+        batch = cls.current()
+        if not batch:
+            Value.invalidate_cache(contact_field=contact_field, group=group)
+        elif contact_field:
+            batch.invalid_fields[contact_field.pk] = contact_field
+        elif group:
+            batch.invalid_groups[group.pk] = group
+
+    def add_update(self, contact, attrs=(), urns=(), field=None, group=None):
+        self.contacts[contact.pk] = contact
+
+        if 'name' in attrs or urns:
+            self.attr_updates.add(contact.pk)
+        if field:
+            self.field_updates[contact.pk][field.pk] = field
+        if group:
+            self.group_updates.add(contact.pk)
+
+    def __enter__(self):
+        if not self.current():
+            ContactUpdateBatch._local.batch = self
+            self.is_outermost = True
+
+        return self.current()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.is_outermost:
+            try:
+                self.apply()
+            finally:
+                ContactUpdateBatch._local.batch = None
+
+    def apply(self):
+        # dynamic group changes count as group changes, so these need to be applied first
+        self.update_dynamic_groups()
+        self.update_campaign_events()
+
+        for field in self.invalid_fields.values():
+            Value.invalidate_cache(contact_field=field)
+
+        for group in self.invalid_groups.values():
+            Value.invalidate_cache(group=group)
+
+    def update_dynamic_groups(self):
+        """
+        Evaluates the query of each dynamic group affected by our updates in memory against its affected contacts
+        """
+        contact_ids = self.attr_updates.union(self.field_updates.keys())
+        if not contact_ids:
+            return
+
+        from temba.contacts import search
+
+        contacts = [self.contacts[contact_id] for contact_id in contact_ids]
+        org_ids = set(contact.org_id for contact in contacts)
+
+        groups = ContactGroup.objects.filter(org__in=org_ids, is_active=True).exclude(query=None)
+        groups = list(groups.select_related('org').prefetch_related('query_fields'))
+        if not groups:
+            return
+
+        # load the current fields and URNs of all our contacts at once, so each group query can be evaluated in memory
+        org_contacts = defaultdict(list)
+        for contact in contacts:
+            org_contacts[contact.org_id].append(contact)
+
+        org_fields = dict()
+        for group in groups:
+            if group.org_id not in org_fields:
+                Contact.bulk_cache_initialize(group.org, org_contacts[group.org_id])
+                org_fields[group.org_id] = group.org.get_schema().fields_by_key
+
+        for group in groups:
+            query_field_ids = set(field.pk for field in group.query_fields.all())
+
+            # name and URN changes can affect any group, field changes only groups that query on that field
+            affected = [contact for contact in contacts if contact.org_id == group.org_id and
+                        (contact.pk in self.attr_updates or
+                         query_field_ids.intersection(self.field_updates.get(contact.pk, {}).keys()))]
+            if not affected:
+                continue
+
+            predicate, is_complex = search.contact_predicate(group.org, group.query, org_fields[group.org_id])
+
+            qualifying = set()
+            unevaluated = []
+            for contact in affected:
+                try:
+                    if predicate.matches(contact):
+                        qualifying.add(contact.pk)
+                except search.SearchException:
+                    unevaluated.append(contact.pk)
+
+            # only fall back to running the query against the database for contacts we couldn't evaluate
+            if unevaluated:
+                qs, is_complex = Contact.search(group.org, group.query)
+                qualifying.update(qs.filter(pk__in=unevaluated).values_list('pk', flat=True))
+
+            group.update_contacts([contact for contact in affected if contact.pk in qualifying], True)
+            group.update_contacts([contact for contact in affected if contact.pk not in qualifying], False)
+
+    def update_campaign_events(self):
+        from temba.campaigns.models import EventFire
+
+        # contacts whose groups changed get all their events rescheduled
+        for contact_id in self.group_updates:
+            EventFire.update_events_for_contact(self.contacts[contact_id])
+
+        # everybody else only needs events for the fields that changed
+        for contact_id, fields in self.field_updates.items():
+            if contact_id not in self.group_updates:
+                for field in fields.values():
+                    EventFire.update_events_for_contact_field(self.contacts[contact_id], field.key)
+
+
 class ExportContactsTask(SmartModel):
 
     org = models.ForeignKey(Org, related_name='contacts_exports', help_text=_("The Organization of the user."))
@@ -1356,54 +2093,34 @@ class ExportContactsTask(SmartModel):
     def do_export(self):
         from xlwt import Workbook
 
-        book = Workbook()
-
         fields = [dict(label='Phone', key='phone'), dict(label='Name', key='name')]
-        contact_fields_list = ContactField.objects.filter(org=self.org, is_active=True)
+        contact_fields_list = self.org.get_schema().active_fields
 
         for contact_field in contact_fields_list:
             fields.append(dict(label=contact_field.label, key=contact_field.key))
 
-        all_contacts = Contact.objects.filter(org=self.org, is_active=True, is_archived=False).order_by('name', 'pk')
+        all_contacts = Contact.objects.filter(org=self.org, is_active=True, is_archived=False)
 
         if self.group:
             all_contacts = all_contacts.filter(groups=self.group)
 
         temp = NamedTemporaryFile(delete=True)
 
-        # if we have too many fields, Export using csv Otherwise use Excel
-        if len(fields) > 256:
-            import csv
-
+        # if we have too many fields or contacts, export using csv, otherwise use Excel
+        if len(fields) > 256 or all_contacts.count() > EXPORT_XLS_MAX_CONTACTS:
             writer = csv.writer(temp, quoting=csv.QUOTE_ALL)
-
             writer.writerow([s['label'].encode("utf-8") for s in fields])
 
-            for obj in all_contacts:
-                row_data = []
-                for col in range(len(fields)):
-                    field = fields[col]['key']
-                    field_value = obj.get_field_display(field)
-
-                    if field == 'name':
-                        field_value = obj.name
-
-                    value = ""
-                    if field_value:
-                        value = unicode(field_value)
-
-                    if field == 'phone':
-                        value = obj.get_urn_display(self.org, scheme=TEL_SCHEME, full=True)
+            for contacts in self.iter_contact_pages(all_contacts):
+                for contact in contacts:
+                    writer.writerow([s.encode("utf-8") for s in self.get_row_values(contact, fields)])
 
-                    row_data.append(value)
-
-                writer.writerow([s.encode("utf-8") for s in row_data])
+                temp.flush()
 
             name = '%s_%s.csv' % (str(self.pk), re.sub('-', '', str(uuid4())))
 
         else:
-            contact_sheet_number = 1
-            all_contacts = list(all_contacts)
+            book = Workbook()
 
             def add_sheet(book, sheet_number, fields):
                 # write our first sheet
@@ -1413,40 +2130,26 @@ class ExportContactsTask(SmartModel):
 
                 return sheet
 
+            contact_sheet_number = 1
             current_contact_sheet = add_sheet(book, contact_sheet_number, fields)
+            row = 0
 
-            while all_contacts:
-                if len(all_contacts) >= 65535:
-                    contacts = all_contacts[:65535]
-                    all_contacts = all_contacts[65535:]
-                else:
-                    contacts = all_contacts
-                    all_contacts = None
-
-                # then our actual values
-                for row in range(len(contacts)):
-                    obj = contacts[row]
-                    for col in range(len(fields)):
-                        field = fields[col]['key']
-                        field_value = obj.get_field_display(field)
-
-                        if field == 'name':
-                            field_value = obj.name
-
-                        value = ""
-                        if field_value:
-                            value = unicode(field_value)
-
-                        if field == 'phone':
-                            value = obj.get_urn_display(self.org, scheme=TEL_SCHEME, full=True)
-
-                        # skip the header
-                        current_contact_sheet.write(row + 1, col, value)
+            for contacts in self.iter_contact_pages(all_contacts):
+                for contact in contacts:
+                    # xls sheets are limited to 65536 rows, so start a new sheet when this one is full
+                    if row == 65535:
+                        current_contact_sheet.flush_row_data()
+                        contact_sheet_number += 1
+                        current_contact_sheet = add_sheet(book, contact_sheet_number, fields)
+                        row = 0
 
+                    row += 1
+                    for col, value in enumerate(self.get_row_values(contact, fields)):
+                        current_contact_sheet.write(row, col, value)
 
-                contact_sheet_number += 1
-                current_contact_sheet = add_sheet(book, contact_sheet_number, fields)
-
+                # serialize the rows we've written so far so we don't hold cell objects for the whole export, though
+                # the serialized rows stay in memory until the book is saved, which is why the number of rows is bounded
+                current_contact_sheet.flush_row_data()
 
             name = '%s_%s.xls' % (str(self.pk), re.sub('-', '', str(uuid4())))
 
@@ -1470,3 +2173,43 @@ class ExportContactsTask(SmartModel):
 
         send_temba_email(self.created_by.username, subject,
                           template, dict(link='http://%s/%s' % (settings.AWS_STORAGE_BUCKET_NAME, self.filename)), branding)
+
+    def iter_contact_pages(self, contacts):
+        """
+        Pages through the given contacts in the order they were created, using the last id of each page as the key for
+        the next rather than an offset so that every page is a primary key range scan, and yields each page with its
+        fields and URNs already loaded
+        """
+        contacts = contacts.order_by('pk')
+
+        last_id = 0
+        while True:
+            page = list(contacts.filter(pk__gt=last_id)[:EXPORT_PAGE_SIZE])
+            if not page:
+                break
+
+            # all our contacts are in our org, so set it on each one rather than fetching it again
+            for contact in page:
+                contact.org = self.org
+
+            Contact.bulk_cache_initialize(self.org, page)
+            yield page
+
+            last_id = page[-1].pk
+
+    def get_row_values(self, contact, fields):
+        """
+        Gets the export row for the given contact as a list of strings, one for each of the given fields
+        """
+        values = []
+        for field in fields:
+            if field['key'] == 'phone':
+                value = contact.get_urn_display(self.org, scheme=TEL_SCHEME, full=True)
+            elif field['key'] == 'name':
+                value = contact.name
+            else:
+                value = contact.get_field_display(field['key'])
+
+            values.append(unicode(value) if value else "")
+
+        return values
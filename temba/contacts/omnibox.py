@@ -85,7 +85,8 @@ def omnibox_mixed_search(org, search, types):
 
         join_op = ' AND '
         for term in search_terms:
-            term_clauses.append(col + " ILIKE %s")
+            # matches the expression of our trigram indexes so that substring searches can use them
+            term_clauses.append("UPPER(" + col + "::text) LIKE UPPER(%s)")
             _params.append(r'%' + term + r'%')
 
             # if this is an anonymous org, maybe they are querying by id
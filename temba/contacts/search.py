@@ -1,13 +1,16 @@
 from __future__ import unicode_literals
 
+import abc
+import operator
 import ply.lex as lex
 import pytz
 from datetime import timedelta
 from decimal import Decimal
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
 from django.db.models import Q
 from ply import yacc
-from temba.utils import str_to_datetime
+from temba.utils import str_to_datetime, datetime_to_ms
 from temba.values.models import TEXT, DECIMAL, DATETIME, STATE, DISTRICT
 
 # Originally based on this DSL for Django ORM: http://www.matthieuamiguet.ch/blog/my-djangocon-eu-slides-are-online
@@ -43,6 +46,29 @@ DATETIME_LOOKUP_ALIASES = {
     '<=': 'lte'
 }
 
+# SQL operators for the decimal lookups above
+DECIMAL_LOOKUP_OPERATORS = {
+    'exact': '=',
+    'gt': '>',
+    'gte': '>=',
+    'lt': '<',
+    'lte': '<='
+}
+
+# in memory equivalents of the text and decimal lookups above, used for predicates
+TEXT_LOOKUP_TESTS = {
+    'iexact': lambda actual, expected: actual.lower() == expected.lower(),
+    'icontains': lambda actual, expected: expected.lower() in actual.lower()
+}
+
+DECIMAL_LOOKUP_TESTS = {
+    'exact': operator.eq,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le
+}
+
 
 class SearchException(Exception):
     """
@@ -52,6 +78,116 @@ class SearchException(Exception):
         self.message = message
 
 
+class ContactCondition(object):
+    """
+    A SQL condition on the contacts table, which can be combined with other conditions using & and |
+    """
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+
+    def __and__(self, other):
+        return ContactCondition('(%s) AND (%s)' % (self.sql, other.sql), self.params + other.params)
+
+    def __or__(self, other):
+        return ContactCondition('(%s) OR (%s)' % (self.sql, other.sql), self.params + other.params)
+
+
+class ContactPredicate(object):
+    """
+    A parsed query which can be evaluated in memory against a single contact, using its cached field values and URNs
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def get_field_keys(self):
+        return set()
+
+    def matches(self, contact):
+        """
+        Whether the passed in contact would be returned by a search using our query
+        """
+        if not contact.is_active or contact.is_archived or contact.is_test:
+            return False
+
+        contact.cache_fields(self.get_field_keys())
+        return self.evaluate(contact)
+
+    @abc.abstractmethod
+    def evaluate(self, contact):  # pragma: no cover
+        """
+        Whether the passed in contact satisfies this predicate, assuming its fields have been cached
+        """
+
+
+class BoolPredicate(ContactPredicate):
+    """
+    An AND or OR of two predicates
+    """
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def get_field_keys(self):
+        return self.left.get_field_keys() | self.right.get_field_keys()
+
+    def evaluate(self, contact):
+        if self.operator == 'and':
+            return self.left.evaluate(contact) and self.right.evaluate(contact)
+        else:
+            return self.left.evaluate(contact) or self.right.evaluate(contact)
+
+
+class ConditionPredicate(ContactPredicate):
+    """
+    A single condition on a contact attribute or field. The test is given the contact's name, URN paths or field
+    value (which may be None) and should mirror the database lookup used for searching.
+    """
+    def __init__(self, identifier, test, field=None):
+        self.identifier = identifier
+        self.test = test
+        self.field = field
+
+    def get_field_keys(self):
+        return {self.field.key} if self.field else set()
+
+    def evaluate(self, contact):
+        if self.identifier == 'name':
+            return contact.name is not None and self.test(contact.name)
+        elif self.identifier == 'urns__path':
+            return any(self.test(urn.path) for urn in contact.get_urns())
+        else:
+            value = contact.get_field(self.field.key)
+            return value is not None and self.test(value)
+
+
+class SimplePredicate(ContactPredicate):
+    """
+    A simple term based search, where every term must be contained in the name or a URN path of the contact
+    """
+    def __init__(self, org, query):
+        self.org = org
+        self.terms = [term.lower() for term in query.split()]
+
+    def evaluate(self, contact):
+        for term in self.terms:
+            if contact.name and term in contact.name.lower():
+                continue
+
+            if self.org.is_anon:
+                try:
+                    if int(term) == contact.pk:
+                        continue
+                except ValueError:
+                    pass
+            elif any(term in urn.path.lower() for urn in contact.get_urns()):
+                continue
+
+            return False
+
+        return True
+
+
 def contact_search(org, query, base_queryset):
     """
     Searches for contacts
@@ -60,32 +196,60 @@ def contact_search(org, query, base_queryset):
     :param base_queryset: the base query set which queries operate on
     :return: a tuple of the contact query set, a boolean whether query was complex
     """
+    init_property_aliases()
+
+    try:
+        return contact_search_complex(org, query, base_queryset), True
+    except SearchException:
+        pass
+
+    # if that didn't work, try again as simple name or urn path query
+    return contact_search_simple(org, query, base_queryset), False
+
+
+def init_property_aliases():
     from .models import URN_SCHEME_CHOICES
     global PROPERTY_ALIASES
     if not PROPERTY_ALIASES:
         PROPERTY_ALIASES = {scheme: 'urns__path' for scheme, label in URN_SCHEME_CHOICES}
 
+
+def contact_predicate(org, query, fields=None):
+    """
+    Parses a query into a predicate which can be evaluated in memory against single contacts
+    :param org: the org (used for date formats and timezones)
+    :param query: the query, e.g. 'name = "Bob"'
+    :param fields: optional map of keys to all contact fields of the org, to avoid fetching each field
+    :return: a tuple of the predicate, a boolean whether query was complex
+    """
+    global search_lexer, search_parser
+
+    init_property_aliases()
+
+    # each parse gets its own lexer so that concurrent or nested parses can't see each other's context
+    lexer = search_lexer.clone()
+    lexer.org = org
+    lexer.fields = fields
+    lexer.build_predicate = True
     try:
-        return contact_search_complex(org, query, base_queryset), True
+        return search_parser.parse(query, lexer=lexer), True
     except SearchException:
         pass
 
-    # if that didn't work, try again as simple name or urn path query
-    return contact_search_simple(org, query, base_queryset), False
+    return SimplePredicate(org, query), False
 
 
 def contact_search_simple(org, query, base_queryset):
     """
     Performs a simple term based search, e.g. 'Bob' or '250783835665'
     """
-    matches = ('name__icontains',) if org.is_anon else ('name__icontains', 'urns__path__icontains')
+    from .models import ContactURN
+
     terms = query.split()
     q = Q(pk__gt=0)
 
     for term in terms:
-        term_query = Q(pk__lt=0)
-        for match in matches:
-            term_query |= Q(**{match: term})
+        term_query = Q(name__icontains=term)
 
         if org.is_anon:
             # try id match for anon orgs
@@ -94,6 +258,10 @@ def contact_search_simple(org, query, base_queryset):
                 term_query |= Q(id=term_as_int)
             except ValueError:
                 pass
+        else:
+            # URNs are matched in a sub-query rather than a join so that both lookups can use their trigram indexes
+            urn_matches = ContactURN.objects.filter(org=org, path__icontains=term).exclude(contact=None)
+            term_query |= Q(pk__in=urn_matches.values('contact'))
 
         q &= term_query
 
@@ -106,24 +274,23 @@ def contact_search_complex(org, query, base_queryset):
     """
     global search_lexer, search_parser
 
-    # attach context to the lexer
-    search_lexer.org = org
-    search_lexer.base_queryset = base_queryset
+    # attach context to our own copy of the lexer
+    lexer = search_lexer.clone()
+    lexer.org = org
+    lexer.fields = None
+    lexer.build_predicate = False
 
-    # combining results from multiple joins can lead to duplicates
-    return search_parser.parse(query, lexer=search_lexer).distinct()
+    # the whole query becomes a single condition on the contacts table, so no joins are needed
+    condition = search_parser.parse(query, lexer=lexer)
+    return base_queryset.extra(where=[condition.sql], params=condition.params)
 
 
-def generate_queryset(lexer, identifier, comparator, value):
+def resolve_identifier(lexer, identifier):
     """
-    Generates a queryset from the base and given field condition
-    :param lexer: the lexer
-    :param identifier: the contact attribute or field name, e.g. name
-    :param comparator: the comparator, e.g. =
-    :param value: the literal value, e.g. "Bob"
-    :return: the query set
+    Resolves an identifier to a contact attribute or a contact field
+    :return: a tuple of the resolved identifier and the contact field, if any
     """
-    # resolve identifier aliases, e.g. '>' -> 'gt'
+    # resolve identifier aliases, e.g. 'tel' -> 'urns__path'
     if identifier in PROPERTY_ALIASES.keys():
         identifier = PROPERTY_ALIASES[identifier]
 
@@ -131,26 +298,96 @@ def generate_queryset(lexer, identifier, comparator, value):
         if identifier == 'urns__path' and lexer.org.is_anon:
             raise SearchException("Cannot search by URN in anonymous org")
 
-        q = generate_non_field_comparison(identifier, comparator, value)
+        return identifier, None
     else:
         from temba.contacts.models import ContactField
         try:
-            field = ContactField.objects.get(org=lexer.org, key=identifier)
-        except ObjectDoesNotExist:
+            if lexer.fields is not None:
+                return identifier, lexer.fields[identifier]
+            else:
+                return identifier, ContactField.objects.get(org=lexer.org, key=identifier)
+        except (KeyError, ObjectDoesNotExist):
             raise SearchException("Unrecognized contact field identifier %s" % identifier)
 
-        if field.value_type == TEXT:
-            q = generate_text_field_comparison(field, comparator, value)
-        elif field.value_type == DECIMAL:
-            q = generate_decimal_field_comparison(field, comparator, value)
-        elif field.value_type == DATETIME:
-            q = generate_datetime_field_comparison(field, comparator, value, lexer.org)
-        elif field.value_type == STATE or field.value_type == DISTRICT:
-            q = generate_location_field_comparison(field, comparator, value)
+
+def generate_condition(lexer, identifier, comparator, value):
+    """
+    Generates a SQL condition for the given field condition
+    :param lexer: the lexer
+    :param identifier: the contact attribute or field name, e.g. name
+    :param comparator: the comparator, e.g. =
+    :param value: the literal value, e.g. "Bob"
+    :return: the condition
+    """
+    identifier, field = resolve_identifier(lexer, identifier)
+
+    if not field:
+        return generate_non_field_comparison(identifier, comparator, value)
+    elif field.value_type == TEXT:
+        return generate_text_field_comparison(field, comparator, value)
+    elif field.value_type == DECIMAL:
+        return generate_decimal_field_comparison(field, comparator, value)
+    elif field.value_type == DATETIME:
+        return generate_datetime_field_comparison(field, comparator, value, lexer.org)
+    elif field.value_type == STATE or field.value_type == DISTRICT:
+        return generate_location_field_comparison(field, comparator, value)
+    else:
+        raise SearchException("Unrecognized contact field type '%s'" % field.value_type)
+
+
+def generate_predicate(lexer, identifier, comparator, value):
+    """
+    Generates an in memory predicate for the given field condition, equivalent to generate_condition
+    :param lexer: the lexer
+    :param identifier: the contact attribute or field name, e.g. name
+    :param comparator: the comparator, e.g. =
+    :param value: the literal value, e.g. "Bob"
+    :return: the predicate
+    """
+    identifier, field = resolve_identifier(lexer, identifier)
+
+    if not field or field.value_type in (TEXT, STATE, DISTRICT):
+        lookup = TEXT_LOOKUP_ALIASES.get(comparator, None)
+        if not lookup:
+            raise SearchException("Unsupported comparator %s" % comparator)
+
+        text_test = TEXT_LOOKUP_TESTS[lookup]
+
+        if not field:
+            test = lambda actual: text_test(actual, value)
+        elif field.value_type == TEXT:
+            test = lambda actual: text_test(actual.string_value, value)
         else:
-            raise SearchException("Unrecognized contact field type '%s'" % field.value_type)
+            test = lambda actual: actual.location_value is not None and text_test(actual.location_value.name, value)
+
+    elif field.value_type == DECIMAL:
+        lookup = DECIMAL_LOOKUP_ALIASES.get(comparator, None)
+        if not lookup:
+            raise SearchException("Unsupported comparator %s for decimal field" % comparator)
+
+        decimal_value = parse_decimal(value)
+        decimal_test = DECIMAL_LOOKUP_TESTS[lookup]
+        test = lambda actual: actual.decimal_value is not None and decimal_test(actual.decimal_value, decimal_value)
+
+    elif field.value_type == DATETIME:
+        (start, end) = get_datetime_range(comparator, value, lexer.org)
+        test = lambda actual: (actual.datetime_value is not None and
+                               (start is None or actual.datetime_value >= start) and
+                               (end is None or actual.datetime_value < end))
+    else:
+        raise SearchException("Unrecognized contact field type '%s'" % field.value_type)
+
+    return ConditionPredicate(identifier, test, field)
+
 
-    return lexer.base_queryset.filter(q)
+def generate_text_comparison(column, lookup, value):
+    """
+    Generates a case insensitive comparison of the given text column and value
+    """
+    if lookup == 'iexact':
+        return 'UPPER(%s) = UPPER(%%s)' % column, [value]
+    else:
+        return 'UPPER(%s) LIKE UPPER(%%s)' % column, ['%%%s%%' % connection.ops.prep_for_like_query(value)]
 
 
 def generate_non_field_comparison(relation, comparator, value):
@@ -158,7 +395,13 @@ def generate_non_field_comparison(relation, comparator, value):
     if not lookup:
         raise SearchException("Unsupported comparator %s for non-field" % comparator)
 
-    return Q(**{'%s__%s' % (relation, lookup): value})
+    if relation == 'name':
+        sql, params = generate_text_comparison('contacts_contact.name::text', lookup, value)
+    else:
+        sql, params = generate_text_comparison('path::text', lookup, value)
+        sql = 'contacts_contact.id IN (SELECT contact_id FROM contacts_contacturn WHERE %s)' % sql
+
+    return ContactCondition(sql, params)
 
 
 def generate_text_field_comparison(field, comparator, value):
@@ -166,23 +409,41 @@ def generate_text_field_comparison(field, comparator, value):
     if not lookup:
         raise SearchException("Unsupported comparator %s for text field" % comparator)
 
-    return Q(**{'values__contact_field__key': field.key, 'values__string_value__%s' % lookup: value})
+    # values are stored lowercase so exact matches can use the hstore index
+    if lookup == 'iexact':
+        return ContactCondition('contacts_contact.fields @> hstore(%s::text, %s::text)', [field.key, value.lower()])
+    else:
+        sql, params = generate_text_comparison('contacts_contact.fields -> %s', lookup, value)
+        return ContactCondition(sql, [field.key] + params)
 
 
 def generate_decimal_field_comparison(field, comparator, value):
+    from temba.contacts.models import FIELD_HSTORE_DECIMAL_KEY
+
     lookup = DECIMAL_LOOKUP_ALIASES.get(comparator, None)
     if not lookup:
         raise SearchException("Unsupported comparator %s for decimal field" % comparator)
 
+    value = parse_decimal(value)
+    key = FIELD_HSTORE_DECIMAL_KEY % field.key
+
+    # only decimal values are stored under this key so the cast is always safe
+    sql = 'contacts_contact.fields ? %%s AND (contacts_contact.fields -> %%s)::numeric %s %%s'
+    return ContactCondition(sql % DECIMAL_LOOKUP_OPERATORS[lookup], [key, key, value])
+
+
+def parse_decimal(value):
     try:
-        value = Decimal(value)
+        return Decimal(value)
     except Exception:
         raise SearchException("Can't convert '%s' to a decimal" % unicode(value))
 
-    return Q(**{'values__contact_field__key': field.key, 'values__decimal_value__%s' % lookup: value})
 
-
-def generate_datetime_field_comparison(field, comparator, value, org):
+def get_datetime_range(comparator, value, org):
+    """
+    Gets the range of datetimes matched by the given comparison
+    :return: a tuple of the inclusive start and exclusive end of the range, either of which may be None
+    """
     lookup = DATETIME_LOOKUP_ALIASES.get(comparator, None)
     if not lookup:
         raise SearchException("Unsupported comparator %s for datetime field" % comparator)
@@ -193,30 +454,51 @@ def generate_datetime_field_comparison(field, comparator, value, org):
     value = local_date.astimezone(pytz.utc)
 
     if lookup == '<equal>':  # check if datetime is between date and date + 1d, i.e. anytime in that 24 hour period
-        return Q(**{
-            'values__contact_field__key': field.key,
-            'values__datetime_value__gte': value,
-            'values__datetime_value__lt': value + timedelta(days=1)})
+        return value, value + timedelta(days=1)
     elif lookup == 'lte':  # check if datetime is less then date + 1d, i.e. that day and all previous
-        return Q(**{
-            'values__contact_field__key': field.key,
-            'values__datetime_value__lt': value + timedelta(days=1)})
+        return None, value + timedelta(days=1)
     elif lookup == 'gt':  # check if datetime is greater than or equal to date + 1d, i.e. day after and subsequent
-        return Q(**{
-            'values__contact_field__key': field.key,
-            'values__datetime_value__gte': value + timedelta(days=1)})
+        return value + timedelta(days=1), None
+    elif lookup == 'gte':
+        return value, None
     else:
-        return Q(**{'values__contact_field__key': field.key, 'values__datetime_value__%s' % lookup: value})
+        return None, value
+
+
+def generate_datetime_field_comparison(field, comparator, value, org):
+    from temba.contacts.models import FIELD_HSTORE_DATETIME_KEY
+
+    (start, end) = get_datetime_range(comparator, value, org)
+    key = FIELD_HSTORE_DATETIME_KEY % field.key
+
+    # datetimes are stored as millisecond timestamps which can be compared numerically
+    sql = 'contacts_contact.fields ? %s'
+    params = [key]
+    if start is not None:
+        sql += ' AND (contacts_contact.fields -> %s)::bigint >= %s'
+        params += [key, datetime_to_ms(start)]
+    if end is not None:
+        sql += ' AND (contacts_contact.fields -> %s)::bigint < %s'
+        params += [key, datetime_to_ms(end)]
+
+    return ContactCondition(sql, params)
 
 
 def generate_location_field_comparison(field, comparator, value):
+    from temba.contacts.models import FIELD_HSTORE_LOCATION_KEY
+
     lookup = LOCATION_LOOKUP_ALIASES.get(comparator, None)
     if not lookup:
         raise SearchException("Unsupported comparator %s for location field" % comparator)
 
-    return Q(**{
-        'values__contact_field__key': field.key,
-        'values__location_value__name__%s' % lookup: value})
+    key = FIELD_HSTORE_LOCATION_KEY % field.key
+
+    # location names are stored lowercase so exact matches can use the hstore index
+    if lookup == 'iexact':
+        return ContactCondition('contacts_contact.fields @> hstore(%s::text, %s::text)', [key, value.lower()])
+    else:
+        sql, params = generate_text_comparison('contacts_contact.fields -> %s', lookup, value)
+        return ContactCondition(sql, [key] + params)
 
 
 #################################### Lexer definition ####################################
@@ -262,7 +544,9 @@ precedence = (
 
 def p_expression_binop(p):
     """expression : expression BINOP expression"""
-    if p[2].lower() == 'and':
+    if p.lexer.build_predicate:
+        p[0] = BoolPredicate(p[2].lower(), p[1], p[3])
+    elif p[2].lower() == 'and':
         p[0] = p[1] & p[3]
     elif p[2].lower() == 'or':
         p[0] = p[1] | p[3]
@@ -275,7 +559,10 @@ def p_expression_grouping(p):
 
 def p_expression_comparison(p):
     """expression : TEXT COMPARATOR literal"""
-    p[0] = generate_queryset(p.lexer, p[1].lower(), p[2].lower(), p[3])
+    if p.lexer.build_predicate:
+        p[0] = generate_predicate(p.lexer, p[1].lower(), p[2].lower(), p[3])
+    else:
+        p[0] = generate_condition(p.lexer, p[1].lower(), p[2].lower(), p[3])
 
 
 def p_literal(p):
@@ -293,6 +580,8 @@ def p_error(p):
 
 # initalize the PLY library for lexing and parsing
 search_lexer = lex.lex()
+search_lexer.fields = None
+search_lexer.build_predicate = False
 search_parser = yacc.yacc(write_tables=False)
 
 
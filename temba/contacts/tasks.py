@@ -1,7 +1,7 @@
 from __future__ import unicode_literals
 from datetime import timedelta
 
-from .models import ExportContactsTask
+from .models import Contact, ExportContactsTask
 from djcelery_transactions import task
 
 @task(track_started=True, name='export_contacts_task')
@@ -13,3 +13,11 @@ def export_contacts_task(id):
     if tasks:
         task = tasks[0]
         task.do_export()
+
+
+@task(track_started=True, name='purge_contacts_task')
+def purge_contacts_task(contact_ids):
+    """
+    Purges the messages, runs, values and event fires of released contacts
+    """
+    Contact.purge_released(contact_ids)
@@ -1,9 +1,11 @@
 from __future__ import unicode_literals
 
+import csv
 import json
 import pytz
 
 from datetime import datetime, date
+from decimal import Decimal
 from django.utils import timezone
 
 from django_hstore.apps import register_hstore_handler
@@ -16,6 +18,7 @@ from smartmin.tests import _CRUDLTest
 from smartmin.csv_imports.models import ImportTask
 from temba.contacts.models import Contact, ContactGroup, ContactField, ContactURN, TEL_SCHEME, TWITTER_SCHEME
 from temba.contacts.models import ExportContactsTask
+from temba.contacts import search
 from temba.contacts.templatetags.contacts import contact_field
 from temba.locations.models import AdminBoundary
 from temba.orgs.models import Org, OrgFolder
@@ -23,7 +26,7 @@ from temba.channels.models import Channel
 from temba.msgs.models import Msg, Call, Label
 from temba.tests import AnonymousOrg, TembaTest
 from temba.utils import datetime_to_str, get_datetime_format
-from temba.values.models import STATE
+from temba.values.models import Value, STATE
 
 
 class ContactCRUDLTest(_CRUDLTest):
@@ -196,6 +199,15 @@ class ContactGroupTest(TembaTest):
 
         group.update_contacts([self.mary], add=False)
 
+        with self.assertNumQueries(0):
+            self.assertEquals(group.get_member_count(), 2)
+
+        # only contacts whose membership actually changes are counted
+        self.assertEqual({self.mary.pk}, group.update_contacts([self.joe, self.mary, self.mary], add=True))
+        self.assertEqual(set(), group.update_contacts([self.joe, self.frank, self.mary], add=True))
+        self.assertEqual({self.mary.pk}, group.update_contacts([self.mary], add=False))
+        self.assertEqual(set(group.contacts.all()), {self.joe, self.frank})
+
         with self.assertNumQueries(0):
             self.assertEquals(group.get_member_count(), 2)
 
@@ -226,6 +238,21 @@ class ContactGroupTest(TembaTest):
         group.update_query('height > 100')
         self.assertEqual(0, ContactGroup.objects.get(pk=group.id).query_fields.count())
 
+        # rebuilding membership only applies the differences, and keeps the cached count accurate
+        self.assertEqual((2, 0), group.update_query('name has o'))
+        self.assertEqual(set(group.contacts.all()), {self.joe, self.mary})
+        self.assertEqual(2, group.get_member_count())
+
+        self.assertEqual((1, 1), group.update_query('name has r'))
+        self.assertEqual(set(group.contacts.all()), {self.frank, self.mary})
+        self.assertEqual((0, 0), group.rebuild_members())
+
+        with patch('temba.contacts.models.GROUP_REBUILD_CHUNK_SIZE', 1):
+            self.assertEqual((1, 2), group.update_query('name has joe'))
+
+        self.assertEqual(set(group.contacts.all()), {self.joe})
+        self.assertEqual(1, group.get_member_count())
+
         # dynamic group should not have remove to group button
         self.login(self.admin)
         filter_url = reverse('contacts.contact_filter', args=[group.pk])
@@ -338,6 +365,71 @@ class ContactTest(TembaTest):
         # or have any URNs
         self.assertEqual(0, ContactURN.objects.filter(contact=self.joe).count())
 
+    def test_bulk_release(self):
+        from temba.campaigns.models import Campaign, CampaignEvent, EventFire
+        from temba.flows.models import FlowRun, FlowStep
+
+        msg1 = self.create_msg(text="Test 1", direction='I', contact=self.joe, msg_type='I', status='H')
+        msg2 = self.create_msg(text="Test 2", direction='I', contact=self.frank, msg_type='I', status='H', visibility='A')
+        msg3 = self.create_msg(text="Test 3", direction='I', contact=self.voldemort, msg_type='I', status='H')
+        label = Label.objects.create(org=self.org, name="Interesting")
+        label.toggle_label([msg1, msg2, msg3], add=True)
+        group = self.create_group("Testers", [self.joe, self.frank, self.voldemort])
+
+        flow = self.create_flow()
+        flow.start([], [self.joe, self.voldemort])
+
+        joined = ContactField.get_or_create(self.org, 'joined', "Joined")
+        self.joe.set_field('joined', "05-10-2020 12:30:10")
+        self.voldemort.set_field('joined', "05-10-2020 12:30:10")
+
+        campaign = Campaign.objects.create(name="Reminders", group=group, org=self.org,
+                                           created_by=self.admin, modified_by=self.admin)
+        event = CampaignEvent.objects.create(campaign=campaign, relative_to=joined, offset=1, flow=flow,
+                                             created_by=self.admin, modified_by=self.admin)
+        EventFire.update_campaign_events(campaign)
+        self.assertEqual(2, EventFire.objects.filter(event=event).count())
+
+        self.clear_cache()
+        self.assertEqual(4, self.org.get_folder_count(OrgFolder.contacts_all))
+        self.assertEqual(2, self.org.get_folder_count(OrgFolder.msgs_inbox))
+        self.assertEqual(1, self.org.get_folder_count(OrgFolder.msgs_archived))
+        self.assertEqual(3, label.get_message_count())
+        self.assertEqual(3, group.get_member_count())
+        self.assertEqual(2, flow.get_total_runs())
+
+        with patch('temba.contacts.models.CONTACT_RELEASE_CHUNK_SIZE', 1):
+            released = Contact.apply_action_delete(Contact.objects.filter(pk__in=[self.joe.pk, self.frank.pk]))
+
+        self.assertEqual({self.joe.pk, self.frank.pk}, set(released))
+        self.assertFalse(Contact.objects.filter(pk__in=released, is_active=True).exists())
+        self.assertEqual(0, ContactURN.objects.filter(contact__in=released).count())
+
+        # counts are adjusted for the released contacts and their messages
+        self.assertEqual(2, self.org.get_folder_count(OrgFolder.contacts_all))
+        self.assertEqual(1, self.org.get_folder_count(OrgFolder.msgs_inbox))
+        self.assertEqual(0, self.org.get_folder_count(OrgFolder.msgs_archived))
+        self.assertEqual(1, label.get_message_count())
+        self.assertEqual(1, group.get_member_count())
+        self.assertEqual({self.voldemort}, set(group.contacts.all()))
+
+        # their messages, runs, steps, values and event fires are all purged
+        self.assertEqual(0, Msg.objects.filter(contact__in=released).exclude(visibility='D').count())
+        self.assertEqual(0, Msg.objects.filter(contact__in=released).exclude(text="").count())
+        self.assertEqual(0, FlowRun.objects.filter(contact__in=released).count())
+        self.assertEqual(0, FlowStep.objects.filter(contact__in=released).count())
+        self.assertEqual(0, Value.objects.filter(contact__in=released).count())
+        self.assertEqual(0, EventFire.objects.filter(contact__in=released).count())
+
+        # but voldemort's are untouched
+        self.assertEqual(1, FlowRun.objects.filter(contact=self.voldemort).count())
+        self.assertEqual(1, EventFire.objects.filter(contact=self.voldemort).count())
+        self.assertEqual(1, flow.get_total_runs())
+
+        # releasing contacts again has no effect
+        self.assertEqual([], Contact.bulk_release([self.joe]))
+        self.assertEqual(2, self.org.get_folder_count(OrgFolder.contacts_all))
+
     def test_contact_display(self):
         mr_long_name = self.create_contact(name="Wolfeschlegelsteinhausenbergerdorff", number="8877")
 
@@ -495,6 +587,15 @@ class ContactTest(TembaTest):
         self.assertEquals(0, q('(('))
         self.assertEquals(0, q('name = "trey'))
 
+        # queries evaluated in memory as predicates should match the same contacts as the database searches
+        all_contacts = list(Contact.objects.filter(org=self.org))
+        for query in ('trey', '0788382011', 'name has e', 'twitter = tweep_12', 'age > 30 and age <= 40',
+                      'join_date <= 30/1/2014', 'join_date > 30/1/2014', 'home has k',
+                      '(home is gatsibo or home is "kigali") and name is mike', 'name = "trey'):
+            predicate, is_complex = search.contact_predicate(self.org, query)
+            searched = set(Contact.search(self.org, query)[0])
+            self.assertEqual(searched, {c for c in all_contacts if predicate.matches(c)})
+
         # non-anon orgs can't search by id (because they never see ids)
         contact = Contact.objects.filter(is_active=True).last()
         self.assertFalse('%d' % contact.pk in contact.get_urn().path)  # check this contact's id isn't in their tel
@@ -1249,6 +1350,31 @@ class ContactTest(TembaTest):
         response = self.client.post(customize_url, post_data, follow=True)
         self.assertFormError(response, 'form', None, 'Name is a reserved name for contact fields')
 
+    def test_contact_import_chunks(self):
+        # import in chunks of two rows, one of which has a number that already exists
+        self.create_contact("Eric", "250788382382")
+
+        with patch('temba.contacts.models.CONTACT_IMPORT_CHUNK_SIZE', 2):
+            records = self.do_import(self.user, 'sample_contacts_update.csv')
+
+        self.assertEquals(4, len(records))
+        self.assertEquals(['Eric Newcomer', 'Jackson Newcomer', 'Nic Pottier', 'Norbert Kwizera'],
+                          sorted([contact.name for contact in records]))
+
+        # our existing contacts were updated, the rest created along with their URNs
+        self.assertEquals("Eric Newcomer", Contact.objects.get(urns__path="+250788382382").name)
+        self.assertEquals("Nic Pottier", Contact.objects.get(pk=self.voldemort.pk).name)
+        self.assertEquals(1, ContactURN.objects.filter(path="+250788382382").count())
+        self.assertEquals(4, ContactURN.objects.filter(path__in=["+250788382382", "+250788383383",
+                                                                 "+250788383385", "+250788321321"]).count())
+
+        # all our contacts end up in the one group
+        group = ContactGroup.objects.get(name="Sample Contacts Update")
+        self.assertEquals(4, group.contacts.count())
+
+        task = ImportTask.objects.get()
+        self.assertEquals(dict(records=4, errors=0, creates=2, updates=2), json.loads(task.import_results))
+
     def test_import_methods(self):
         user = self.user
         c1 = self.create_contact(name=None, number='0788382382')
@@ -1305,6 +1431,30 @@ class ContactTest(TembaTest):
         self.assertEquals('Joe', self.joe.get_field_raw('1234-1234'))
         ContactField.objects.get(key='1234-1234', label="First Name", org=self.joe.org)
 
+        # set multiple fields at once, creating any that don't exist
+        self.joe.set_fields(dict(age=25, district="Gasabo", nickname="Joey"))
+        self.assertEquals('25', self.joe.get_field_raw('age'))
+        self.assertEquals(25, Contact.objects.get(pk=self.joe.pk).get_field('age').decimal_value)
+        self.assertEquals('Gasabo', Contact.objects.get(pk=self.joe.pk).get_field_raw('district'))
+        ContactField.objects.get(key='nickname', label="Nickname", org=self.joe.org)
+
+        # or across many contacts, removing a field by setting it to empty
+        Contact.bulk_set_fields(self.org, [(self.joe, dict(age=26, nickname='')),
+                                           (self.frank, dict(age=50, nickname="Franky"))])
+        self.assertEquals('26', Contact.objects.get(pk=self.joe.pk).get_field_raw('age'))
+        self.assertIsNone(Contact.objects.get(pk=self.joe.pk).get_field_raw('nickname'))
+        self.assertEquals('Gasabo', Contact.objects.get(pk=self.joe.pk).get_field_raw('district'))
+        self.assertEquals('50', Contact.objects.get(pk=self.frank.pk).get_field_raw('age'))
+        self.assertEquals('Franky', self.frank.get_field_raw('nickname'))
+        self.assertEquals(1, Value.objects.filter(contact=self.joe, contact_field__key='age').count())
+
+        # fields are mirrored into the hstore used by searches, with typed keys for parseable values
+        fields = Contact.objects.get(pk=self.joe.pk).fields
+        self.assertEquals('26', fields['age'])
+        self.assertEquals(Decimal(26), Decimal(fields['age:n']))
+        self.assertEquals('gasabo', fields['district'])
+        self.assertFalse('nickname' in fields)
+
     def test_message_context(self):
         message_context = self.joe.build_message_context()
 
@@ -1402,6 +1552,30 @@ class ContactTest(TembaTest):
             self.mary.update_urns([('tel', "54321"), ('twitter', 'mary_mary')])
             self.assertEquals([self.frank, self.joe], list(_123_group.contacts.order_by('name')))
 
+            # inside a batch, group and campaign updates are deferred until the end, where group queries are
+            # evaluated in memory rather than run against the database
+            with patch.object(Contact, 'search') as contact_search:
+                with Contact.batch_updates():
+                    self.annie.set_field('age', 19)
+                    self.frank.set_field('gender', "Male")
+                    self.joe.name = "Joseph"
+                    self.joe.save()
+                    self.joe.handle_update(attrs=('name',))
+
+                    self.assertEquals([self.frank, self.mary], list(women_group.contacts.order_by('name')))
+                    self.assertEquals([self.joe], list(men_group.contacts.order_by('name')))
+                    self.assertEquals([self.joe, self.mary], list(joes_group.contacts.order_by('name')))
+
+                self.assertFalse(contact_search.called)
+
+            self.assertEquals([self.annie, self.mary], list(women_group.contacts.order_by('name')))
+            self.assertEquals([self.frank, self.joe], list(men_group.contacts.order_by('name')))
+            self.assertEquals([self.mary], list(joes_group.contacts.order_by('name')))
+
+            # and Joe's event fire is gone now that he is no longer in the group
+            joe_fires = EventFire.objects.filter(event=joes_event)
+            self.assertEquals([self.mary], [fire.contact for fire in joe_fires])
+
 
 class ContactURNTest(TembaTest):
     def setUp(self):
@@ -1438,6 +1612,53 @@ class ContactURNTest(TembaTest):
         self.assertEquals(('twitter', "jimmyjo"), ContactURN.normalize_urn('TWITTER', "jimmyjo"))
         self.assertEquals(('twitter', "billy_bob"), ContactURN.normalize_urn('twitter', " @billy_bob "))
 
+    def test_normalize_numbers(self):
+        normalized = ContactURN.normalize_numbers(["0788383383", "+250788383383", "0788383383", "MTN"], "RW")
+        self.assertEquals({"0788383383": ("+250788383383", True),
+                           "+250788383383": ("+250788383383", True),
+                           "MTN": ("mtn", False)}, normalized)
+
+        # results are cached so normalizing or validating the same number again doesn't need to parse it
+        self.assertTrue(ContactURN.validate_urn('tel', "0788383383", "RW"))
+
+        with patch('phonenumbers.parse') as mock_parse:
+            self.assertEquals(("+250788383383", True), ContactURN.normalize_number("0788383383", "RW"))
+            self.assertTrue(ContactURN.validate_urn('tel', "0788383383", "RW"))
+            self.assertEquals(0, mock_parse.call_count)
+
+    def test_cached(self):
+        urn = (TEL_SCHEME, "+250788000001")
+
+        # an incoming message caches its URN as belonging to its contact
+        contact = Contact.get_or_create(self.org, self.user, urns=[urn], incoming_channel=self.channel)
+        cached = ContactURN.get_cached(self.org, 'tel:+250788000001')
+        self.assertEquals(contact.urn_objects[urn].pk, cached.pk)
+        self.assertEquals(contact.pk, cached.contact_id)
+        self.assertEquals(self.channel.pk, cached.channel_id)
+
+        # so the next message from that URN only needs to fetch the contact
+        with self.assertNumQueries(1):
+            self.assertEquals(contact, Contact.get_or_create(self.org, self.user, urns=[urn],
+                                                             incoming_channel=self.channel))
+
+        # a message on a different channel goes the long way round to update the URN's channel
+        other_channel = Channel.objects.create(org=self.org, name="Other Channel", address="+250785551313",
+                                               country='RW', channel_type='A', secret="23456", gcm_id="234",
+                                               created_by=self.user, modified_by=self.user)
+        Contact.get_or_create(self.org, self.user, urns=[urn], incoming_channel=other_channel)
+        self.assertEquals(other_channel.pk, ContactURN.get_cached(self.org, 'tel:+250788000001').channel_id)
+
+        # detaching the URN removes it from the cache
+        contact.update_urns([(TEL_SCHEME, "+250788000002")])
+        self.assertIsNone(ContactURN.get_cached(self.org, 'tel:+250788000001'))
+
+        # as does releasing its contact
+        contact = Contact.get_or_create(self.org, self.user, urns=[urn], incoming_channel=self.channel)
+        self.assertIsNotNone(ContactURN.get_cached(self.org, 'tel:+250788000001'))
+
+        contact.release()
+        self.assertIsNone(ContactURN.get_cached(self.org, 'tel:+250788000001'))
+
     def test_validate_urn(self):
         # valid tel numbers
         self.assertTrue(ContactURN.validate_urn('tel', "0788383383", "RW"))
@@ -1531,6 +1752,40 @@ class ContactFieldTest(TembaTest):
         self.assertEquals('+12067799294', sheet.cell(1, 0).value)
         self.assertEquals("One", sheet.cell(1, 2).value)
 
+        # add some more contacts, including one without a name, and export across several small pages
+        self.create_contact("Adam Smith", '+12067799291')
+        self.create_contact(None, '+12067799292')
+        self.create_contact("Zed Jones", '+12067799293').set_field('First', 'Two')
+
+        with patch('temba.contacts.models.EXPORT_PAGE_SIZE', 2):
+            self.client.get(reverse('contacts.contact_export'), dict())
+
+        task = ExportContactsTask.objects.all().order_by('-pk').first()
+        workbook = open_workbook("/%s/%s" % (settings.MEDIA_ROOT, task.filename), 'rb')
+        sheet = workbook.sheets()[0]
+
+        # each contact appears once, in the order they were created
+        self.assertEquals(5, sheet.nrows)
+        self.assertEquals(["Ben Haggerty", "Adam Smith", '', "Zed Jones"], [sheet.cell(r, 1).value for r in range(1, 5)])
+        self.assertEquals(['+12067799294', '+12067799291', '+12067799292', '+12067799293'],
+                          [sheet.cell(r, 0).value for r in range(1, 5)])
+        self.assertEquals(["One", "", "", "Two"], [sheet.cell(r, 2).value for r in range(1, 5)])
+
+        # exports with more contacts than we'll hold in an xls workbook are written as csv instead
+        with patch('temba.contacts.models.EXPORT_XLS_MAX_CONTACTS', 3):
+            with patch('temba.contacts.models.EXPORT_PAGE_SIZE', 2):
+                self.client.get(reverse('contacts.contact_export'), dict())
+
+        task = ExportContactsTask.objects.all().order_by('-pk').first()
+        self.assertTrue(task.filename.endswith('.csv'))
+
+        with open("/%s/%s" % (settings.MEDIA_ROOT, task.filename), 'rb') as csv_file:
+            rows = list(csv.reader(csv_file))
+
+        self.assertEquals(['Phone', 'Name', 'First', 'Second', 'Third'], rows[0][:5])
+        self.assertEquals(["Ben Haggerty", "Adam Smith", '', "Zed Jones"], [row[1] for row in rows[1:]])
+        self.assertEquals(["One", "", "", "Two"], [row[2] for row in rows[1:]])
+
     def test_managefields(self):
         manage_fields_url = reverse('contacts.contactfield_managefields')
 
@@ -779,10 +779,13 @@ class ContactCRUDL(SmartCRUDL):
 
                 obj.update_urns(urns)
 
+            field_values = dict()
             for field_key, value in self.form.cleaned_data.iteritems():
                 if field_key.startswith('__field__'):
                     key = field_key[9:]
-                    obj.set_field(key, value)
+                    field_values[key] = value
+
+            obj.set_fields(field_values)
 
             return obj
 
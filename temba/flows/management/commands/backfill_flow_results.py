@@ -0,0 +1,41 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from temba.flows.models import FlowRun
+from temba.utils import dict_to_json
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+class Command(BaseCommand): # pragma: no cover
+    args = '<flow_id flow_id ...>'
+    help = 'Populates the results column for runs which predate it, optionally limited to the given flows.'
+
+    def handle(self, *args, **options):
+        runs = FlowRun.objects.filter(results=None)
+        if args:
+            runs = runs.filter(flow__pk__in=[int(arg) for arg in args])
+
+        total = 0
+        while True:
+            # each pass picks up the next batch of runs still without results
+            batch = list(runs.order_by('pk')[:BACKFILL_BATCH_SIZE])
+            if not batch:
+                break
+
+            run_results = FlowRun.build_results_from_steps(batch)
+
+            # update the whole batch in a single statement
+            rows = []
+            params = []
+            for run in batch:
+                rows.append('(%s, %s)')
+                params += [run.pk, dict_to_json(run_results[run.pk])]
+
+            cursor = connection.cursor()
+            cursor.execute("UPDATE flows_flowrun r SET results = u.results FROM (VALUES %s) AS u(id, results) "
+                           "WHERE r.id = u.id" % ', '.join(rows), params)
+
+            total += len(batch)
+            print "Backfilled results for %d runs" % total
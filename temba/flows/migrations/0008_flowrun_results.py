@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0007_auto_20150115_1926'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flowrun',
+            name='results',
+            field=models.TextField(help_text='A JSON representation of the latest result for each ruleset in this run', null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
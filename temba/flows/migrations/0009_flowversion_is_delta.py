@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0008_flowrun_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flowversion',
+            name='is_delta',
+            field=models.BooleanField(default=False, help_text='Whether our definition is a compressed delta against the previous version'),
+            preserve_default=True,
+        ),
+    ]
@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+import base64
 import copy
 import json
 import numbers
@@ -11,7 +12,9 @@ import requests
 import time
 import xlwt
 import urllib2
+import zlib
 
+from collections import defaultdict
 from datetime import timedelta
 from decimal import Decimal
 from django.conf import settings
@@ -22,7 +25,7 @@ from django.core.files.temp import NamedTemporaryFile
 from django.core.mail import send_mail
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User, Group
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.db.models import Q, Count
 from django.utils import timezone
 from django.utils.html import escape
@@ -38,6 +41,8 @@ from temba.msgs.models import Broadcast, Msg, FLOW, OUTGOING, STOP_WORDS, QUEUED
 from temba.orgs.models import Org
 from temba.temba_email import send_temba_email
 from temba.utils import get_datetime_format, str_to_datetime, datetime_to_str, get_preferred_language, analytics
+from temba.utils import dict_to_json, json_date_to_datetime
+from temba.utils.cache import incrby_existing
 from temba.utils.models import TembaModel
 from temba.utils.queues import push_task
 from temba.values.models import VALUE_TYPE_CHOICES, TEXT, DATETIME, DECIMAL, Value
@@ -61,6 +66,10 @@ RESPONSE_TYPE_CHOICES = ((OPEN, "Open Ended"),
 
 FLOW_DEFAULT_EXPIRES_AFTER = 60 * 12
 START_FLOW_BATCH_SIZE = 500
+RELEASE_RUN_BATCH_SIZE = 500
+
+# how often we store a full snapshot of a flow definition, versions in between only store deltas
+FLOW_VERSION_SNAPSHOT_INTERVAL = 10
 
 
 class FlowException(Exception):
@@ -80,6 +89,25 @@ FLOW_STAT_CACHE_KEY = 'org:%d:cache:flow:%d:%s'
 # the most frequently we will check if our cache needs rebuilding
 FLOW_STAT_CACHE_FREQUENCY = 24 * 60 * 60  # 1 day
 
+# increments a count in one of our cached count hashes, but only if that has been built
+UPDATE_RULE_COUNT_LUA = """
+if redis.call('exists', KEYS[1]) == 1 then
+  return redis.call('hincrby', KEYS[1], ARGV[1], ARGV[2])
+end
+return nil
+"""
+
+# runs waiting on a webhook are parked at their ruleset until the webhook task resumes them
+FLOW_WEBHOOK_WAIT_KEY = 'flow_webhook_wait_%d'
+FLOW_WEBHOOK_WAIT_TTL = 60 * 5  # 5 minutes
+FLOW_WEBHOOK_LOCK_KEY = 'flow_webhook_lock_%d'
+
+# messages which arrive for a run while it waits are parked until the webhook returns, or the wait expires
+FLOW_WEBHOOK_PARKED_KEY = 'flow_webhook_parked_%d'
+FLOW_WEBHOOK_PARKED_TTL = 60 * 60 * 24  # 1 day
+FLOW_WEBHOOK_PARKED_RUNS_KEY = 'flow_webhook_parked_runs'
+CALL_FLOW_WEBHOOK_TASK = 'call_flow_webhook'
+
 class FlowLock(Enum):
     """
     Locks that are flow specific
@@ -98,6 +126,7 @@ class FlowCache(Enum):
     visit_count_map = 4
     step_active_set = 5
     cache_check = 6
+    category_count_map = 7
 
 def edit_distance(s1, s2): # pragma: no cover
     """
@@ -457,8 +486,8 @@ class Flow(TembaModel, SmartModel):
                     run.set_completed()
                     return response
 
-                step.save_rule_match(rule, value)
-                ruleset.save_run_value(run, rule, value, recording=recording_url)
+                step.save_rule_match(rule, value, run, run.contact.is_test)
+                ruleset.save_run_value(run, rule, value, recording=recording_url, step=step, text=step.get_text())
 
                 # no destination for our rule?  we are done, though we did handle this message, user is now out of the flow
                 if not rule.destination:
@@ -499,8 +528,8 @@ class Flow(TembaModel, SmartModel):
                     run.set_completed()
                     return response
 
-                step.save_rule_match(rule, value)
-                ruleset.save_run_value(run, rule, value)
+                step.save_rule_match(rule, value, run, run.contact.is_test)
+                ruleset.save_run_value(run, rule, value, step=step, text=step.get_text())
 
                 if not rule.destination:
                     # log it for our test contacts
@@ -626,6 +655,17 @@ class Flow(TembaModel, SmartModel):
             run = step.run
             flow = run.flow
 
+            # this run is waiting on a webhook, so messages are parked until that returns
+            if run.is_waiting_on_webhook():
+                if msg.id <= 0:
+                    continue
+
+                with run.lock_on_webhook():
+                    parked = run.park_msg_on_webhook(msg)
+
+                if parked:
+                    return True
+
             ruleset = RuleSet.get(step.step_uuid)
             if not ruleset:
                 step.left_on = timezone.now()
@@ -645,12 +685,17 @@ class Flow(TembaModel, SmartModel):
         return False
 
     @classmethod
-    def handle_ruleset(cls, ruleset, step, run, msg, start_time=None):
+    def handle_ruleset(cls, ruleset, step, run, msg, start_time=None, call_webhook=True):
         if not start_time:
             start_time = time.time()
 
+        # webhooks are called from their own queue, our run waits at this ruleset until that returns
+        if call_webhook and ruleset.has_async_webhook(run):
+            ruleset.park_run(step, run, msg)
+            return True
+
         # find a matching rule
-        rule, value = ruleset.find_matching_rule(step, run, msg)
+        rule, value = ruleset.find_matching_rule(step, run, msg, call_webhook=call_webhook)
 
         # no rule matched? then this message isn't part of this flow, escape out
         if not rule:
@@ -664,8 +709,8 @@ class Flow(TembaModel, SmartModel):
         if msg.id > 0:
             step.add_message(msg)
 
-        step.save_rule_match(rule, value)
-        ruleset.save_run_value(run, rule, value)
+        step.save_rule_match(rule, value, run, is_test_contact)
+        ruleset.save_run_value(run, rule, value, step=step, text=msg.text)
 
         # no destination for our rule?  we are done, though we did handle this message, user is now out of the flow
         if not rule.destination:
@@ -711,6 +756,60 @@ class Flow(TembaModel, SmartModel):
 
         return True
 
+    @classmethod
+    def resume_webhook_ruleset(cls, ruleset_id, step_id, msg_id, text):
+        """
+        Calls the webhook for a parked run and then continues evaluating its ruleset
+        """
+        step = FlowStep.objects.filter(pk=step_id).select_related('run', 'run__flow', 'run__contact', 'run__flow__org').first()
+        ruleset = RuleSet.objects.filter(pk=ruleset_id).first()
+
+        if not step:
+            return False
+
+        run = step.run
+
+        # messages without ids are placeholders for rulesets which don't operate on a step
+        msg = Msg.objects.filter(pk=msg_id).first() if msg_id else None
+        if not msg:
+            msg = Msg(contact=run.contact, text=text, id=0)
+
+        def is_resumable():
+            # our run may have moved on or expired while it was waiting, e.g. if this task sat in the queue for longer
+            # than our wait and the run was parked again by a later message
+            return ruleset and run.is_active and FlowStep.objects.filter(pk=step.pk, left_on=None, rule_uuid=None).exists()
+
+        # we keep waiting while the webhook is called, so messages that arrive in the meantime are parked
+        if is_resumable():
+            ruleset.call_webhook(run, msg)
+
+        handled = False
+        with run.lock_on_webhook():
+            resumed = is_resumable()
+            if resumed:
+                handled = cls.handle_ruleset(ruleset, step, run, msg, call_webhook=False)
+
+            run.stop_waiting_on_webhook()
+            parked_ids = run.pop_msgs_parked_on_webhook()
+
+        # if our run moved on without us, our message still needs handling from wherever it is now
+        if not resumed and msg.id > 0:
+            parked_ids.insert(0, msg.id)
+
+        # now handle any messages which were parked while we waited, in the order they arrived
+        cls.handle_parked_msgs(parked_ids)
+
+        return handled
+
+    @classmethod
+    def handle_parked_msgs(cls, parked_ids):
+        """
+        Handles the messages with the given ids, in that order, which were parked while a run waited on a webhook
+        """
+        parked = Msg.objects.filter(pk__in=parked_ids).select_related('org', 'contact', 'channel')
+        for parked_msg in sorted(parked, key=lambda m: parked_ids.index(m.pk)):
+            Msg.process_message(parked_msg)
+
     @classmethod
     def apply_action_label(cls, flows, label, add):
         return label.toggle_label(flows, add)
@@ -815,6 +914,10 @@ class Flow(TembaModel, SmartModel):
             if len(visits):
                 r.hmset(self.get_cache_key(FlowCache.visit_count_map), visits)
 
+            # rebuild our category counts
+            r.delete(self.get_cache_key(FlowCache.category_count_map))
+            self._populate_category_counts(r)
+
     def _calculate_activity(self, simulation=False):
 
         """
@@ -1145,8 +1248,54 @@ class Flow(TembaModel, SmartModel):
 
         return node_order
 
-    def get_ruleset_category_counts(self):
-        (rulesets, rule_categories) = self.build_ruleset_caches()
+    def _calculate_rule_counts(self):
+        """
+        Calculates the number of distinct runs which matched each rule in this flow, in a single grouped query
+        """
+        rule_counts = self.steps().filter(step_type=RULE_SET, run__contact__is_test=False).exclude(rule_uuid=None)
+        rule_counts = rule_counts.values('rule_uuid').annotate(count=Count('run', distinct=True))
+        return dict((count['rule_uuid'], count['count']) for count in rule_counts)
+
+    def _populate_category_counts(self, r):
+        """
+        Builds our redis hash of rule counts if it doesn't exist yet, callers should hold our activity lock
+        """
+        key = self.get_cache_key(FlowCache.category_count_map)
+        if r.exists(key):
+            return
+
+        rule_counts = self._calculate_rule_counts()
+        if rule_counts:
+            r.hmset(key, rule_counts)
+
+        return rule_counts
+
+    def get_rule_counts(self, cached=False):
+        """
+        Gets the number of distinct runs which matched each rule in this flow. If cached, this comes from our
+        incrementally maintained redis hash instead of the database
+        """
+        if not cached:
+            return self._calculate_rule_counts()
+
+        r = get_redis_connection()
+        with self.lock_on(FlowLock.activity):
+            rule_counts = self._populate_category_counts(r)
+
+        if rule_counts is None:
+            rule_counts = r.hgetall(self.get_cache_key(FlowCache.category_count_map))
+
+        return dict((rule_uuid, int(count)) for rule_uuid, count in rule_counts.items())
+
+    def update_rule_count(self, rule_uuid, delta):
+        """
+        Adjusts our cached count of runs which matched the given rule, if it has been built
+        """
+        r = get_redis_connection()
+        r.eval(UPDATE_RULE_COUNT_LUA, 1, self.get_cache_key(FlowCache.category_count_map), rule_uuid, delta)
+
+    def get_ruleset_category_counts(self, cached=False):
+        rule_counts = self.get_rule_counts(cached=cached)
         counts = []
 
         # get our columns, these should be roughly in the same order as our nodes
@@ -1157,7 +1306,7 @@ class Flow(TembaModel, SmartModel):
             category_map = dict()
 
             for rule in ruleset.get_rules():
-                count = self.steps().filter(step_type=RULE_SET, rule_uuid=rule.uuid, run__contact__is_test=False).distinct('run').count()
+                count = rule_counts.get(rule.uuid, 0)
 
                 category_name = rule.get_category_name(self.base_language)
 
@@ -1202,12 +1351,12 @@ class Flow(TembaModel, SmartModel):
 
         return (rulesets, rule_categories)
 
-    def build_message_context(self, contact, sms):
-        # if we have a contact, build up our results for them
-        if contact:
-            results = self.get_results(contact, only_last_run=True)
-        else:
+    def build_message_context(self, contact, sms, results=None):
+        # if we have a contact, build up our results for them, unless the caller already has them
+        if not contact:
             results = []
+        elif results is None:
+            results = self.get_results(contact, only_last_run=True)
 
         # create a flow dict
         flow_context = dict()
@@ -1287,72 +1436,47 @@ class Flow(TembaModel, SmartModel):
         elif only_last_run:
             runs = runs.distinct('contact')
 
-        flow_steps = FlowStep.objects.filter(step_uuid__in=rulesets.keys()).exclude(rule_uuid=None)
-
-        # filter our steps to only the runs we care about
-        flow_steps = flow_steps.filter(run__pk__in=[r.pk for r in runs])
-
-        # and the ruleset we care about
-        if filter_ruleset:
-            flow_steps = flow_steps.filter(step_uuid=filter_ruleset.uuid)
-
-        flow_steps = flow_steps.order_by('arrived_on').select_related('run').prefetch_related('messages')
-
-        steps_cache = {}
-        for step in flow_steps:
+        runs = list(runs)
 
-            step_dict = dict(left_on=step.left_on,
-                             arrived_on=step.arrived_on,
-                             rule_uuid=step.rule_uuid,
-                             rule_category=step.rule_category,
-                             rule_decimal_value=step.rule_decimal_value,
-                             rule_value=step.rule_value,
-                             text=step.get_text(),
-                             step_uuid=step.step_uuid)
-
-            step_run = step.run.id
-
-            if step_run in steps_cache.keys():
-                steps_cache[step_run].append(step_dict)
-
-            else:
-                steps_cache[step_run] = [step_dict]
+        # runs which predate our results column have their results built from their steps, keeping only the latest
+        # visit to each ruleset just like our results column
+        legacy_results = FlowRun.build_results_from_steps([r for r in runs if r.results is None])
 
         for run in runs:
             first_seen = None
             last_seen = None
             values = []
 
-            if run.id in steps_cache:
-                run_steps = steps_cache[run.id]
-            else:
-                run_steps = []
+            run_results = legacy_results[run.pk] if run.pk in legacy_results else run.get_results_dict()
+            run_results = sorted(run_results.values(), key=lambda r: r['arrived_on'])
+
+            for rule_step in run_results:
+                ruleset = rulesets.get(rule_step['node'])
+
+                # only include the rulesets we care about
+                if not ruleset:
+                    continue
 
-            for rule_step in run_steps:
-                ruleset = rulesets.get(rule_step['step_uuid'])
                 if not first_seen:
-                    first_seen = rule_step['left_on']
+                    first_seen = rule_step['time']
                 last_seen = rule_step['arrived_on']
 
-                if ruleset:
-                    time = rule_step['left_on'] if rule_step['left_on'] else rule_step['arrived_on']
-
-                    label = ruleset.label
-                    category = rule_categories.get(rule_step['rule_uuid'], None)
+                label = ruleset.label
+                category = rule_categories.get(rule_step['rule_uuid'], None)
 
-                    # if this category no longer exists, use the category label at the time
-                    if not category:
-                        category = rule_step['rule_category']
+                # if this category no longer exists, use the category label at the time
+                if not category:
+                    category = rule_step['category']
 
-                    value = rule_step['rule_decimal_value'] if rule_step['rule_decimal_value'] is not None else rule_step['rule_value']
+                value = rule_step['decimal_value'] if rule_step['decimal_value'] is not None else rule_step['rule_value']
 
-                    values.append(dict(node=rule_step['step_uuid'],
-                                       label=label,
-                                       category=category,
-                                       text=rule_step['text'],
-                                       value=value,
-                                       rule_value=rule_step['rule_value'],
-                                       time=time))
+                values.append(dict(node=rule_step['node'],
+                                   label=label,
+                                   category=category,
+                                   text=rule_step['text'],
+                                   value=value,
+                                   rule_value=rule_step['rule_value'],
+                                   time=rule_step['time']))
 
             results.append(dict(contact=run.contact, values=values, first_seen=first_seen, last_seen=last_seen, run=run.pk))
 
@@ -1595,40 +1719,42 @@ class Flow(TembaModel, SmartModel):
         msgs = []
         optimize_sending_action = len(broadcasts) > 0
 
-        for contact in batch_contacts:
-            run = run_map[contact.id]
-            run_msgs = message_map.get(contact.id, [])
+        # any contact updates made by our entry actions are applied once for the whole batch
+        with Contact.batch_updates():
+            for contact in batch_contacts:
+                run = run_map[contact.id]
+                run_msgs = message_map.get(contact.id, [])
 
-            if entry_actions:
-                run_msgs += entry_actions.execute_actions(run, start_msg, started_flows, execute_reply_action=not optimize_sending_action)
-                step = self.add_step(run, entry_actions, run_msgs, is_start=True)
+                if entry_actions:
+                    run_msgs += entry_actions.execute_actions(run, start_msg, started_flows, execute_reply_action=not optimize_sending_action)
+                    step = self.add_step(run, entry_actions, run_msgs, is_start=True)
 
-                # and onto the destination
-                if entry_actions.destination:
-                    self.add_step(run, entry_actions.destination, previous_step=step)
-                else:
-                    run.set_completed()
-                    if contact.is_test:
-                        ActionLog.create_action_log(run, '%s has exited this flow' % run.contact.get_display(self.org, short=True))
+                    # and onto the destination
+                    if entry_actions.destination:
+                        self.add_step(run, entry_actions.destination, previous_step=step)
+                    else:
+                        run.set_completed()
+                        if contact.is_test:
+                            ActionLog.create_action_log(run, '%s has exited this flow' % run.contact.get_display(self.org, short=True))
 
-            elif entry_rules:
-                step = self.add_step(run, entry_rules, run_msgs, is_start=True)
+                elif entry_rules:
+                    step = self.add_step(run, entry_rules, run_msgs, is_start=True)
 
-                # if we have a start message, go and handle the rule
-                if start_msg:
-                    self.find_and_handle(start_msg)
+                    # if we have a start message, go and handle the rule
+                    if start_msg:
+                        self.find_and_handle(start_msg)
 
-                # otherwise, if this ruleset doesn't operate on a step, then evaluate it immediately
-                elif not entry_rules.requires_step():
-                    # create an empty placeholder message
-                    msg = Msg(contact=contact, text='', id=0)
-                    self.handle_ruleset(entry_rules, step, run, msg)
+                    # otherwise, if this ruleset doesn't operate on a step, then evaluate it immediately
+                    elif not entry_rules.requires_step():
+                        # create an empty placeholder message
+                        msg = Msg(contact=contact, text='', id=0)
+                        self.handle_ruleset(entry_rules, step, run, msg)
 
-            runs.append(run)
+                runs.append(run)
 
-            # add these messages as ones that are ready to send
-            for msg in run_msgs:
-                msgs.append(msg)
+                # add these messages as ones that are ready to send
+                for msg in run_msgs:
+                    msgs.append(msg)
 
         # trigger our messages to be sent
         if msgs:
@@ -1688,6 +1814,35 @@ class Flow(TembaModel, SmartModel):
             for key in r.keys(self.get_cache_key(FlowCache.step_active_set, '*')):
                 r.srem(key, *run_ids)
 
+    def remove_released_runs(self, run_contacts, visits, rule_counts):
+        """
+        Decrements our cached stats for runs which have been deleted in bulk, given a map of their ids to contact ids,
+        the visit counts of their steps and the number of runs which matched each rule
+        """
+        r = get_redis_connection()
+        run_ids = run_contacts.keys()
+
+        with self.lock_on(FlowLock.participation):
+            incrby_existing(self.get_cache_key(FlowCache.runs_started_count), -len(run_ids), r)
+            r.srem(self.get_cache_key(FlowCache.runs_completed_count), *run_ids)
+
+            # contacts with no runs left in this flow are no longer counted as started
+            contact_ids = set(run_contacts.values())
+            contact_ids -= set(self.runs.filter(contact__in=contact_ids).values_list('contact', flat=True))
+            if contact_ids:
+                r.srem(self.get_cache_key(FlowCache.contacts_started_set), *contact_ids)
+
+        with self.lock_on(FlowLock.activity):
+            for key in r.keys(self.get_cache_key(FlowCache.step_active_set, '*')):
+                r.srem(key, *run_ids)
+
+            # only adjust counts which have been built, the same way we do for matched rules
+            for visit_key, count in visits.items():
+                r.eval(UPDATE_RULE_COUNT_LUA, 1, self.get_cache_key(FlowCache.visit_count_map), visit_key, -count)
+
+            for rule_uuid, count in rule_counts.items():
+                self.update_rule_count(rule_uuid, -count)
+
     def remove_active_for_step(self, step):
         """
         Removes the active stat for a run at the given step, but does not
@@ -1958,6 +2113,10 @@ class Flow(TembaModel, SmartModel):
             if entry:
                 destinations.add(entry)
 
+            # new nodes are created in bulk once we've seen them all
+            new_rulesets = []
+            new_actionsets = []
+
             # create all our rule sets
             for ruleset in json_dict.get(Flow.RULE_SETS, []):
 
@@ -1996,7 +2155,12 @@ class Flow(TembaModel, SmartModel):
                 existing = existing_rulesets.get(uuid, None)
 
                 if existing:
-                    existing.label = ruleset.get(Flow.LABEL, None)
+                    # only write rulesets which have actually changed
+                    if (existing.label, existing.get_rules_dict(), existing.webhook_url, existing.webhook_action,
+                            existing.operand, existing.finished_key, existing.response_type, existing.x, existing.y) == \
+                            (label, rules, webhook_url, webhook_action, operand, finished_key, response_type, x, y):
+                        continue
+
                     existing.set_rules_dict(rules)
                     existing.webhook_url = webhook_url
                     existing.webhook_action = webhook_action
@@ -2005,24 +2169,29 @@ class Flow(TembaModel, SmartModel):
                     existing.finished_key = finished_key
                     existing.response_type = response_type
                     (existing.x, existing.y) = (x, y)
+
+                    # update our value type based on our new rules
+                    existing.value_type = existing.get_value_type()
                     existing.save()
                 else:
-
-                    existing = RuleSet.objects.create(flow=self,
-                                                      uuid=uuid,
-                                                      label=label,
-                                                      rules=json.dumps(rules),
-                                                      webhook_url=webhook_url,
-                                                      webhook_action=webhook_action,
-                                                      finished_key=finished_key,
-                                                      response_type=response_type,
-                                                      operand=operand,
-                                                      x=x, y=y)
-                    existing_rulesets[uuid] = existing
-
-                # update our value type based on our new rules
-                existing.value_type = existing.get_value_type()
-                RuleSet.objects.filter(pk=existing.pk).update(value_type=existing.value_type)
+                    new_ruleset = RuleSet(flow=self,
+                                          uuid=uuid,
+                                          label=label,
+                                          rules=json.dumps(rules),
+                                          webhook_url=webhook_url,
+                                          webhook_action=webhook_action,
+                                          finished_key=finished_key,
+                                          response_type=response_type,
+                                          operand=operand,
+                                          x=x, y=y)
+                    new_ruleset.value_type = new_ruleset.get_value_type()
+                    new_rulesets.append(new_ruleset)
+
+            # create all our new rulesets at once, then fetch them back so we have their ids
+            if new_rulesets:
+                RuleSet.objects.bulk_create(new_rulesets)
+                for ruleset in RuleSet.objects.filter(flow=self, uuid__in=[_.uuid for _ in new_rulesets]):
+                    existing_rulesets[ruleset.uuid] = ruleset
 
             # now work through our action sets
             for actionset in json_dict.get(Flow.ACTION_SETS, []):
@@ -2055,34 +2224,46 @@ class Flow(TembaModel, SmartModel):
                     destination = None
 
                 existing = existing_actionsets.get(uuid, None)
+                destination_id = destination.pk if destination else None
 
                 if existing:
+                    # only write actionsets which have actually changed
+                    if (existing.destination_id, existing.get_actions_dict(), existing.x, existing.y) == \
+                            (destination_id, actions, x, y):
+                        continue
+
                     existing.destination = destination
                     existing.set_actions_dict(actions)
                     (existing.x, existing.y) = (x, y)
                     existing.save()
                 else:
-                    existing = ActionSet.objects.create(flow=self,
-                                                        uuid=uuid,
-                                                        destination=destination,
-                                                        actions=json.dumps(actions),
-                                                        x=x, y=y)
-
-                    existing_actionsets[uuid] = existing
-
-            # now work through all our objects once more, making sure all uuids map appropriately
-            for existing in existing_actionsets.values():
-                if not existing.uuid in seen:
-                    del existing_actionsets[existing.uuid]
-                    existing.delete()
-
-            for existing in existing_rulesets.values():
-                if not existing.uuid in seen:
-                    # clean up any values on this ruleset
-                    Value.objects.filter(ruleset=existing, org=self.org).delete()
-
-                    del existing_rulesets[existing.uuid]
-                    existing.delete()
+                    new_actionsets.append(ActionSet(flow=self,
+                                                    uuid=uuid,
+                                                    destination=destination,
+                                                    actions=json.dumps(actions),
+                                                    x=x, y=y))
+
+            if new_actionsets:
+                ActionSet.objects.bulk_create(new_actionsets)
+                for actionset in ActionSet.objects.filter(flow=self, uuid__in=[_.uuid for _ in new_actionsets]):
+                    existing_actionsets[actionset.uuid] = actionset
+
+            # now remove any objects no longer used in this flow, all at once
+            removed_actionsets = [node_uuid for node_uuid in existing_actionsets.keys() if not node_uuid in seen]
+            if removed_actionsets:
+                ActionSet.objects.filter(flow=self, uuid__in=removed_actionsets).delete()
+                for node_uuid in removed_actionsets:
+                    del existing_actionsets[node_uuid]
+
+            removed_rulesets = [node_uuid for node_uuid in existing_rulesets.keys() if not node_uuid in seen]
+            if removed_rulesets:
+                # clean up any values on these rulesets
+                removed_ids = [existing_rulesets[node_uuid].pk for node_uuid in removed_rulesets]
+                Value.objects.filter(ruleset__in=removed_ids, org=self.org).delete()
+
+                RuleSet.objects.filter(pk__in=removed_ids).delete()
+                for node_uuid in removed_rulesets:
+                    del existing_rulesets[node_uuid]
 
             # make sure all destinations are present though
             for destination in destinations:
@@ -2124,7 +2305,7 @@ class Flow(TembaModel, SmartModel):
             if user is None:
                 user = self.created_by
 
-            self.versions.create(definition=json.dumps(json_dict), created_by=user, modified_by=user)
+            FlowVersion.create_version(self, json_dict, user)
 
             return dict(status="success", description="Flow Saved", saved_on=datetime_to_str(self.saved_on))
 
@@ -2267,19 +2448,53 @@ class RuleSet(models.Model):
         # otherwise, looks like we don't need it
         return False
 
-    def find_matching_rule(self, step, run, event):
+    def has_async_webhook(self, run):
+        """
+        Whether our webhook should be called asynchronously for the passed in run, simulations always
+        call webhooks inline so they can show the results immediately
+        """
+        return self.webhook_url and settings.FLOW_WEBHOOKS_ASYNC and not run.contact.is_test
+
+    def park_run(self, step, run, msg):
+        """
+        Parks the passed in run at this ruleset and queues up the call to our webhook, the run resumes
+        once that returns or times out
+        """
+        # the message now belongs to this flow
+        if msg.id > 0:
+            step.add_message(msg)
+
+        run.start_waiting_on_webhook(step)
+
+        task = dict(ruleset=self.pk, step=step.pk, msg=msg.id, text=msg.text)
+        push_task(run.flow.org, settings.FLOW_WEBHOOK_QUEUE, CALL_FLOW_WEBHOOK_TASK, task)
+
+    def call_webhook(self, run, event, context=None, results=None):
+        from temba.api.models import WebHookEvent
+
+        if results is None:
+            results = run.flow.get_results(run.contact, only_last_run=True)
+
+        if context is None:
+            context = run.flow.build_message_context(run.contact, event, results=results)
+
+        (value, missing) = Msg.substitute_variables(self.webhook_url, run.contact, context,
+                                                    org=run.flow.org, url_encode=True)
+        WebHookEvent.trigger_flow_event(value, self.flow, run, self,
+                                        run.contact, event, self.webhook_action, results=results)
+
+    def find_matching_rule(self, step, run, event, call_webhook=True):
         orig_text = event.text
-        context = run.flow.build_message_context(run.contact, event)
 
-        if self.webhook_url:
-            from temba.api.models import WebHookEvent
-            (value, missing) = Msg.substitute_variables(self.webhook_url, run.contact, context,
-                                                        org=run.flow.org, url_encode=True)
-            WebHookEvent.trigger_flow_event(value, self.flow, run, self,
-                                            run.contact, event, self.webhook_action)
+        # our results are shared by our context and our webhook, so only fetch them once
+        results = run.flow.get_results(run.contact, only_last_run=True)
+        context = run.flow.build_message_context(run.contact, event, results=results)
+
+        if self.webhook_url and call_webhook:
+            self.call_webhook(run, event, context, results=results)
 
             # rebuild our context again, the webhook may have populated something
-            context = run.flow.build_message_context(run.contact, event)
+            context = run.flow.build_message_context(run.contact, event, results=results)
 
         # if we have a custom operand, figure that out
         if self.operand:
@@ -2300,7 +2515,10 @@ class RuleSet(models.Model):
 
         return None, None
 
-    def save_run_value(self, run, rule, value, recording=False):
+    def save_run_value(self, run, rule, value, recording=False, step=None, text=None):
+        # keep the denormalized results on our run up to date
+        run.save_result(self, rule, value, text, arrived_on=step.arrived_on if step else None)
+
         value = unicode(value)[:640]
         location_value = None
         dec_value = None
@@ -2441,13 +2659,105 @@ class ActionSet(models.Model):
 
 class FlowVersion(SmartModel):
     """
-    JSON definitions for previous flow versions
+    JSON definitions for previous flow versions. Most versions only store a compressed delta against the version
+    before them, with a full snapshot of the definition stored every FLOW_VERSION_SNAPSHOT_INTERVAL versions.
     """
     flow = models.ForeignKey(Flow, related_name='versions')
     definition = models.TextField(help_text=_("The JSON flow definition"))
 
-    def as_json(self):
-        return dict(user=dict(email=self.created_by.username, name=self.created_by.get_full_name()), created_on=datetime_to_str(self.created_on), definition=json.loads(self.definition))
+    is_delta = models.BooleanField(default=False,
+                                   help_text=_("Whether our definition is a compressed delta against the previous version"))
+
+    @classmethod
+    def create_version(cls, flow, definition, user):
+        """
+        Creates a new version of the passed in flow, storing a delta against the last version when we can
+        """
+        last_snapshot = flow.versions.filter(is_delta=False).order_by('-pk').first()
+
+        if last_snapshot and flow.versions.filter(pk__gt=last_snapshot.pk).count() < FLOW_VERSION_SNAPSHOT_INTERVAL - 1:
+            previous = flow.versions.order_by('-pk').first().get_definition()
+
+            # if our previous version can't be rebuilt, start again with a new snapshot
+            if previous is not None:
+                delta = FlowVersion.diff_definitions(previous, definition)
+                return flow.versions.create(definition=base64.b64encode(zlib.compress(json.dumps(delta))),
+                                            is_delta=True, created_by=user, modified_by=user)
+
+        return flow.versions.create(definition=json.dumps(definition), created_by=user, modified_by=user)
+
+    @classmethod
+    def diff_definitions(cls, old, new):
+        """
+        Builds the delta between two flow definitions. Nodes are diffed by uuid, everything else is copied as is.
+        """
+        delta = dict()
+        for key, value in new.items():
+            if key in (Flow.ACTION_SETS, Flow.RULE_SETS):
+                old_nodes = dict((node[Flow.UUID], node) for node in old.get(key, []))
+                changed = dict((node[Flow.UUID], node) for node in value if old_nodes.get(node[Flow.UUID]) != node)
+                delta[key] = dict(order=[node[Flow.UUID] for node in value], changed=changed)
+            else:
+                delta[key] = value
+
+        return delta
+
+    @classmethod
+    def apply_delta(cls, old, delta):
+        """
+        Applies a delta built by diff_definitions to the old definition, returning the new one
+        """
+        definition = dict()
+        for key, value in delta.items():
+            if key in (Flow.ACTION_SETS, Flow.RULE_SETS):
+                old_nodes = dict((node[Flow.UUID], node) for node in old.get(key, []))
+                definition[key] = [value['changed'].get(uuid, old_nodes.get(uuid)) for uuid in value['order']]
+            else:
+                definition[key] = value
+
+        return definition
+
+    @classmethod
+    def get_definitions(cls, flow, versions):
+        """
+        Rebuilds the definitions of the passed in versions of a flow, keyed by version id. Each delta is only applied
+        once, walking forward from the last snapshot before the oldest version. Versions which can't be rebuilt, i.e.
+        deltas with no snapshot before them, map to None.
+        """
+        wanted = set(version.pk for version in versions)
+        definitions = dict()
+        if not wanted:
+            return definitions
+
+        # start from the last snapshot at or before our oldest version, if there is one
+        snapshot = flow.versions.filter(is_delta=False, pk__lte=min(wanted)).order_by('-pk').first()
+        sequence = flow.versions.filter(pk__lte=max(wanted)).order_by('pk')
+        sequence = sequence.filter(pk__gte=snapshot.pk) if snapshot else sequence.filter(pk__gte=min(wanted))
+
+        definition = None
+        for version in sequence:
+            if not version.is_delta:
+                definition = json.loads(version.definition)
+            elif definition is not None:
+                delta = json.loads(zlib.decompress(base64.b64decode(version.definition)))
+                definition = FlowVersion.apply_delta(definition, delta)
+
+            if version.pk in wanted:
+                definitions[version.pk] = definition
+
+        return definitions
+
+    def get_definition(self):
+        if not self.is_delta:
+            return json.loads(self.definition)
+
+        return FlowVersion.get_definitions(self.flow, [self])[self.pk]
+
+    def as_json(self, definition=None):
+        if definition is None:
+            definition = self.get_definition()
+
+        return dict(user=dict(email=self.created_by.username, name=self.created_by.get_full_name()), created_on=datetime_to_str(self.created_on), definition=definition)
 
 RULE_SET = 'R'
 ACTION_SET = 'A'
@@ -2482,9 +2792,13 @@ class FlowRun(models.Model):
     start = models.ForeignKey('flows.FlowStart', null=True, blank=True, related_name='runs',
                               help_text=_("The FlowStart objects that started this run"))
 
+    results = models.TextField(blank=True, null=True,
+                               help_text=_("A JSON representation of the latest result for each ruleset in this run"))
+
     @classmethod
     def create(cls, flow, contact, start=None, call=None, fields=None, created_on=None, db_insert=True):
-        args = dict(flow=flow, contact=contact, start=start, call=call, fields=fields)
+        # new runs start with no results, only runs which predate our results column have none at all
+        args = dict(flow=flow, contact=contact, start=start, call=call, fields=fields, results=dict_to_json(dict()))
 
         if created_on:
             args['created_on'] = created_on
@@ -2590,6 +2904,71 @@ class FlowRun(models.Model):
         # lastly delete ourselves
         self.delete()
 
+    @classmethod
+    def bulk_release(cls, runs):
+        """
+        Deletes all runs in the given queryset along with their steps, in batches of set-based deletes rather than one
+        by one. The cached stats of affected flows are decremented for each batch from a few grouped queries.
+        Returns the number of runs deleted.
+        """
+        from temba.ivr.models import IVRAction
+
+        step_table = FlowStep._meta.db_table
+        step_messages_table = FlowStep.messages.through._meta.db_table
+
+        released = 0
+
+        cursor = connection.cursor()
+        remaining = runs.order_by('pk').values_list('pk', flat=True)
+        while True:
+            batch = list(remaining[:RELEASE_RUN_BATCH_SIZE])
+            if not batch:
+                break
+
+            # gather what these runs contributed to the stats of their flows before they're gone
+            flow_runs = defaultdict(dict)
+            for run_id, flow_id, contact_id in FlowRun.objects.filter(pk__in=batch, contact__is_test=False)\
+                    .values_list('pk', 'flow', 'contact'):
+                flow_runs[flow_id][run_id] = contact_id
+
+            stats_run_ids = [run_id for run_contacts in flow_runs.values() for run_id in run_contacts]
+            stats_steps = FlowStep.objects.filter(run__in=stats_run_ids).order_by()
+            flow_visits = defaultdict(dict)
+            for step in stats_steps.exclude(next_uuid=None).values('run__flow', 'step_type', 'step_uuid', 'rule_uuid',
+                                                                   'next_uuid').annotate(count=Count('pk')):
+                if step['step_type'] == RULE_SET:
+                    if not step['rule_uuid']:
+                        continue
+                    visit_key = '%s:%s' % (step['rule_uuid'], step['next_uuid'])
+                else:
+                    visit_key = '%s:%s' % (step['step_uuid'], step['next_uuid'])
+
+                visits = flow_visits[step['run__flow']]
+                visits[visit_key] = visits.get(visit_key, 0) + step['count']
+
+            flow_rule_counts = defaultdict(dict)
+            for step in stats_steps.filter(step_type=RULE_SET).exclude(rule_uuid=None)\
+                    .values('run__flow', 'rule_uuid').annotate(count=Count('run', distinct=True)):
+                flow_rule_counts[step['run__flow']][step['rule_uuid']] = step['count']
+
+            # actions of voice steps go with their steps, as they would when a step is deleted
+            IVRAction.objects.filter(step__run__in=batch).delete()
+
+            cursor.execute('DELETE FROM %s WHERE flowstep_id IN (SELECT id FROM %s WHERE run_id = ANY(%%s))'
+                           % (step_messages_table, step_table), [batch])
+            cursor.execute('DELETE FROM %s WHERE run_id = ANY(%%s)' % step_table, [batch])
+
+            ActionLog.objects.filter(run__in=batch).delete()
+            Value.objects.filter(run__in=batch).update(run=None)
+
+            cursor.execute('DELETE FROM %s WHERE id = ANY(%%s)' % FlowRun._meta.db_table, [batch])
+            released += cursor.rowcount
+
+            for flow in Flow.objects.filter(pk__in=flow_runs.keys()):
+                flow.remove_released_runs(flow_runs[flow.pk], flow_visits[flow.pk], flow_rule_counts[flow.pk])
+
+        return released
+
     def set_completed(self, complete=True):
         """
         Mark a run as complete. Runs can become incomplete at a later
@@ -2621,6 +3000,77 @@ class FlowRun(models.Model):
     def expire(self):
         self.do_expire_runs(FlowRun.objects.filter(pk=self.pk))
 
+    def start_waiting_on_webhook(self, step):
+        r = get_redis_connection()
+        r.set(FLOW_WEBHOOK_WAIT_KEY % self.pk, step.pk, FLOW_WEBHOOK_WAIT_TTL)
+
+    def stop_waiting_on_webhook(self):
+        r = get_redis_connection()
+        r.delete(FLOW_WEBHOOK_WAIT_KEY % self.pk)
+
+    def is_waiting_on_webhook(self):
+        r = get_redis_connection()
+        return r.exists(FLOW_WEBHOOK_WAIT_KEY % self.pk)
+
+    def lock_on_webhook(self):
+        """
+        Lock held while parking messages on this run, or while it resumes from its webhook
+        """
+        r = get_redis_connection()
+        return r.lock(FLOW_WEBHOOK_LOCK_KEY % self.pk, FLOW_LOCK_TTL)
+
+    def park_msg_on_webhook(self, msg):
+        """
+        Parks the passed in message until our webhook returns, returning False if we're no longer waiting on it.
+        Callers should hold our webhook lock.
+        """
+        if not self.is_waiting_on_webhook():
+            return False
+
+        r = get_redis_connection()
+        with r.pipeline() as pipe:
+            pipe.rpush(FLOW_WEBHOOK_PARKED_KEY % self.pk, msg.pk)
+            pipe.expire(FLOW_WEBHOOK_PARKED_KEY % self.pk, FLOW_WEBHOOK_PARKED_TTL)
+
+            # remember this run has parked messages in case its webhook never returns
+            pipe.sadd(FLOW_WEBHOOK_PARKED_RUNS_KEY, self.pk)
+            pipe.execute()
+        return True
+
+    def pop_msgs_parked_on_webhook(self):
+        """
+        Removes and returns the ids of any messages parked on this run. Callers should hold our webhook lock.
+        """
+        r = get_redis_connection()
+        with r.pipeline() as pipe:
+            pipe.lrange(FLOW_WEBHOOK_PARKED_KEY % self.pk, 0, -1)
+            pipe.delete(FLOW_WEBHOOK_PARKED_KEY % self.pk)
+            pipe.srem(FLOW_WEBHOOK_PARKED_RUNS_KEY, self.pk)
+            parked_ids = pipe.execute()[0]
+
+        return [int(msg_id) for msg_id in parked_ids]
+
+    @classmethod
+    def release_expired_webhook_waits(cls):
+        """
+        Handles the messages parked on runs which are no longer waiting on their webhook, i.e. because the webhook task
+        never resumed them before their wait expired
+        """
+        r = get_redis_connection()
+        for run_id in r.smembers(FLOW_WEBHOOK_PARKED_RUNS_KEY):
+            run = FlowRun.objects.filter(pk=int(run_id)).first()
+            if not run:
+                r.srem(FLOW_WEBHOOK_PARKED_RUNS_KEY, run_id)
+                continue
+
+            with run.lock_on_webhook():
+                if run.is_waiting_on_webhook():
+                    continue
+
+                parked_ids = run.pop_msgs_parked_on_webhook()
+
+            Flow.handle_parked_msgs(parked_ids)
+
     def update_fields(self, field_map):
         # validate our field
         (field_map, count) = FlowRun.normalize_fields(field_map)
@@ -2642,6 +3092,78 @@ class FlowRun(models.Model):
         else:
             return dict()
 
+    @classmethod
+    def build_result(cls, node, rule_uuid, category, rule_value, decimal_value, text, arrived_on, time):
+        return dict(node=node, rule_uuid=rule_uuid, category=category, rule_value=rule_value,
+                    decimal_value=decimal_value, text=text, arrived_on=arrived_on, time=time)
+
+    @classmethod
+    def build_step_results(cls, runs):
+        """
+        Builds a list of results for each of the passed in runs, one for every ruleset step in the order they were
+        arrived at. This is only needed for runs which predate our results column.
+        """
+        step_results = dict()
+        for run in runs:
+            step_results[run.pk] = []
+
+        if not step_results:
+            return step_results
+
+        steps = FlowStep.objects.filter(run__pk__in=step_results.keys(), step_type=RULE_SET).exclude(rule_uuid=None)
+        for step in steps.order_by('arrived_on').prefetch_related('messages'):
+            time = step.left_on if step.left_on else step.arrived_on
+            step_results[step.run_id].append(FlowRun.build_result(step.step_uuid, step.rule_uuid,
+                                                                  step.rule_category, step.rule_value,
+                                                                  step.rule_decimal_value, step.get_text(),
+                                                                  step.arrived_on, time))
+        return step_results
+
+    @classmethod
+    def build_results_from_steps(cls, runs):
+        """
+        Builds the results dictionary for each of the passed in runs by walking their ruleset steps. This is
+        only needed for runs which predate our results column, all others are maintained by save_result.
+        """
+        run_results = dict()
+        for run_pk, step_results in FlowRun.build_step_results(runs).iteritems():
+            # later visits to a ruleset replace earlier ones
+            run_results[run_pk] = {result['node']: result for result in step_results}
+
+        return run_results
+
+    def get_results_dict(self):
+        """
+        Returns the latest result for each ruleset in this run, keyed by ruleset uuid
+        """
+        if self.results is None:
+            return FlowRun.build_results_from_steps([self])[self.pk]
+
+        results = json.loads(self.results)
+        for result in results.values():
+            result['arrived_on'] = json_date_to_datetime(result['arrived_on'][:-1])
+            result['time'] = json_date_to_datetime(result['time'][:-1])
+            if result['decimal_value'] is not None:
+                result['decimal_value'] = Decimal(result['decimal_value'])
+
+        return results
+
+    def save_result(self, ruleset, rule, value, text, arrived_on=None):
+        """
+        Records the latest result for the passed in ruleset, we only keep one result per ruleset
+        """
+        results = self.get_results_dict()
+
+        now = timezone.now()
+        decimal_value = value if isinstance(value, Decimal) else None
+        rule_value = unicode(value)[:640] if value is not None else ''
+
+        results[ruleset.uuid] = FlowRun.build_result(ruleset.uuid, rule.uuid, rule.category, rule_value,
+                                                     decimal_value, text, arrived_on if arrived_on else now, now)
+
+        self.results = dict_to_json(results)
+        self.save(update_fields=['results'])
+
     def is_completed(self):
         """
         Whether this run has reached the terminal node in the flow
@@ -3046,10 +3568,14 @@ class FlowStep(models.Model):
         if not self.contact.is_test:
             self.run.flow.remove_visits_for_step(self)
 
+            # if this was the last time our run matched this rule, it no longer counts towards it
+            if self.rule_uuid and not self.is_repeat_rule_match(self.run, self.rule_uuid, released=True):
+                self.run.flow.update_rule_count(self.rule_uuid, -1)
+
         # finally delete us
         self.delete()
 
-    def save_rule_match(self, rule, value):
+    def save_rule_match(self, rule, value, run, is_test_contact):
         self.rule_category = rule.category
         self.rule_uuid = rule.uuid
 
@@ -3062,6 +3588,26 @@ class FlowStep(models.Model):
 
         self.save(update_fields=['rule_category', 'rule_uuid', 'rule_value', 'rule_decimal_value'])
 
+        # rule counts are by distinct run, so only count the first time our run matched this rule
+        if not is_test_contact and not self.is_repeat_rule_match(run, rule.uuid):
+            run.flow.update_rule_count(rule.uuid, 1)
+
+    def is_repeat_rule_match(self, run, rule_uuid, released=False):
+        """
+        Whether any other step in our run has matched the given rule. Our run's results tell us whether this is the
+        first visit to our ruleset or whether the last visit matched the same rule, so we only need to look at the
+        other steps when neither is the case. When we're being released our run's results may be our own, so then we
+        always look at the other steps.
+        """
+        if run.results is not None and not released:
+            previous = json.loads(run.results).get(self.step_uuid)
+            if not previous:
+                return False
+            elif previous['rule_uuid'] == rule_uuid:
+                return True
+
+        return FlowStep.objects.filter(run=self.run_id, rule_uuid=rule_uuid).exclude(pk=self.pk).exists()
+
     def response_to(self):
         if self.messages.all():
             msg = self.messages.all().first()
@@ -3383,10 +3929,12 @@ class APIAction(Action):
 
     def execute(self, run, actionset, sms):
         from temba.api.models import WebHookEvent
-        message_context = run.flow.build_message_context(run.contact, sms)
+        results = run.flow.get_results(run.contact, only_last_run=True)
+        message_context = run.flow.build_message_context(run.contact, sms, results=results)
         (value, missing) = Msg.substitute_variables(self.webhook, run.contact, message_context,
                                                     org=run.flow.org, url_encode=True)
-        WebHookEvent.trigger_flow_event(value, run.flow, run, actionset, run.contact, sms, self.action)
+        WebHookEvent.trigger_flow_event(value, run.flow, run, actionset, run.contact, sms, self.action,
+                                        results=results)
         return []
 
 
@@ -4005,7 +4553,7 @@ class SaveToContactAction(Action):
             contact.save(update_fields=['name'])
         else:
             new_value = value[:255]
-            contact.set_field(self.field, new_value)
+            contact.set_fields({self.field: new_value})
 
         self.logger(run, new_value)
 
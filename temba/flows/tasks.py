@@ -5,7 +5,7 @@ from djcelery_transactions import task
 from temba.utils.queues import pop_task
 from temba.contacts.models import Contact
 from temba.msgs.models import Broadcast, Msg
-from temba.flows.models import FlowCache
+from temba.flows.models import FlowCache, CALL_FLOW_WEBHOOK_TASK
 from redis_cache import get_redis_connection
 from .models import EmailAction, ExportFlowResultsTask, Flow, FlowStart, FlowRun, FlowStep
 
@@ -34,6 +34,9 @@ def check_flows_task():
     """
     FlowRun.do_expire_runs(FlowRun.objects.filter(is_active=True, expires_on__lte=timezone.now()))
 
+    # handle messages parked on runs whose webhook never returned
+    FlowRun.release_expired_webhook_waits()
+
 
 @task(track_started=True, name='export_flow_results_task')
 def export_flow_results_task(id):
@@ -87,6 +90,20 @@ def start_msg_flow_batch_task():
         traceback.print_exc(e)
         logger.exception("Error starting flow: %s" % id)
 
+@task(track_started=True, name='call_flow_webhook')
+def call_flow_webhook_task():
+    logger = call_flow_webhook_task.get_logger()
+
+    # pop off the next webhook call
+    task = pop_task(CALL_FLOW_WEBHOOK_TASK)
+    if task is None:
+        return
+
+    try:
+        Flow.resume_webhook_ruleset(task['ruleset'], task['step'], task['msg'], task['text'])
+    except Exception:
+        logger.exception("Error calling flow webhook for step: %d" % task['step'])
+
 @task(track_started=True, name="check_flow_stats_accuracy_task")
 def check_flow_stats_accuracy_task(flow_id):
     logger = start_flow_task.get_logger()
@@ -12,6 +12,7 @@ from smartmin.tests import SmartminTest
 
 
 from django.db import connection
+from django.test.utils import override_settings
 from mock import patch
 from temba.msgs.models import INCOMING, SMS_NORMAL_PRIORITY, SMS_HIGH_PRIORITY, Label
 from temba.triggers.models import Trigger
@@ -20,6 +21,7 @@ from temba.utils import datetime_to_str
 from .models import *
 from temba.orgs.models import Language
 import datetime
+import copy
 
 def uuid(id):
     return '00000000-00000000-00000000-%08d' % id
@@ -86,6 +88,43 @@ class RuleTest(TembaTest):
         self.assertEquals(2, versions.count())
         self.assertEquals(versions[0].created_by, self.root)
 
+    def test_version_deltas(self):
+        # save our flow a number of times, moving a node and adding and removing another along the way
+        definitions = []
+        for i in range(FLOW_VERSION_SNAPSHOT_INTERVAL + 2):
+            definition = copy.deepcopy(self.definition)
+            definition['action_sets'][0]['x'] = i
+            if i % 2:
+                definition['action_sets'].append(dict(uuid=uuid(6), x=6, y=6, destination=None,
+                                                      actions=[dict(type='reply', msg='Goodbye')]))
+
+            self.flow.update(definition)
+            definitions.append(json.loads(json.dumps(definition)))
+
+        # only our first version and every interval after it are full snapshots
+        versions = self.flow.versions.all().order_by('pk')
+        self.assertEquals(len(definitions), versions.count())
+        self.assertEquals([False] + [True] * (FLOW_VERSION_SNAPSHOT_INTERVAL - 1) + [False, True],
+                          [version.is_delta for version in versions])
+
+        # but each can be rebuilt into the definition that was saved
+        for version, definition in zip(versions, definitions):
+            self.assertEquals(definition, version.get_definition())
+
+        # including all at once, as for our versions list
+        rebuilt = FlowVersion.get_definitions(self.flow, versions)
+        self.assertEquals(definitions, [rebuilt[version.pk] for version in versions])
+
+        # deltas which have lost the snapshot before them can't be rebuilt
+        versions[0].delete()
+        self.assertIsNone(versions[1].get_definition())
+        self.assertEquals(definitions[-1], versions.last().get_definition())
+
+        # our nodes reflect the last save
+        self.assertEquals(5, self.flow.action_sets.count())
+        self.assertEquals(FLOW_VERSION_SNAPSHOT_INTERVAL + 1, self.flow.action_sets.get(uuid=uuid(1)).x)
+        self.assertEquals(1, self.flow.rule_sets.count())
+
     def test_flow_lists(self):
 
         self.login(self.admin)
@@ -2155,8 +2194,16 @@ class FlowsTest(FlowFileTest):
         self.assertEquals(1, flow.get_completed_runs())
         self.assertEquals(50, flow.get_completed_percentage())
 
+        # our cached rule counts should match those calculated from the database
+        rule_counts = flow.get_rule_counts()
+        self.assertEquals(rule_counts, flow.get_rule_counts(cached=True))
+
+        # each run is only counted once per rule, even though our contact matched other twice
+        self.assertEquals(2, len([count for count in rule_counts.values() if count == 2]))
+
         # rebuild our flow stats and make sure they are the same
         flow.do_calculate_flow_stats()
+        self.assertEquals(rule_counts, flow.get_rule_counts(cached=True))
         (active, visited) = flow.get_activity()
         self.assertEquals(2, len(active))
         self.assertEquals(3, visited[other_rule_to_msg])
@@ -2195,6 +2242,9 @@ class FlowsTest(FlowFileTest):
         self.assertEquals(1, flow.get_total_runs())
         self.assertEquals(1, flow.get_total_contacts())
 
+        # and his matches no longer count towards our categories
+        self.assertEquals(flow.get_rule_counts(), flow.get_rule_counts(cached=True))
+
         # he was also accounting for our completion rate, back to nothing
         self.assertEquals(0, flow.get_completed_runs())
         self.assertEquals(0, flow.get_completed_percentage())
@@ -2233,8 +2283,18 @@ class FlowsTest(FlowFileTest):
         self.assertEquals(2, visited[msg_to_color_step])
         self.assertEquals(2, visited[other_rule_to_msg])
 
+        # releasing a run takes its rule matches out of our cached counts
+        ryan_run = FlowRun.objects.get(contact=ryan)
+        ryan_rules = set(ryan_run.steps.exclude(rule_uuid=None).values_list('rule_uuid', flat=True))
+        rule_counts = flow.get_rule_counts(cached=True)
+        self.assertTrue(ryan_rules)
+        self.assertTrue(all(rule_counts[rule_uuid] == 1 for rule_uuid in ryan_rules))
+
         # delete our last contact to make sure activity is gone without first expiring, zeros abound
         ryan.release()
+        rule_counts = flow.get_rule_counts(cached=True)
+        self.assertTrue(all(rule_counts[rule_uuid] == 0 for rule_uuid in ryan_rules))
+        self.assertEquals({}, flow.get_rule_counts())
         (active, visited) = flow.get_activity()
         self.assertEquals(0, len(active))
         self.assertEquals(0, visited[msg_to_color_step])
@@ -2491,6 +2551,59 @@ class FlowsTest(FlowFileTest):
         flow = self.update_flow(flow, 'pick_a_number')
         self.assertIsNone(flow.rule_sets.all()[0].webhook_url)
 
+    @override_settings(FLOW_WEBHOOKS_ASYNC=True)
+    def test_async_webhook(self):
+        flow = self.get_flow('preprocess')
+
+        # with our webhook call queued instead of made, our message is handled but not replied to yet
+        with patch('temba.flows.models.push_task') as push_task:
+            self.assertIsNone(self.send_message(flow, "3", assert_reply=False))
+
+        run = FlowRun.objects.get(flow=flow, contact=self.contact)
+        self.assertTrue(run.is_waiting_on_webhook())
+
+        # messages which arrive while our run waits are parked
+        other = self.create_msg(direction=INCOMING, contact=self.contact, text="4")
+        self.assertTrue(Flow.find_and_handle(other))
+
+        # once the webhook is called, our run picks up where it was parked and then handles the parked message
+        task = push_task.call_args[0][3]
+        with patch.object(Msg, 'process_message') as process_message:
+            self.assertTrue(Flow.resume_webhook_ruleset(task['ruleset'], task['step'], task['msg'], task['text']))
+            self.assertEquals([other], [call[0][0] for call in process_message.call_args_list])
+
+        self.assertFalse(run.is_waiting_on_webhook())
+        self.assertEquals("You picked 3!", Msg.objects.get(response_to=task['msg']).text)
+
+        # if our run has moved on by the time a webhook task runs, e.g. because it waited longer than our wait, its
+        # message is handled from wherever the run is now
+        with patch.object(Msg, 'process_message') as process_message:
+            self.assertFalse(Flow.resume_webhook_ruleset(task['ruleset'], task['step'], task['msg'], task['text']))
+            self.assertEquals([task['msg']], [call[0][0].pk for call in process_message.call_args_list])
+
+    @override_settings(FLOW_WEBHOOKS_ASYNC=True)
+    def test_async_webhook_never_returns(self):
+        flow = self.get_flow('preprocess')
+
+        with patch('temba.flows.models.push_task'):
+            self.assertIsNone(self.send_message(flow, "3", assert_reply=False))
+
+        run = FlowRun.objects.get(flow=flow, contact=self.contact)
+        other = self.create_msg(direction=INCOMING, contact=self.contact, text="4")
+        self.assertTrue(Flow.find_and_handle(other))
+
+        # nothing happens to parked messages while we're still waiting
+        with patch.object(Msg, 'process_message') as process_message:
+            FlowRun.release_expired_webhook_waits()
+            self.assertFalse(process_message.called)
+
+        # but once our wait expires without the webhook task resuming us, they are handled, and only once
+        run.stop_waiting_on_webhook()
+        with patch.object(Msg, 'process_message') as process_message:
+            FlowRun.release_expired_webhook_waits()
+            FlowRun.release_expired_webhook_waits()
+            self.assertEquals([other], [call[0][0] for call in process_message.call_args_list])
+
     def test_flow_loops(self):
         # this tests two flows that start each other
         flow1 = self.create_flow()
@@ -2705,6 +2818,24 @@ class DuplicateValueTest(FlowFileTest):
         value = Value.objects.get(run=run)
         self.assertEquals("Red", value.category)
 
+        # our run should likewise only keep the latest result for the ruleset
+        run = FlowRun.objects.get(pk=run.pk)
+        results = run.get_results_dict()
+        self.assertEquals(1, len(results))
+        self.assertEquals("Red", results[value.ruleset.uuid]['category'])
+        self.assertEquals("red", results[value.ruleset.uuid]['text'])
+
+        values = flow.get_results(self.contact)[0]['values']
+        self.assertEquals(1, len(values))
+        self.assertEquals("Red", values[0]['category'])
+        self.assertEquals("red", values[0]['text'])
+
+        # runs which predate our results get the same results built from their steps
+        FlowRun.objects.filter(pk=run.pk).update(results=None)
+        legacy_values = flow.get_results(self.contact)[0]['values']
+        self.assertEquals([(v['node'], v['category'], v['text'], v['value']) for v in values],
+                          [(v['node'], v['category'], v['text'], v['value']) for v in legacy_values])
+
 class WebhookLoopTest(FlowFileTest):
 
     def setUp(self):
@@ -34,7 +34,7 @@ from temba.msgs.views import BaseActionForm
 from temba.triggers.models import Trigger, KEYWORD_TRIGGER
 from temba.utils import analytics, build_json_response
 from temba.values.models import Value
-from .models import FlowStep, RuleSet, ActionLog, ExportFlowResultsTask, FlowLabel, COMPLETE, FAILED, FlowStart
+from .models import FlowStep, RuleSet, ActionLog, ExportFlowResultsTask, FlowLabel, COMPLETE, FAILED, FlowStart, FlowVersion
 
 def flow_unread_response_count_processor(request):
     """
@@ -437,7 +437,11 @@ class FlowCRUDL(SmartCRUDL):
     class Versions(OrgObjPermsMixin, SmartReadView):
         def get(self, request, *args, **kwargs):
             flow = self.get_object()
-            versions = [version.as_json() for version in flow.versions.all().order_by('-created_on')[:25]]
+            versions = list(flow.versions.all().order_by('-pk').select_related('created_by')[:25])
+
+            # rebuild all of their definitions in one pass, skipping any that can't be rebuilt
+            definitions = FlowVersion.get_definitions(flow, versions)
+            versions = [version.as_json(definitions[version.pk]) for version in versions if definitions[version.pk] is not None]
             return build_json_response(versions)
 
     class OrgQuerysetMixin(object):
@@ -1082,7 +1086,7 @@ class FlowCRUDL(SmartCRUDL):
                         context['contact'] = contact
 
                 else:
-                    context['counts'] = self.object.get_ruleset_category_counts()
+                    context['counts'] = self.object.get_ruleset_category_counts(cached=True)
 
                 return super(FlowCRUDL.Results, self).render_to_response(context, **response_kwargs)
 
@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+import hashlib
 import json
 import logging
 import os
@@ -9,6 +10,7 @@ import string
 import time
 import traceback
 
+from collections import defaultdict
 from datetime import datetime, timedelta
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -21,13 +23,14 @@ from django.db.models import Q, Count
 from django.utils import timezone
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.utils.html import escape
+from redis_cache import get_redis_connection
 from smartmin.models import SmartModel
 from temba.contacts.models import Contact, ContactGroup, ContactURN, TEL_SCHEME
-from temba.orgs.models import Org, OrgAssetMixin, OrgEvent, TopUp, ORG_DISPLAY_CACHE_TTL
+from temba.orgs.models import Org, OrgAssetMixin, OrgEvent, OrgFolder, TopUp, UncreditedUsage, ORG_DISPLAY_CACHE_TTL
 from temba.channels.models import Channel, ANDROID, SEND
 from temba.schedules.models import Schedule
 from temba.temba_email import send_temba_email
-from temba.utils import get_datetime_format, datetime_to_str, analytics, get_preferred_language
+from temba.utils import get_datetime_format, datetime_to_str, datetime_to_ms, analytics, get_preferred_language
 from temba.utils.cache import get_cacheable_result, incrby_existing
 from temba.utils.parser import evaluate_template, EvaluationContext
 from temba.utils.queues import DEFAULT_PRIORITY, push_task, LOW_PRIORITY, HIGH_PRIORITY
@@ -40,9 +43,43 @@ __message_handlers = None
 
 MSG_QUEUE = 'msgs'
 SEND_MSG_TASK = 'send_msg_task'
+SEND_BROADCAST_BATCH_TASK = 'send_broadcast_batch'
 
 BATCH_SIZE = 500
 
+# broadcasts to at least this many recipients are sent in batches of this size by parallel tasks
+SEND_BROADCAST_BATCH_SIZE = 1000
+BROADCAST_BATCHES_REMAINING_KEY = 'broadcast:%d:batches_remaining'
+BROADCAST_BATCHES_REMAINING_TTL = 60 * 60 * 24  # 1 day, so counters of lost batches don't stay around forever
+
+# how many messages we release at once in bulk releases
+RELEASE_BATCH_SIZE = 1000
+
+MSG_LOOP_CACHE_KEY = 'msg_loop:%d:%d:%s'
+
+# keeps a sliding window of the times identical messages were sent, as a sorted set. Returns the (1-based) index of
+# the first window / limit pair which has already been reached, or 0 after adding this message to the window.
+MSG_LOOP_LUA = """
+local key, now, member = KEYS[1], tonumber(ARGV[1]), ARGV[2]
+
+local longest = 0
+for i = 3, #ARGV, 2 do
+  longest = math.max(longest, tonumber(ARGV[i]))
+end
+
+redis.call('zremrangebyscore', key, '-inf', now - longest)
+
+for i = 3, #ARGV, 2 do
+  if redis.call('zcount', key, now - tonumber(ARGV[i]), '+inf') >= tonumber(ARGV[i + 1]) then
+    return (i - 1) / 2
+  end
+end
+
+redis.call('zadd', key, now, member)
+redis.call('pexpire', key, longest)
+return 0
+"""
+
 INITIALIZING = 'I'
 PENDING = 'P'
 QUEUED = 'Q'
@@ -328,14 +365,20 @@ class Broadcast(models.Model):
         return commands
 
     def send(self, trigger_send=True, message_context=None, response_to=None, status=PENDING,
-             created_on=None, base_language=None, partial_recipients=None):
+             created_on=None, base_language=None, partial_recipients=None, priority=None):
         """
-        Sends this broadcast by creating outgoing messages for each recipient.
+        Sends this broadcast by creating outgoing messages for each recipient. Unless a priority is given, it is based
+        on the number of recipients.
         """
         # cannot ask for sending by us AND specify a created on, blow up in that case
         if trigger_send and created_on:
             raise Exception("Cannot trigger send and specify a created_on, breaks creating batches")
 
+        # large broadcasts are split into batches which are sent in parallel
+        if not partial_recipients and not message_context and not response_to and not created_on \
+                and self.recipient_count >= SEND_BROADCAST_BATCH_SIZE:
+            return self.send_batched(trigger_send=trigger_send, status=status, base_language=base_language)
+
         if partial_recipients:
             # if flow is being started, it'll provide a batch of unique contacts itself
             urns, contacts = partial_recipients
@@ -353,11 +396,8 @@ class Broadcast(models.Model):
         batch = []
 
         # our priority is based on the number of recipients
-        priority = SMS_NORMAL_PRIORITY
-        if len(recipients) == 1:
-            priority = SMS_HIGH_PRIORITY
-        elif len(recipients) >= BULK_THRESHOLD:
-            priority = SMS_BULK_PRIORITY
+        if priority is None:
+            priority = Broadcast.get_priority(len(recipients))
 
         # determine our preferred languages
         preferred_languages = []
@@ -373,22 +413,39 @@ class Broadcast(models.Model):
         # pre-fetch channels to reduce database hits
         org = Org.objects.filter(pk=self.org.id).prefetch_related('channels').first()
 
-        for recipient in recipients:
-            text = self.text
+        # parse our translations once, and only pick the text for each contact language once
+        language_dict = json.loads(self.language_dict) if self.language_dict else None
+        texts_by_language = dict()
 
-            if self.language_dict:
+        def get_recipient_text(recipient):
+            if not language_dict:
+                return self.text
 
-                # prepend the contact language if we have one
-                if isinstance(recipient, Contact) and recipient.language:
-                    preferred_languages.insert(0, recipient.language)
+            # prefer the contact language if we have one
+            language = recipient.language if isinstance(recipient, Contact) else None
+            if language not in texts_by_language:
+                languages = [language] + preferred_languages if language else preferred_languages
+                texts_by_language[language] = get_preferred_language(language_dict, languages)
 
-                text = get_preferred_language(json.loads(self.language_dict), preferred_languages)
+            return texts_by_language[language]
 
+        # the date part of the context is the same for every recipient, so only build it once
+        date_context = Msg.build_date_context(org.get_dayfirst(), org.get_tzinfo())
+
+        def commit_batch(batch):
+            # pay for all the messages in the batch at once
+            paid = [msg for msg in batch if not msg.contact.is_test]
+            for msg, topup_id in zip(paid, org.allocate_credits(len(paid))):
+                msg.topup_id = topup_id
+
+            Msg.objects.bulk_create(batch)
+
+        for recipient in recipients:
             try:
                 msg = Msg.create_outgoing(org,
                                           self.created_by,
                                           recipient,
-                                          text,
+                                          get_recipient_text(recipient),
                                           broadcast=self,
                                           channel=self.channel,
                                           response_to=response_to,
@@ -396,7 +453,8 @@ class Broadcast(models.Model):
                                           status=status,
                                           insert_object=False,
                                           priority=priority,
-                                          created_on=created_on)
+                                          created_on=created_on,
+                                          date_context=date_context)
 
             except UnreachableException:
                 # there was no way to reach this contact, do not create a message
@@ -408,7 +466,7 @@ class Broadcast(models.Model):
 
             # we commit our messages in batches
             if len(batch) >= BATCH_SIZE:
-                Msg.objects.bulk_create(batch)
+                commit_batch(batch)
 
                 # send any messages
                 if trigger_send:
@@ -421,7 +479,7 @@ class Broadcast(models.Model):
 
         # commit any remaining objects
         if batch:
-            Msg.objects.bulk_create(batch)
+            commit_batch(batch)
 
             if trigger_send:
                 self.org.trigger_send(Msg.objects.filter(broadcast=self, created_on=created_on).select_related('contact', 'contact_urn', 'channel'))
@@ -433,6 +491,85 @@ class Broadcast(models.Model):
             self.status = QUEUED if len(recipients) > 0 else SENT
             self.save(update_fields=('status',))
 
+    @classmethod
+    def get_priority(cls, recipient_count):
+        """
+        Gets the priority of the messages of a broadcast to the given number of recipients
+        """
+        if recipient_count == 1:
+            return SMS_HIGH_PRIORITY
+        elif recipient_count >= BULK_THRESHOLD:
+            return SMS_BULK_PRIORITY
+        else:
+            return SMS_NORMAL_PRIORITY
+
+    def send_batched(self, trigger_send=True, status=PENDING, base_language=None):
+        """
+        Sends this broadcast by splitting its recipients into batches which are pushed onto our task queue, so that
+        many workers can create and send its messages in parallel. The last batch to finish updates our status.
+        """
+        batches = []
+
+        # URNs are only ever added to a broadcast individually, so there are never many of them
+        urn_ids = list(self.urns.values_list('pk', flat=True))
+        if urn_ids:
+            batches.append(dict(urns=urn_ids, contacts=[]))
+
+        # read the ids of our contacts and the members of our groups in a single query, as sub-queries rather than a
+        # join so no distinct is needed, skipping any contacts already included by URN
+        group_members = ContactGroup.contacts.through.objects.filter(contactgroup__in=self.groups.all())
+        contacts = Contact.objects.filter(Q(pk__in=self.contacts.values_list('pk', flat=True)) |
+                                          Q(pk__in=group_members.values('contact_id')))
+        contacts = contacts.exclude(pk__in=self.urns.exclude(contact=None).values_list('contact_id', flat=True))
+
+        contact_ids = []
+        for contact_id in contacts.order_by('pk').values_list('pk', flat=True).iterator():
+            contact_ids.append(contact_id)
+
+            if len(contact_ids) >= SEND_BROADCAST_BATCH_SIZE:
+                batches.append(dict(urns=[], contacts=contact_ids))
+                contact_ids = []
+
+        if contact_ids:
+            batches.append(dict(urns=[], contacts=contact_ids))
+
+        if not batches:
+            self.status = SENT
+            self.save(update_fields=('status',))
+            return
+
+        # set our counter before pushing anything, as the batches may finish before we've pushed them all
+        r = get_redis_connection()
+        r.set(BROADCAST_BATCHES_REMAINING_KEY % self.pk, len(batches), BROADCAST_BATCHES_REMAINING_TTL)
+
+        # every batch uses the priority of the broadcast as a whole, not of its own size
+        priority = Broadcast.get_priority(self.recipient_count)
+
+        for batch in batches:
+            batch.update(broadcast=self.pk, trigger_send=trigger_send, status=status, base_language=base_language,
+                         priority=priority)
+            push_task(self.org, MSG_QUEUE, SEND_BROADCAST_BATCH_TASK, batch)
+
+    def send_batch(self, urn_ids, contact_ids, trigger_send=True, status=PENDING, base_language=None, priority=None):
+        """
+        Sends this broadcast to one batch of its recipients
+        """
+        try:
+            urns = list(ContactURN.objects.filter(pk__in=urn_ids).select_related('contact'))
+            contacts = list(Contact.objects.filter(pk__in=contact_ids))
+
+            self.send(trigger_send=trigger_send, status=status, base_language=base_language,
+                      partial_recipients=(urns, contacts), priority=priority)
+        finally:
+            # even a failed batch counts as finished, otherwise our status would never be updated
+            r = get_redis_connection()
+            remaining_key = BROADCAST_BATCHES_REMAINING_KEY % self.pk
+            if r.decr(remaining_key) <= 0:
+                r.delete(remaining_key)
+
+                self.status = QUEUED
+                self.save(update_fields=('status',))
+
     def update(self):
         """
         Check the status of our messages and update ours accordingly
@@ -898,7 +1035,11 @@ class Msg(models.Model, OrgAssetMixin):
                                     status=PENDING,
                                     broadcast=self.broadcast)
 
-        # mark ourselves as resent
+        # mark ourselves as resent, which takes us off our topup and leaves us uncredited
+        if self.topup_id:
+            TopUp.record_used(self.topup_id, -1)
+            UncreditedUsage.record_used(self.org_id, 1)
+
         self.status = RESENT
         self.topup = None
         self.visibility = ARCHIVED
@@ -988,11 +1129,11 @@ class Msg(models.Model, OrgAssetMixin):
         return msg
 
     @classmethod
-    def substitute_variables(cls, text, contact, message_context, org=None, url_encode=False):
+    def substitute_variables(cls, text, contact, message_context, org=None, url_encode=False, date_context=None):
         """
         Given input ```text```, tries to find variables in the format @foo.bar and replace them according to
         the passed in context, contact and org. If some variables are not resolved to values, then the variable
-        name will remain (ie, @foo.bar).
+        name will remain (ie, @foo.bar). A pre-built date context can be passed in when substituting many texts.
 
         Returns a tuple of the substituted text and whether there were are substitution failures.
         """
@@ -1001,7 +1142,8 @@ class Msg(models.Model, OrgAssetMixin):
         if not text or (text.find('@') < 0 and text.find('=') < 0):
             return text, False
 
-        if contact:
+        # only build the contact part of the context if the text might reference it
+        if contact and text.lower().find('contact') >= 0:
             message_context['contact'] = contact.build_message_context()
 
         if not org:
@@ -1011,16 +1153,7 @@ class Msg(models.Model, OrgAssetMixin):
             dayfirst = org.get_dayfirst()
             tz = org.get_tzinfo()
 
-        (format_date, format_time) = get_datetime_format(dayfirst)
-
-        date_context = dict()
-        date_context['__default__'] = datetime_to_str(timezone.now(), format=format_time, tz=tz)
-        date_context['now'] = datetime_to_str(timezone.now(), format=format_time, tz=tz)
-        date_context['today'] = datetime_to_str(timezone.now(), format=format_date, tz=tz)
-        date_context['tomorrow'] = datetime_to_str(timezone.now() + timedelta(days=1), format=format_date, tz=tz)
-        date_context['yesterday'] = datetime_to_str(timezone.now() - timedelta(days=1), format=format_date, tz=tz)
-
-        message_context['date'] = date_context
+        message_context['date'] = date_context if date_context else cls.build_date_context(dayfirst, tz)
 
         context = EvaluationContext(message_context, dict(tz=tz, dayfirst=dayfirst))
 
@@ -1029,9 +1162,26 @@ class Msg(models.Model, OrgAssetMixin):
         # currently we throw away the actual error messages from the parser
         return evaluated, (len(errors) > 0)
 
+    @classmethod
+    def build_date_context(cls, dayfirst, tz):
+        """
+        Builds the date part of the message context, which is the same for all texts substituted at the same time
+        """
+        (format_date, format_time) = get_datetime_format(dayfirst)
+        now = timezone.now()
+
+        date_context = dict()
+        date_context['__default__'] = datetime_to_str(now, format=format_time, tz=tz)
+        date_context['now'] = datetime_to_str(now, format=format_time, tz=tz)
+        date_context['today'] = datetime_to_str(now, format=format_date, tz=tz)
+        date_context['tomorrow'] = datetime_to_str(now + timedelta(days=1), format=format_date, tz=tz)
+        date_context['yesterday'] = datetime_to_str(now - timedelta(days=1), format=format_date, tz=tz)
+        return date_context
+
     @classmethod
     def create_outgoing(cls, org, user, recipient, text, broadcast=None, channel=None, priority=SMS_NORMAL_PRIORITY,
-                        created_on=None, response_to=None, message_context=None, status=PENDING, insert_object=True):
+                        created_on=None, response_to=None, message_context=None, status=PENDING, insert_object=True,
+                        date_context=None):
 
         if not org or not user:
             raise ValueError("Trying to create outgoing message with no org or user")
@@ -1054,35 +1204,22 @@ class Msg(models.Model, OrgAssetMixin):
         if not message_context:
             message_context = dict()
 
-        (text, has_template_error) = Msg.substitute_variables(text, contact, message_context, org=org)
+        (text, has_template_error) = Msg.substitute_variables(text, contact, message_context, org=org,
+                                                              date_context=date_context)
 
         # if we are doing a single message, check whether this might be a loop of some kind
-        if insert_object:
-            # prevent the loop of message while the sending phone is the channel
-            # get all messages with same text going to same number
-            same_msg_count = Msg.objects.filter(contact_urn=contact_urn,
-                                                contact__is_test=False,
-                                                channel=channel,
-                                                text=text,
-                                                direction=OUTGOING,
-                                                created_on__gte=created_on - timedelta(minutes=10)).count()
-            if same_msg_count >= 10:
-                analytics.track('System', "temba.msg_loop_caught", dict(org=org.pk, channel=channel.pk))
-                return None
-
+        if insert_object and not contact.is_test:
             # be more aggressive about short codes for duplicate messages
             # we don't want machines talking to each other
             tel = contact.raw_tel()
-            if tel and len(tel) < 6:
-                same_msg_count = Msg.objects.filter(contact_urn=contact_urn, contact__is_test=False, channel=channel, text=text,
-                                                    direction=OUTGOING, created_on__gte=created_on - timedelta(hours=24)).count()
-                if same_msg_count >= 10:
-                    analytics.track('System', "temba.msg_shortcode_loop_caught", dict(org=org.pk, channel=channel.pk))
-                    return None
-
-        # costs 1 credit to send a message
+            loop_caught = cls.detect_loop(channel, contact_urn, text, created_on, short_code=(tel and len(tel) < 6))
+            if loop_caught:
+                analytics.track('System', loop_caught, dict(org=org.pk, channel=channel.pk))
+                return None
+
+        # costs 1 credit to send a message, but messages which aren't inserted here are paid for in bulk by the caller
         topup_id = None
-        if not contact.is_test:
+        if not contact.is_test and insert_object:
             topup_id = org.decrement_credit()
 
         msg_type = 'I'
@@ -1117,6 +1254,30 @@ class Msg(models.Model, OrgAssetMixin):
         org.update_caches(OrgEvent.msg_new_outgoing, msg)
         return msg
 
+    @classmethod
+    def detect_loop(cls, channel, contact_urn, text, created_on, short_code=False):
+        """
+        Checks whether we've already sent too many messages with the same text to the same URN via the same channel
+        recently, which would suggest we're in a loop, e.g. with another machine. Returns the name of the loop caught
+        if so, otherwise records this message as sent.
+        """
+        thresholds = [('temba.msg_loop_caught', settings.MSG_LOOP_THRESHOLD)]
+        if short_code:
+            thresholds.append(('temba.msg_shortcode_loop_caught', settings.MSG_SHORTCODE_LOOP_THRESHOLD))
+
+        text_hash = hashlib.md5(text.encode('utf-8')).hexdigest()
+        key = MSG_LOOP_CACHE_KEY % (channel.pk, contact_urn.pk, text_hash)
+
+        # windows are passed to redis in milliseconds like the timestamps
+        args = [datetime_to_ms(created_on), uuid4().hex]
+        for name, (limit, window) in thresholds:
+            args += [window * 1000, limit]
+
+        r = get_redis_connection()
+        caught = int(r.eval(MSG_LOOP_LUA, 1, key, *args))
+
+        return thresholds[caught - 1][0] if caught else None
+
     @staticmethod
     def resolve_recipient(org, user, recipient, channel):
         """
@@ -1206,6 +1367,58 @@ class Msg(models.Model, OrgAssetMixin):
             changed.append(msg.pk)
         return changed
 
+    @classmethod
+    def bulk_release(cls, msgs):
+        """
+        Releases (i.e. deletes) all messages in the given queryset, in batches of set-based updates rather than one by
+        one. Folder and label counts are adjusted once at the end. Returns the number of messages released.
+        """
+        folder_deltas = defaultdict(lambda: defaultdict(int))
+        label_deltas = defaultdict(int)
+        released = 0
+
+        unreleased = msgs.exclude(visibility=DELETED).order_by('pk').values_list('pk', flat=True)
+        while True:
+            batch = list(unreleased[:RELEASE_BATCH_SIZE])
+            if not batch:
+                break
+
+            batch_msgs = Msg.objects.filter(pk__in=batch)
+
+            # folder counts change as if each message was archived (if visible) and then deleted
+            states = batch_msgs.order_by().values('org', 'visibility', 'direction', 'msg_type', 'status')
+            for state in states.annotate(count=Count('pk')):
+                deltas = folder_deltas[state['org']]
+                if state['visibility'] == VISIBLE:
+                    if state['direction'] == INCOMING:
+                        folder = OrgFolder.msgs_inbox if state['msg_type'] == INBOX else OrgFolder.msgs_flows
+                    else:
+                        folder = OrgFolder.msgs_outbox
+                    deltas[folder] -= state['count']
+                    if state['status'] == FAILED:
+                        deltas[OrgFolder.msgs_failed] -= state['count']
+                else:
+                    deltas[OrgFolder.msgs_archived] -= state['count']
+
+            # remove all labels from these messages
+            label_msgs = Msg.labels.through.objects.filter(msg__in=batch)
+            for label_count in label_msgs.order_by().values('label').annotate(count=Count('pk')):
+                label_deltas[label_count['label']] -= label_count['count']
+            label_msgs.delete()
+
+            released += batch_msgs.exclude(visibility=DELETED).update(visibility=DELETED, text="")
+
+        for org in Org.objects.filter(pk__in=folder_deltas.keys()):
+            org.update_folder_counts(folder_deltas[org.pk])
+
+        # label counts include the messages of child labels
+        for label in Label.objects.filter(pk__in=label_deltas.keys()):
+            incrby_existing(label.get_message_count_cache_key(), label_deltas[label.pk])
+            if label.parent_id:
+                incrby_existing(LABEL_MESSAGE_COUNT_CACHE_KEY % (label.org_id, label.parent_id), label_deltas[label.pk])
+
+        return released
+
     @classmethod
     def apply_action_resend(cls, msgs):
         changed = []
@@ -1389,20 +1602,23 @@ class Label(models.Model):
         """
         Adds or removes this label from the given messages
         """
-        changed = set()
+        msg_ids = set(msg.pk for msg in msgs)
+        if not msg_ids:
+            return set()
 
-        for msg in msgs:
-            # if we are adding the label and this message doesnt have it, add it
-            if add:
-                if not msg.labels.filter(pk=self.pk):
-                    msg.labels.add(self)
-                    changed.add(msg.pk)
+        # find which of these messages already have this label with a single query
+        through = Msg.labels.through
+        existing = set(through.objects.filter(label=self, msg__in=msg_ids).values_list('msg_id', flat=True))
 
-            # otherwise, remove it if not already present
-            else:
-                if msg.labels.filter(pk=self.pk):
-                    msg.labels.remove(self)
-                    changed.add(msg.pk)
+        # if we are adding the label, add it to messages which don't have it
+        if add:
+            changed = msg_ids - existing
+            through.objects.bulk_create([through(msg_id=msg_id, label=self) for msg_id in changed])
+
+        # otherwise, remove it from messages which do
+        else:
+            changed = existing
+            through.objects.filter(label=self, msg__in=changed).delete()
 
         # if there is a cached message count, update it
         count_delta = len(changed) if add else -len(changed)
@@ -12,7 +12,8 @@ from redis_cache import get_redis_connection
 from temba.contacts.models import Contact
 from temba.urls import init_analytics
 from temba.utils.mage import mage_handle_new_message, mage_handle_new_contact
-from .models import Msg, ExportMessagesTask, PENDING
+from temba.utils.queues import pop_task
+from .models import Msg, ExportMessagesTask, PENDING, SEND_BROADCAST_BATCH_TASK
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +47,22 @@ def send_broadcast_task(broadcast_id):
     except Exception as e:
         logger.exception("Error sending broadcast: %s" % str(e))
 
+@task(track_started=True, name='send_broadcast_batch')
+def send_broadcast_batch_task():
+    # pop off the next batch, there might be none if more workers were started than batches were added
+    task = pop_task(SEND_BROADCAST_BATCH_TASK)
+    if task is None:
+        return
+
+    try:
+        from .models import Broadcast
+        broadcast = Broadcast.objects.get(pk=task['broadcast'])
+        broadcast.send_batch(task['urns'], task['contacts'], trigger_send=task['trigger_send'],
+                             status=task['status'], base_language=task['base_language'],
+                             priority=task.get('priority'))
+    except Exception as e:
+        logger.exception("Error sending broadcast batch: %s" % str(e))
+
 @task(track_started=True, name='send_spam')
 def send_spam(user_id, contact_id):
     """
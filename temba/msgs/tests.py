@@ -6,14 +6,17 @@ import json
 from datetime import timedelta
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
 from django.utils import timezone
+from mock import patch
+from redis_cache import get_redis_connection
 from smartmin.tests import SmartminTest, _CRUDLTest
 from temba.contacts.models import ContactField, TEL_SCHEME
 from temba.orgs.models import Org
 from temba.channels.models import Channel
 from temba.msgs.models import Msg, Contact, ContactGroup, ExportMessagesTask, RESENT, FAILED, OUTGOING, PENDING, WIRED
-from temba.msgs.models import Broadcast, Label, Call, UnreachableException, SMS_BULK_PRIORITY
-from temba.msgs.models import VISIBLE, ARCHIVED, HANDLED, SENT
+from temba.msgs.models import Broadcast, Label, Call, UnreachableException, SMS_BULK_PRIORITY, SMS_NORMAL_PRIORITY
+from temba.msgs.models import VISIBLE, ARCHIVED, HANDLED, SENT, QUEUED
 from temba.tests import TembaTest
 from temba.utils import dict_to_struct
 from temba.values.models import DATETIME, DECIMAL
@@ -186,6 +189,32 @@ class MsgTest(TembaTest):
         must_return_none = Msg.create_outgoing(self.org, self.admin, (TEL_SCHEME, self.channel.address), 'Infinite Loop')
         self.assertIsNone(must_return_none)
         
+    def test_create_outgoing_loops(self):
+        contact = self.create_contact("Ann", "+250788111222")
+        now = timezone.now()
+
+        def send(recipient, text, created_on):
+            return Msg.create_outgoing(self.org, self.admin, recipient, text, created_on=created_on)
+
+        # the first 10 identical messages are sent, but then we assume we're in a loop
+        for m in range(10):
+            self.assertTrue(send(contact, "Hello", now))
+
+        self.assertIsNone(send(contact, "Hello", now))
+
+        # other text can still be sent, and the same text can be sent again once the window has passed
+        self.assertTrue(send(contact, "Goodbye", now))
+        self.assertTrue(send(contact, "Hello", now + timedelta(minutes=11)))
+
+        # short codes have to wait longer
+        for m in range(10):
+            self.assertTrue(send(self.joe, "Hello", now))
+
+        self.assertIsNone(send(self.joe, "Hello", now + timedelta(minutes=11)))
+
+        with override_settings(MSG_SHORTCODE_LOOP_THRESHOLD=(20, 60 * 60 * 24)):
+            self.assertTrue(send(self.joe, "Hello", now + timedelta(minutes=11)))
+
     def test_create_incoming(self):
 
         Msg.create_incoming(self.channel, (TEL_SCHEME, "250788382382"), "It's going well")
@@ -1147,6 +1176,41 @@ class BroadcastTest(TembaTest):
         self.assertEquals(sms_to_kevin.text, 'Hi Kevin Durant, You live in Kanombe and your team is Junior.')
         self.assertFalse(sms_to_kevin.has_template_error)
 
+    def test_send_batched(self):
+        joe_urn = self.joe.urns.get()
+
+        with patch('temba.msgs.models.SEND_BROADCAST_BATCH_SIZE', 2):
+            broadcast = Broadcast.create(self.org, self.user, "Hello", [joe_urn, self.joe_and_frank, self.kevin, self.lucy])
+            broadcast.send()
+
+        # each recipient gets one message, with joe only getting the one to his URN
+        self.assertEquals(4, broadcast.get_message_count())
+        self.assertEquals(1, Msg.objects.filter(contact=self.joe, contact_urn=joe_urn).count())
+        self.assertEquals(1, Msg.objects.filter(contact=self.lucy).count())
+
+        # every batch uses the priority of the whole broadcast, even the one with only joe's URN
+        self.assertEquals({SMS_NORMAL_PRIORITY}, set(broadcast.get_messages().values_list('priority', flat=True)))
+
+        # the last batch to finish updated our status
+        broadcast = Broadcast.objects.get(pk=broadcast.pk)
+        self.assertEquals(QUEUED, broadcast.status)
+        self.assertFalse(get_redis_connection().exists('broadcast:%d:batches_remaining' % broadcast.pk))
+
+    def test_send_translations(self):
+        self.joe.language = 'fre'
+        self.joe.save()
+        self.kevin.language = 'kin'
+        self.kevin.save()
+
+        broadcast = Broadcast.create(self.org, self.user, "Hello @contact.name", [self.joe_and_frank, self.kevin],
+                                     language_dict=json.dumps(dict(eng="Hello @contact.name", fre="Bonjour")))
+        broadcast.send(trigger_send=False, base_language='eng')
+
+        # each contact gets the text in their own language, falling back to the base language
+        self.assertEquals("Bonjour", Msg.objects.get(contact=self.joe).text)
+        self.assertEquals("Hello Frank Blow", Msg.objects.get(contact=self.frank).text)
+        self.assertEquals("Hello Kevin Durant", Msg.objects.get(contact=self.kevin).text)
+
 
 class BroadcastCRUDLTest(_CRUDLTest):
     def setUp(self):
@@ -1282,6 +1346,21 @@ class LabelTest(TembaTest):
         label.toggle_label([msg1], add=False)
         child.toggle_label([msg4], add=False)
 
+        with self.assertNumQueries(0):
+            self.assertEqual(label.get_message_count(), 4)
+            self.assertEqual(child.get_message_count(), 2)
+
+        # only messages whose labelling actually changes are counted
+        self.assertEqual({msg1.pk}, label.toggle_label([msg1, msg2, msg3, msg1], add=True))
+        self.assertEqual(set(), child.toggle_label([msg1, msg4], add=False))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(label.get_message_count(), 5)
+            self.assertEqual(child.get_message_count(), 2)
+
+        self.assertEqual({msg1.pk}, label.toggle_label([msg1, msg4], add=False))
+        self.assertEqual(set(), label.toggle_label([], add=True))
+
         with self.assertNumQueries(0):
             self.assertEqual(label.get_message_count(), 4)
             self.assertEqual(child.get_message_count(), 2)
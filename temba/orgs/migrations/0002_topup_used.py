@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orgs', '0001_initial'),
+        ('msgs', '0002_broadcast_channel'),
+        ('ivr', '0002_auto_20141126_2054'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topup',
+            name='used',
+            field=models.IntegerField(default=0, help_text='The number of credits used in this top up, excluding any pending in redis', verbose_name='Number of Credits Used'),
+            preserve_default=True,
+        ),
+        migrations.RunSQL(
+            "UPDATE orgs_topup t SET used = "
+            "(SELECT COUNT(*) FROM msgs_msg m WHERE m.topup_id = t.id) + "
+            "(SELECT COUNT(*) FROM ivr_ivraction a WHERE a.topup_id = t.id)"
+        ),
+    ]
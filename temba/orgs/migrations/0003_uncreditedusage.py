@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orgs', '0002_topup_used'),
+        ('contacts', '0001_initial'),
+        ('msgs', '0002_broadcast_channel'),
+        ('ivr', '0002_auto_20141126_2054'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UncreditedUsage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('used', models.IntegerField(default=0, help_text='The number of uncredited items, excluding any pending in redis', verbose_name='Number of Credits Used')),
+                ('org', models.OneToOneField(related_name='uncredited_usage', to='orgs.Org')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.RunSQL(
+            "INSERT INTO orgs_uncreditedusage (org_id, used) SELECT o.id, "
+            "(SELECT COUNT(*) FROM msgs_msg m INNER JOIN contacts_contact c ON c.id = m.contact_id "
+            "WHERE m.org_id = o.id AND m.topup_id IS NULL AND NOT c.is_test) + "
+            "(SELECT COUNT(*) FROM ivr_ivraction a INNER JOIN ivr_ivrcall v ON v.id = a.call_id "
+            "INNER JOIN contacts_contact c ON c.id = v.contact_id "
+            "WHERE a.org_id = o.id AND a.topup_id IS NULL AND NOT c.is_test) "
+            "FROM orgs_org o"
+        ),
+    ]
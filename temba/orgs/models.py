@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 import calendar
+import copy
 import json
 import logging
 import os
@@ -15,7 +16,7 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 from django.core.urlresolvers import reverse
 from django.db import models
-from django.db.models import Sum, Count
+from django.db.models import Sum, F
 from django.utils import timezone
 from django.conf import settings
 from django.core.exceptions import ValidationError
@@ -29,7 +30,7 @@ from temba.locations.models import AdminBoundary, BoundaryAlias
 from temba.nexmo import NexmoClient
 from temba.temba_email import send_temba_email
 from temba.utils import analytics, str_to_datetime, get_datetime_format, datetime_to_str, datetime_to_ms, random_string
-from temba.utils.cache import get_cacheable_result, incrby_existing
+from temba.utils.cache import get_cacheable_result, incrby_existing, LRUCache
 from twilio.rest import TwilioRestClient
 from uuid import uuid4
 from .bundles import BUNDLE_MAP, WELCOME_TOPUP_SIZE
@@ -92,8 +93,37 @@ ORG_TOPUP_CREDITS_CACHE_KEY = 'org:%d:cache:topup_credits'
 ORG_TOPUP_EXPIRES_CACHE_KEY = 'org:%d:cache:topup_expires'
 ORG_CREDITS_TOTAL_CACHE_KEY = 'org:%d:cache:credits_total'
 ORG_CREDITS_USED_CACHE_KEY = 'org:%d:cache:credits_used'
+TOPUP_USED_DELTAS_KEY = 'topup_used_deltas'
+ORG_UNCREDITED_DELTAS_KEY = 'org_uncredited_deltas'
+ORG_SCHEMA_VERSION_CACHE_KEY = 'org:%d:cache:schema_version'
 
 ORG_LOCK_TTL = 60  # 1 minute
+
+# how many org schemas each process keeps cached
+ORG_SCHEMA_CACHE_SIZE = 256
+
+# takes up to the requested number of credits from the cached active topup, provided it hasn't expired, returning the
+# topup id and the number of credits taken. The credits taken are recorded against the topup and the total used count
+# is also updated if it exists.
+ALLOCATE_CREDITS_LUA = """
+local topup_id = redis.call('get', KEYS[1])
+local expires_on = redis.call('get', KEYS[3])
+if not topup_id or (expires_on and tonumber(expires_on) < tonumber(ARGV[2])) then
+  return {0, 0}
+end
+
+local taken = math.min(tonumber(redis.call('get', KEYS[2]) or 0), tonumber(ARGV[1]))
+if taken <= 0 then
+  return {topup_id, 0}
+end
+
+redis.call('decrby', KEYS[2], taken)
+redis.call('hincrby', KEYS[5], topup_id, taken)
+if redis.call('exists', KEYS[4]) == 1 then
+  redis.call('incrby', KEYS[4], taken)
+end
+return {topup_id, taken}
+"""
 ORG_CREDITS_CACHE_TTL = 24 * 60 * 60  # 1 day
 ORG_DISPLAY_CACHE_TTL = 7 * 24 * 60 * 60  # 1 week
 
@@ -154,6 +184,7 @@ class OrgCache(Enum):
     """
     display = 1
     credits = 2
+    schema = 3
 
 
 class OrgAssetMixin(object):
@@ -184,6 +215,93 @@ class OrgAssetMixin(object):
         return bool(rows_updated)
 
 
+class OrgSchema(object):
+    """
+    The contact fields of an org and the URN schemes and channels it can use. These are cached in process for the most
+    recently used orgs and only rebuilt when the version of the org's schema in redis changes, i.e. when a field or
+    channel is changed. Fields and channels are handed out as copies so callers can't modify the cached instances.
+    """
+    _cached = LRUCache(ORG_SCHEMA_CACHE_SIZE)  # org id to schema
+
+    def __init__(self, org_id, version):
+        from temba.channels.models import Channel, SEND
+        from temba.contacts.models import ContactField
+
+        self.org_id = org_id
+        self.version = version
+
+        self._fields = list(ContactField.objects.filter(org_id=org_id).order_by('pk'))
+        self._fields_by_key = {f.key: f for f in self._fields}
+
+        channels = list(Channel.objects.filter(org_id=org_id, is_active=True).order_by('pk'))
+
+        # the schemes available for each channel role
+        self._schemes = dict()
+        for channel in channels:
+            for role in channel.role:
+                self._schemes.setdefault(role, set()).add(channel.get_scheme())
+
+        # the channels we can pick between when sending to a number, i.e. those which aren't delegates
+        self._send_channels = [c for c in channels if SEND in c.role and not c.parent_id and c.address]
+
+    @classmethod
+    def _copy(cls, instance):
+        copied = copy.copy(instance)
+        copied._state = copy.copy(instance._state)
+        return copied
+
+    @property
+    def fields(self):
+        return [self._copy(f) for f in self._fields]
+
+    @property
+    def active_fields(self):
+        return [self._copy(f) for f in self._fields if f.is_active]
+
+    @property
+    def fields_by_key(self):
+        return {key: self._copy(f) for key, f in self._fields_by_key.items()}
+
+    @property
+    def send_channels(self):
+        return [self._copy(c) for c in self._send_channels]
+
+    def get_field(self, key):
+        field = self._fields_by_key.get(key)
+        return self._copy(field) if field else None
+
+    def get_schemes(self, role):
+        return set(self._schemes.get(role, set()))
+
+    @classmethod
+    def get(cls, org_id):
+        """
+        Gets the schema for the given org, only hitting the database if it has changed since we last built it
+        """
+        r = get_redis_connection()
+        version_key = ORG_SCHEMA_VERSION_CACHE_KEY % org_id
+
+        version = r.get(version_key)
+        if version is None:
+            r.setnx(version_key, uuid4().hex)
+            version = r.get(version_key)
+
+        schema = cls._cached.get(org_id)
+        if not schema or schema.version != version:
+            schema = cls(org_id, version)
+            cls._cached.set(org_id, schema)
+
+        return schema
+
+    @classmethod
+    def invalidate(cls, org_id):
+        """
+        Invalidates the schema of the given org in every process by giving it a new version
+        """
+        r = get_redis_connection()
+        r.set(ORG_SCHEMA_VERSION_CACHE_KEY % org_id, uuid4().hex)
+
+
 class Org(SmartModel):
     """
     An Org can have several users and is the main component that holds all Flows, Messages, Contacts, etc. Orgs
@@ -339,6 +457,16 @@ class Org(SmartModel):
                 + self.get_folder_count(OrgFolder.msgs_outbox)
                 + self.get_folder_count(OrgFolder.calls_all)) > 0
 
+    def update_folder_counts(self, deltas):
+        """
+        Updates the cached counts of several folders at once, e.g. after a bulk change. Deltas are a dict of folder
+        to the change in its count.
+        """
+        r = get_redis_connection()
+        for folder, delta in deltas.iteritems():
+            if delta:
+                incrby_existing(self._get_folder_count_cache_key(folder), delta, r)
+
     def update_caches(self, event, entity):
         """
         Update org-level caches in response to an event
@@ -438,7 +566,7 @@ class Org(SmartModel):
 
     def clear_caches(self, caches):
         """
-        Clears the given cache types (display, credits) for this org. Returns number of keys actually deleted
+        Clears the given cache types (display, credits, schema) for this org. Returns number of keys actually deleted
         """
         keys = []
         if OrgCache.display in caches:
@@ -456,6 +584,9 @@ class Org(SmartModel):
             keys.append(ORG_CREDITS_TOTAL_CACHE_KEY % self.pk)
             keys.append(ORG_CREDITS_USED_CACHE_KEY % self.pk)
 
+        if OrgCache.schema in caches:
+            keys.append(ORG_SCHEMA_VERSION_CACHE_KEY % self.pk)
+
         r = get_redis_connection()
         return r.delete(*keys)
 
@@ -528,12 +659,8 @@ class Org(SmartModel):
                 prefix = 1
                 channel = None
 
-                # filter the (possibly) pre-fetched channels in Python to reduce database hits as this method is called
-                # for every message in a broadcast
-                senders = [r for r in self.channels.all() if SEND in r.role and not r.parent_id and r.is_active and r.address]
-                senders.sort(key=lambda r: r.id)
-
-                for r in senders:
+                # use the cached channels of our schema as this method is called for every message in a broadcast
+                for r in self.get_schema().send_channels:
                     channel_number = r.address.strip('+')
 
                     for idx in range(prefix, len(channel_number)):
@@ -578,16 +705,13 @@ class Org(SmartModel):
         """
         Gets all URN schemes which this org has org has channels configured for
         """
-        cache_attr = '__schemes__%s' % role
-        if hasattr(self, cache_attr):
-            return getattr(self, cache_attr)
+        return self.get_schema().get_schemes(role)
 
-        schemes = set()
-        for channel in self.channels.filter(is_active=True, role__contains=role):
-            schemes.add(channel.get_scheme())
-
-        setattr(self, cache_attr, schemes)
-        return schemes
+    def get_schema(self):
+        """
+        Gets the (cached) schema of this org, i.e. its contact fields and the URN schemes and channels it can use
+        """
+        return OrgSchema.get(self.pk)
 
     @classmethod
     def get_possible_countries(cls):
@@ -976,14 +1100,11 @@ class Org(SmartModel):
         active_credits = self.topups.filter(is_active=True, expires_on__gte=timezone.now()).aggregate(Sum('credits')).get('credits__sum')
         active_credits = active_credits if active_credits else 0
 
-        # get our expired topups
-        expired_topups = [t['id'] for t in self.topups.filter(is_active=True, expires_on__lte=timezone.now()).values('id')]
+        # plus the credits that were used on our expired topups
+        expired_topups = self.topups.filter(is_active=True, expires_on__lte=timezone.now())
+        expired_used = sum([topup.get_used() for topup in expired_topups])
 
-        # get how many messages were used on those topups
-        expired_msgs = self.msgs.filter(topup__in=expired_topups).count()
-        expired_ivrs = self.ivr_actions.filter(topup__in=expired_topups).count()
-
-        return active_credits + expired_msgs + expired_ivrs
+        return active_credits + expired_used
 
     def get_credits_used(self):
         """
@@ -993,9 +1114,11 @@ class Org(SmartModel):
                                     self._calculate_credits_used)
 
     def _calculate_credits_used(self):
-        total_msgs = self.msgs.filter(org=self, contact__is_test=False).count()
-        total_ivrs = self.ivr_actions.filter(org=self, call__contact__is_test=False).count()
-        return total_msgs + total_ivrs
+        # credits used on our topups
+        topup_used = sum([topup.get_used() for topup in self.topups.filter(is_active=True)])
+
+        # plus any messages and IVR actions we didn't have credit for
+        return topup_used + UncreditedUsage.get_used(self)
 
     def get_credits_remaining(self):
         """
@@ -1008,58 +1131,68 @@ class Org(SmartModel):
         Decrements this orgs credit by 1. Returns the id of the active topup which can then be assigned to the message
         or IVR action which is being paid for with this credit
         """
+        return self.allocate_credits(1)[0]
+
+    def allocate_credits(self, count):
+        """
+        Allocates a block of credits at once, e.g. for a batch of outgoing messages. Returns a list of the topup ids
+        to assign to each of the items being paid for, which will be None for any items we don't have credit for.
+        """
+        if count <= 0:
+            return []
+
+        r = get_redis_connection()
         active_topup_key = ORG_ACTIVE_TOPUP_CACHE_KEY % self.pk
         topup_credits_key = ORG_TOPUP_CREDITS_CACHE_KEY % self.pk
         topup_expires_key = ORG_TOPUP_EXPIRES_CACHE_KEY % self.pk
         total_used_key = ORG_CREDITS_USED_CACHE_KEY % self.pk
 
-        with self.lock_on(OrgLock.credits):
-            r = get_redis_connection()
-            active_topup_id = r.get(active_topup_key)
-            credits = r.decr(topup_credits_key)
-            expires_on = r.get(topup_expires_key)
-
-            # has this topup's credits expired?
-            if expires_on:
-                expired = datetime_to_ms(datetime.now()) > long(expires_on)
-            else:
-                expired = False
-
-            # if cached topup key has expired or topup is no longer valid, find another..
-            if active_topup_id is None or credits < 0 or expired:
-
-                active_topup = self._calculate_active_topup()
-
-                if active_topup:
-                    active_topup_id = active_topup.pk
-                    decremented_credit = (active_topup.credits - active_topup.num_msgs) - 1
-                    expires_on = datetime_to_ms(active_topup.expires_on)
-
-                    # cache it, the decremented credit value and expires timestamp
-                    r.set(active_topup_key, active_topup.pk, ORG_CREDITS_CACHE_TTL)
-                    r.set(topup_credits_key, decremented_credit, ORG_CREDITS_CACHE_TTL)
-                    r.set(topup_expires_key, expires_on, ORG_CREDITS_CACHE_TTL)
-                else:
-                    active_topup_id = None
-
-                    # delete the existing cache values
-                    r.delete(active_topup_key, topup_credits_key, topup_expires_key)
-
-            # update the total used count as well if it exists
-            incrby_existing(total_used_key, 1)
-
-        return int(active_topup_id) if active_topup_id else None
+        def take_credits(wanted):
+            # atomically take as many of the wanted credits as the cached active topup has left
+            topup_id, taken = r.eval(ALLOCATE_CREDITS_LUA, 5, active_topup_key, topup_credits_key, topup_expires_key,
+                                     total_used_key, TOPUP_USED_DELTAS_KEY, wanted, datetime_to_ms(datetime.now()))
+            return int(topup_id) if topup_id else None, int(taken)
+
+        # the common case is that the active topup can cover the whole block, which needs no lock
+        topup_id, taken = take_credits(count)
+        topup_ids = [topup_id] * taken
+
+        if taken < count:
+            with self.lock_on(OrgLock.credits):
+                while len(topup_ids) < count:
+                    # another process may have already moved onto the next topup
+                    topup_id, taken = take_credits(count - len(topup_ids))
+                    if taken:
+                        topup_ids += [topup_id] * taken
+                        continue
+
+                    active_topup = self._calculate_active_topup()
+
+                    if active_topup:
+                        # cache it, its remaining credits and expires timestamp
+                        r.set(active_topup_key, active_topup.pk, ORG_CREDITS_CACHE_TTL)
+                        r.set(topup_credits_key, active_topup.credits - active_topup.get_used(), ORG_CREDITS_CACHE_TTL)
+                        r.set(topup_expires_key, datetime_to_ms(active_topup.expires_on), ORG_CREDITS_CACHE_TTL)
+                    else:
+                        # delete the existing cache values
+                        r.delete(active_topup_key, topup_credits_key, topup_expires_key)
+
+                        # we're out of credit, but we still count these as used
+                        incrby_existing(total_used_key, count - len(topup_ids), r)
+                        UncreditedUsage.record_used(self.pk, count - len(topup_ids))
+                        topup_ids += [None] * (count - len(topup_ids))
+
+        return topup_ids
 
     def _calculate_active_topup(self):
         """
         Calculates the oldest non-expired topup that still has credits
         """
-        non_expired_topups = self.topups.filter(is_active=True, expires_on__gte=timezone.now())
-        non_expired_topups = non_expired_topups.annotate(num_msgs=Count('msgs')).order_by('expires_on')
+        non_expired_topups = self.topups.filter(is_active=True, expires_on__gte=timezone.now()).order_by('expires_on')
 
         # find the first one that has credits remaining
         for topup in non_expired_topups:
-            if topup.num_msgs < topup.credits:
+            if topup.get_used() < topup.credits:
                 return topup
 
         return None
@@ -1095,7 +1228,7 @@ class Org(SmartModel):
                         break
 
                     current_topup = unexpired_topups.pop()
-                    current_topup_remaining = current_topup.credits - current_topup.used()
+                    current_topup_remaining = current_topup.credits - current_topup.get_used()
 
                 if current_topup_remaining:
                     # if we found some credit, assign the item to the current topup
@@ -1110,6 +1243,10 @@ class Org(SmartModel):
                 Msg.objects.filter(id__in=[item.pk for item in items if isinstance(item, Msg)]).update(topup=topup)
                 IVRAction.objects.filter(id__in=[item.pk for item in items if isinstance(item, IVRAction)]).update(topup=topup)
 
+                if items:
+                    TopUp.objects.filter(pk=topup.pk).update(used=F('used') + len(items))
+                    UncreditedUsage.record_used(self.pk, -len(items))
+
         # deactive all our credit alerts
         CreditAlert.reset_for_org(self)
 
@@ -1507,6 +1644,8 @@ class TopUp(SmartModel):
                                      help_text=_("The Stripe charge id for this charge"))
     comment = models.CharField(max_length=255, null=True, blank=True,
                                help_text="Any comment associated with this topup, used when we credit accounts")
+    used = models.IntegerField(default=0, verbose_name=_("Number of Credits Used"),
+                               help_text=_("The number of credits used in this top up, excluding any pending in redis"))
 
     @classmethod
     def create(cls, user, price, credits, stripe_charge=None, org=None):
@@ -1530,15 +1669,47 @@ class TopUp(SmartModel):
         else:
             return Decimal(self.price) / Decimal(100)
 
-    def used(self):
-        return self.msgs.count() + self.ivr.count()
+    def get_used(self):
+        """
+        Gets the number of credits used in this topup, including those not yet squashed into the database
+        """
+        r = get_redis_connection()
+        return self.used + int(r.hget(TOPUP_USED_DELTAS_KEY, self.pk) or 0)
+
+    @classmethod
+    def record_used(cls, topup_id, delta):
+        """
+        Records a change in the number of credits used in the given topup, to be squashed into the database later
+        """
+        r = get_redis_connection()
+        r.hincrby(TOPUP_USED_DELTAS_KEY, topup_id, delta)
+
+    @classmethod
+    def squash_used(cls):
+        """
+        Squashes all the recorded changes to the credits used in topups into their counters in the database
+        """
+        r = get_redis_connection()
+
+        with r.lock('squash_topup_used', ORG_LOCK_TTL):
+            for topup_id, delta in r.hgetall(TOPUP_USED_DELTAS_KEY).iteritems():
+                delta = int(delta)
+                if delta:
+                    # update the database before removing the change from redis, so that in between we over-count
+                    # rather than under-count the credits used
+                    TopUp.objects.filter(pk=int(topup_id)).update(used=F('used') + delta)
+                    r.hincrby(TOPUP_USED_DELTAS_KEY, topup_id, -delta)
 
     def revert_topup(self):
-        # unwind any items that were assigned to this topup
-        self.msgs.update(topup=None)
-        self.ivr.update(topup=None)
+        # unwind any items that were assigned to this topup, which are now uncredited
+        reverted = self.msgs.update(topup=None) + self.ivr.update(topup=None)
+        UncreditedUsage.record_used(self.org_id, reverted)
 
-        # mark this topup as inactive
+        # mark this topup as inactive, with nothing used
+        r = get_redis_connection()
+        r.hdel(TOPUP_USED_DELTAS_KEY, self.pk)
+
+        self.used = 0
         self.is_active = False
         self.save()
 
@@ -1554,6 +1725,48 @@ class TopUp(SmartModel):
         return "%s Credits" % self.credits
 
 
+class UncreditedUsage(models.Model):
+    """
+    Counts the messages and IVR actions of an org which weren't paid for by any topup
+    """
+    org = models.OneToOneField(Org, related_name='uncredited_usage')
+    used = models.IntegerField(default=0, verbose_name=_("Number of Credits Used"),
+                               help_text=_("The number of uncredited items, excluding any pending in redis"))
+
+    @classmethod
+    def get_used(cls, org):
+        """
+        Gets the number of uncredited items for the given org, including those not yet squashed into the database
+        """
+        r = get_redis_connection()
+        used = cls.objects.filter(org=org).values_list('used', flat=True).first() or 0
+        return used + int(r.hget(ORG_UNCREDITED_DELTAS_KEY, org.pk) or 0)
+
+    @classmethod
+    def record_used(cls, org_id, delta):
+        """
+        Records a change in the number of uncredited items for the given org, to be squashed into the database later
+        """
+        if delta:
+            r = get_redis_connection()
+            r.hincrby(ORG_UNCREDITED_DELTAS_KEY, org_id, delta)
+
+    @classmethod
+    def squash_used(cls):
+        """
+        Squashes all the recorded changes to uncredited items into their counters in the database
+        """
+        r = get_redis_connection()
+
+        with r.lock('squash_uncredited_used', ORG_LOCK_TTL):
+            for org_id, delta in r.hgetall(ORG_UNCREDITED_DELTAS_KEY).iteritems():
+                delta = int(delta)
+                if delta:
+                    usage, created = cls.objects.get_or_create(org_id=int(org_id))
+                    cls.objects.filter(pk=usage.pk).update(used=F('used') + delta)
+                    r.hincrby(ORG_UNCREDITED_DELTAS_KEY, org_id, -delta)
+
+
 class CreditAlert(SmartModel):
     """
     Tracks when we have sent alerts to organization admins about low credits.
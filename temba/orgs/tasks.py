@@ -1,4 +1,4 @@
-from .models import CreditAlert, Invitation
+from .models import CreditAlert, Invitation, TopUp, UncreditedUsage
 from djcelery_transactions import task
 from django.conf import settings
 
@@ -10,3 +10,8 @@ def send_invitation_email_task(invitation_id):
 @task(track_started=True, name='check_credits_task')
 def check_credits_task():
     CreditAlert.check_org_credits()
+
+@task(track_started=True, name='squash_topup_used_task')
+def squash_topup_used_task():
+    TopUp.squash_used()
+    UncreditedUsage.squash_used()
@@ -12,8 +12,8 @@ from django.test.utils import override_settings
 from django.utils import timezone
 from redis_cache import get_redis_connection
 from temba.campaigns.models import Campaign, CampaignEvent
-from temba.contacts.models import ContactGroup, TEL_SCHEME, TWITTER_SCHEME
-from temba.orgs.models import Org, OrgCache, OrgEvent, OrgFolder, TopUp, Invitation, DAYFIRST, MONTHFIRST
+from temba.contacts.models import ContactField, ContactGroup, TEL_SCHEME, TWITTER_SCHEME
+from temba.orgs.models import Org, OrgCache, OrgEvent, OrgFolder, TopUp, UncreditedUsage, Invitation, DAYFIRST, MONTHFIRST
 from temba.orgs.models import ORG_ACTIVE_TOPUP_CACHE_KEY, ORG_TOPUP_CREDITS_CACHE_KEY, ORG_TOPUP_EXPIRES_CACHE_KEY
 from temba.channels.models import Channel, RECEIVE, SEND, TWILIO, TWITTER
 from temba.flows.models import Flow
@@ -21,6 +21,7 @@ from temba.msgs.models import Broadcast, Call, Label, Msg, Schedule, CALL_IN, IN
 from temba.tests import TembaTest
 from temba.triggers.models import Trigger
 from temba.utils import datetime_to_ms
+from temba.values.models import DECIMAL
 
 
 class OrgContextProcessorTest(TembaTest):
@@ -431,7 +432,74 @@ class OrgTest(TembaTest):
         topup_id = self.org.decrement_credit()
         self.assertEquals(active.pk, topup_id)
         self.assertEquals(topup_id, int(r.get(ORG_ACTIVE_TOPUP_CACHE_KEY % self.org.pk)))
-        self.assertEquals(999, int(r.get(ORG_TOPUP_CREDITS_CACHE_KEY % self.org.pk)))
+
+        # the two credits we took earlier are recorded as used
+        self.assertEquals(997, int(r.get(ORG_TOPUP_CREDITS_CACHE_KEY % self.org.pk)))
+
+    def test_allocate_credits(self):
+        welcome_topup = TopUp.objects.get()
+        TopUp.objects.filter(pk=welcome_topup.pk).update(credits=5)
+        self.org.update_caches(OrgEvent.topup_updated, None)
+
+        second_topup = TopUp.create(self.admin, price=0, credits=100, org=self.org)
+
+        # a block of credits is split across topups when the active one runs out
+        self.assertEquals([welcome_topup.pk] * 5 + [second_topup.pk] * 3, self.org.allocate_credits(8))
+
+        r = get_redis_connection()
+        self.assertEquals(second_topup.pk, int(r.get(ORG_ACTIVE_TOPUP_CACHE_KEY % self.org.pk)))
+        self.assertEquals(97, int(r.get(ORG_TOPUP_CREDITS_CACHE_KEY % self.org.pk)))
+
+        # blocks which the active topup can cover don't touch the database
+        with self.assertNumQueries(0):
+            self.assertEquals([second_topup.pk] * 10, self.org.allocate_credits(10))
+
+        self.assertEquals(87, int(r.get(ORG_TOPUP_CREDITS_CACHE_KEY % self.org.pk)))
+        self.assertEquals([], self.org.allocate_credits(0))
+
+    def test_topup_used(self):
+        topup = TopUp.create(self.admin, price=0, credits=100, org=self.org)
+
+        TopUp.record_used(topup.pk, 3)
+        TopUp.record_used(topup.pk, -1)
+
+        # changes are recorded in redis until they're squashed
+        topup = TopUp.objects.get(pk=topup.pk)
+        self.assertEquals(0, topup.used)
+        self.assertEquals(2, topup.get_used())
+
+        TopUp.squash_used()
+
+        topup = TopUp.objects.get(pk=topup.pk)
+        self.assertEquals(2, topup.used)
+        self.assertEquals(2, topup.get_used())
+
+        # squashing again doesn't count them twice
+        TopUp.squash_used()
+        self.assertEquals(2, TopUp.objects.get(pk=topup.pk).get_used())
+
+    def test_uncredited_used(self):
+        self.assertEquals(0, UncreditedUsage.get_used(self.org))
+
+        UncreditedUsage.record_used(self.org.pk, 5)
+        UncreditedUsage.record_used(self.org.pk, -2)
+
+        # changes are recorded in redis until they're squashed
+        self.assertFalse(UncreditedUsage.objects.filter(org=self.org))
+        self.assertEquals(3, UncreditedUsage.get_used(self.org))
+
+        UncreditedUsage.squash_used()
+        UncreditedUsage.squash_used()
+
+        self.assertEquals(3, UncreditedUsage.objects.get(org=self.org).used)
+        self.assertEquals(3, UncreditedUsage.get_used(self.org))
+
+        # reverting a topup makes its items uncredited
+        contact = self.create_contact("Michael Shumaucker", "+250788123123")
+        self.create_msg(contact=contact, direction='I', text="Test")
+        TopUp.objects.get(org=self.org).revert_topup()
+
+        self.assertEquals(4, UncreditedUsage.get_used(self.org))
 
     def test_topup_admin(self):
         self.login(self.admin)
@@ -1047,7 +1115,9 @@ class OrgCRUDLTest(TembaTest):
 
     def test_urn_schemes(self):
         # remove existing channels
-        Channel.objects.all().update(is_active=False, org=None)
+        for channel in Channel.objects.all():
+            channel.is_active = False
+            channel.save()
 
         self.assertEqual(set(), self.org.get_schemes(SEND))
         self.assertEqual(set(), self.org.get_schemes(RECEIVE))
@@ -1073,6 +1143,46 @@ class OrgCRUDLTest(TembaTest):
         self.assertEqual({TEL_SCHEME, TWITTER_SCHEME}, self.org.get_schemes(SEND))
         self.assertEqual({TEL_SCHEME, TWITTER_SCHEME}, self.org.get_schemes(RECEIVE))
 
+    def test_schema(self):
+        ContactField.get_or_create(self.org, 'age', "Age", value_type=DECIMAL)
+        ContactField.get_or_create(self.org, 'nick', "Nickname")
+
+        schema = self.org.get_schema()
+        self.assertEqual(['age', 'nick'], [f.key for f in schema.fields])
+        self.assertEqual(DECIMAL, schema.get_field('age').value_type)
+
+        # fetching again doesn't hit the database, even from another instance of the org
+        other_org = Org.objects.get(pk=self.org.pk)
+        with self.assertNumQueries(0):
+            self.assertIs(schema, other_org.get_schema())
+
+        # callers get copies of fields so can't modify our cached ones
+        schema.get_field('age').label = "Changed"
+        schema.fields[0].label = "Changed"
+        self.assertEqual("Age", schema.get_field('age').label)
+
+        # changing a field gives us a new schema
+        ContactField.hide_field(self.org, 'nick')
+        schema = self.org.get_schema()
+        self.assertEqual(['age'], [f.key for f in schema.active_fields])
+        self.assertFalse(schema.get_field('nick').is_active)
+
+        # as does adding a channel
+        Channel.objects.create(name="Twitter", channel_type=TWITTER, role="SR", org=self.org,
+                               created_by=self.user, modified_by=self.user)
+        self.assertIn(TWITTER_SCHEME, self.org.get_schemes(SEND))
+
+        # as does clearing the cache
+        self.org.clear_caches([OrgCache.schema])
+        self.assertIsNot(schema, self.org.get_schema())
+
+        # contact message contexts include all fields from the schema
+        contact = self.create_contact("Bob", "+250788111222")
+        contact.set_field('age', 25)
+        context = contact.build_message_context()
+        self.assertEqual("25", context['age'])
+        self.assertEqual("", context['nick'])
+
     def test_login_case_not_sensitive(self):
         login_url = reverse('users.user_login')
 
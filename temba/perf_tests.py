@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+import json
 import random
 
 from django.conf import settings
@@ -222,6 +223,32 @@ class PerformanceTest(TembaTest):
         with SegmentProfiler(self, "Updating existing contacts", True):
             self._create_contacts(num_contacts, ["Jimmy"])
 
+    def test_number_normalization(self):
+        num_distinct = 50000
+        num_numbers = 1000000
+
+        # build a sample of numbers like we get from imports and channels, where the same numbers recur in the same
+        # formats and most traffic comes from a minority of the numbers
+        random.seed(1234)
+        formats = ("078%07d", "+25078%07d", "25078%07d", "078 %07d", "(078) %07d")
+        distinct = [random.choice(formats) % random.randint(0, 9999999) for n in range(num_distinct)]
+        numbers = [distinct[int(random.paretovariate(1.16)) % num_distinct] for n in range(num_numbers)]
+
+        ContactURN._normalized_numbers.clear()
+
+        with SegmentProfiler(self, "Normalizing %d numbers without caching" % (num_numbers / 10), False):
+            for number in numbers[:num_numbers / 10]:
+                ContactURN._normalize_number(number, "RW")
+
+        with SegmentProfiler(self, "Normalizing %d numbers" % num_numbers, False):
+            for number in numbers:
+                ContactURN.normalize_number(number, "RW")
+
+        ContactURN._normalized_numbers.clear()
+
+        with SegmentProfiler(self, "Normalizing %d numbers as a batch" % num_numbers, False):
+            ContactURN.normalize_numbers(numbers, "RW")
+
     def test_message_incoming(self):
         num_contacts = 300
 
@@ -292,6 +319,26 @@ class PerformanceTest(TembaTest):
         self.assertEqual(10000, FlowRun.objects.all().count())
         self.assertEqual(20000, FlowStep.objects.all().count())
 
+    def test_flow_webhook_payload(self):
+        from temba.api.models import WebHookEvent
+
+        contact = self._create_contacts(1, ["Bobby"])[0]
+        flow = self.create_flow()
+        ruleset = flow.rule_sets.get()
+        run = FlowRun.create(flow, contact)
+
+        # give our run a long step history, with a message on each step
+        incoming = self._create_incoming(2000, "Red", self.tel_mtn, [contact])
+        for msg in incoming:
+            step = FlowStep.objects.create(run=run, contact=contact, step_type='R', step_uuid=ruleset.uuid,
+                                           rule_value=msg.text)
+            step.messages.add(msg)
+
+        with SegmentProfiler(self, "Building flow webhook payload for a long run", True):
+            data = WebHookEvent.build_flow_event_data(flow, run, ruleset, contact, incoming[-1])
+
+        self.assertEqual(2000, len(json.loads(data['steps'])))
+
     def test_api(self):
         contacts = self._create_contacts(10000, ["Bobby", "Jimmy", "Mary"])
         self._create_groups(10, ["Bobbys", "Jims", "Marys"], contacts)
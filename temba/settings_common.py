@@ -811,6 +811,10 @@ CELERYBEAT_SCHEDULE = {
         'task': 'check_credits_task',
         'schedule': timedelta(seconds=900)
     },
+    "squash-topup-used": {
+        'task': 'squash_topup_used_task',
+        'schedule': timedelta(seconds=60)
+    },
     "check-messages-task": {
         'task': 'check_messages_task',
         'schedule': timedelta(seconds=300)
@@ -825,6 +829,8 @@ CELERYBEAT_SCHEDULE = {
 CELERY_TASK_MAP = {
     'send_msg_task': 'temba.channels.tasks.send_msg_task',
     'start_msg_flow_batch': 'temba.flows.tasks.start_msg_flow_batch_task',
+    'send_broadcast_batch': 'temba.msgs.tasks.send_broadcast_batch_task',
+    'call_flow_webhook': 'temba.flows.tasks.call_flow_webhook_task',
 }
 
 #-----------------------------------------------------------------------------------
@@ -915,11 +921,25 @@ SEND_MESSAGES = False
 #         could cause external APIs to be called in test environment
 SEND_WEBHOOKS = False
 
+######
+# Whether flow webhooks are called from a celery queue, in which case runs wait at their ruleset
+# until the webhook returns instead of blocking message handling. This is off by default, and uses
+# the flows queue which is already consumed by our workers. To give webhooks their own workers, set
+# this to another queue and consume it, e.g. `python manage.py celery worker -Q webhooks`
+FLOW_WEBHOOKS_ASYNC = False
+FLOW_WEBHOOK_QUEUE = 'flows'
+
 ######
 # DANGER: only turn this on if you know what you are doing!
 #         could cause emails to be sent in test environment
 SEND_EMAILS = False
 
+######
+# Outgoing messages are treated as a loop once this many identical messages have been sent to the same URN
+# via the same channel within the window (in seconds). Short codes have their own stricter threshold.
+MSG_LOOP_THRESHOLD = (10, 60 * 10)
+MSG_SHORTCODE_LOOP_THRESHOLD = (10, 60 * 60 * 24)
+
 MESSAGE_HANDLERS = ['temba.triggers.handlers.TriggerHandler',
                     'temba.flows.handlers.FlowHandler',
                     'temba.triggers.handlers.CatchAllHandler']
@@ -1,5 +1,8 @@
 from __future__ import unicode_literals
 
+import threading
+
+from collections import OrderedDict
 from redis_cache import get_redis_connection
 
 
@@ -40,3 +43,42 @@ def incrby_existing(key, delta, r=None):
           "  end\n" \
           "end"
     r.eval(lua, 1, key, delta)
+
+
+class LRUCache(object):
+    """
+    A bounded in-process cache which discards the least recently used item when full. Values must not be None.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value  # re-insert to make this the most recently used
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def get_or_set(self, key, callable):
+        """
+        Gets the cached value for the given key, calculating and caching it with the given callable if necessary
+        """
+        value = self.get(key)
+        if value is None:
+            value = callable()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()